@@ -1,4 +1,6 @@
 #!/bin/bash
 
-# Run performance tests only and print final test results
+# Run performance tests only and print final test results. The measurements are written to performance-results.json,
+# set PIPEFORCE_PERFORMANCE_BASELINE=src/test/performance-baseline.json to fail on regressions
+export PIPEFORCE_PERFORMANCE_RESULTS=${PIPEFORCE_PERFORMANCE_RESULTS:-performance-results.json}
 pytest -k 'test_performance_' --junitxml result.xml >> /dev/null; cat result.xml
\ No newline at end of file
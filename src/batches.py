@@ -0,0 +1,254 @@
+# pylint: disable=E0401
+import inspect
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import pika
+
+from src.logs import get_logger
+from src.payloads import payload_converter
+from src.workers import run_batch_in_process_worker
+
+logger = get_logger("batches")
+
+
+class BatchMixin:
+    """
+        Passes the messages of service methods registered by @batch_event to them in batches for PipeforceClient.
+        The messages are collected on the connection thread per BatchLane, the batch is executed in the worker pool
+        of the lane and each of its messages is settled afterwards: Acknowledged in case it succeeded, otherwise
+        retried, see RetryMixin. Expects the client to provide config, metrics, profiler, connection, lanes,
+        handlers, batch_converters, resolve_handler, resolve_class, settle_message and finish_message.
+    """
+
+    def collect_batch(self, lane, channel, method, props, body, payload):  # pylint: disable=too-many-arguments
+        """
+        Adds the message to the batch being collected by the lane and passes the batch on once it is full.
+        The first message of a batch starts the timer passing it on after max_wait seconds, as does the next
+        message in case the timer was lost together with the connection. Runs on the connection thread.
+        :param lane: The BatchLane the message was delivered by.
+        :param channel:
+        :param method:
+        :param props:
+        :param body:
+        :param payload:
+        :return:
+        """
+        lane.buffer.append((channel, method, props, body, payload))
+        if len(lane.buffer) >= lane.max_size:
+            self.flush_batch(lane)
+        elif not lane.flush_scheduled:
+            lane.flush_scheduled = True
+            self.schedule_batch_flush(lane)
+
+    def schedule_batch_flush(self, lane):
+        """
+        Passes the batch being collected by the lane on after max_wait seconds.
+        :param lane:
+        :return:
+        """
+        self.connection.call_later(lane.max_wait, partial(self.flush_batch, lane, lane.generation))
+
+    def flush_batch(self, lane, generation=None):
+        """
+        Passes the messages collected by the lane so far on to its batch service method.
+        :param lane:
+        :param generation: The batch the timer was started for. Timers of batches passed on already are ignored.
+        :return:
+        """
+        if generation is not None and generation != lane.generation:
+            return
+
+        # Messages received by a connection lost meanwhile are redelivered by the broker
+        items = [item for item in lane.buffer if item[0].is_open]
+        lane.reset()
+        if not items:
+            return
+
+        labels = (("handler", lane.value),)
+        self.metrics.inc("pipeforce_batches_total", labels)
+        self.metrics.inc("pipeforce_batch_messages_total", labels, len(items))
+        self.execute_batch(lane, items)
+
+    def flush_batches(self):
+        """
+        Passes the messages collected by all batch lanes on, for example while draining.
+        :return:
+        """
+        for lane in self.lanes:
+            if lane.batch:
+                self.flush_batch(lane)
+
+    def reset_batches(self):
+        """
+        Drops the messages collected by all batch lanes together with their timers after the connection was lost.
+        The broker redelivers these messages to the new connection.
+        :return:
+        """
+        for lane in self.lanes:
+            if lane.batch:
+                for _, method, props, body, _ in lane.buffer:
+                    self.finish_message(method, props, body, False)
+                lane.reset()
+
+    def execute_batch(self, lane, items):
+        """
+        Executes the batch service method in the worker pool of the lane and settles the messages afterwards.
+        :param lane:
+        :param items: The messages of the batch as (channel, method, props, body, payload) tuples.
+        :return:
+        """
+        payloads = [payload for _, _, _, _, payload in items]
+        if lane.executor is None:
+            self.settle_batch(lane, items, self.run_batch(lane.value, payloads))
+            return
+
+        if isinstance(lane.executor, ProcessPoolExecutor):
+            future = lane.executor.submit(run_batch_in_process_worker, lane.value, payloads)
+        else:
+            future = lane.executor.submit(self.run_batch, lane.value, payloads)
+
+        future.add_done_callback(partial(self.on_batch_done, lane, items))
+
+    def on_batch_done(self, lane, items, future):
+        """
+        Called inside the worker pool after the batch service method has returned.
+        Schedules settling the messages on the connection thread, since pika channels are not thread-safe.
+        :param lane:
+        :param items:
+        :param future: Its result are the failures as returned by run_batch.
+        :return:
+        """
+        error = future.exception()
+        if error:
+            logger.error("Worker failed for batch of %s: %r", lane.value, error, exc_info=error,
+                         extra={"handler": lane.value})
+            failures = None
+        else:
+            failures = future.result()
+
+        try:
+            self.connection.add_callback_threadsafe(partial(self.settle_batch, lane, items, failures))
+        except pika.exceptions.AMQPError:
+            logger.warning("Connection lost, batch of %s will be redelivered", lane.value,
+                           extra={"handler": lane.value})
+            for index, (_, method, props, body, _) in enumerate(items):
+                self.finish_message(method, props, body, failures is not None and failures[index] is None)
+
+    def settle_batch(self, lane, items, failures):
+        """
+        Acknowledges the succeeded messages of the batch and retries the failed ones.
+        :param lane:
+        :param items:
+        :param failures: The error of each message or None for each succeeded one, as returned by run_batch.
+            None in case the worker failed, which retries all messages.
+        :return:
+        """
+        for index, (channel, method, props, body, _) in enumerate(items):
+            if failures is None:
+                self.settle_message(channel, method, props, body, None)
+            else:
+                error = failures[index]
+                self.settle_message(channel, method, props, body, [(lane.value, error)] if error else [])
+
+    def run_batch(self, value, payloads) -> list:
+        """
+        Executes the batch service method with the converted payloads of the batch.
+        :param value: The batch service method in the form module.Class#method.
+        :param payloads:
+        :return: The error description of each failed message or None for each succeeded one.
+        """
+        start = time.perf_counter()
+        try:
+            handler = self.handlers.get(value) or self.resolve_handler(value)
+            convert = self.batch_converter(value)
+            result = self.profiler.call(handler, [convert(payload) for payload in payloads])
+            return self.batch_failures(value, result, len(payloads))
+        except Exception as error:  # pylint: disable=broad-except
+            return self.batch_error(value, error, len(payloads))
+        finally:
+            self.metrics.observe("pipeforce_handler_duration_seconds", time.perf_counter() - start,
+                                 (("handler", value),))
+
+    async def run_batch_async(self, value, payloads) -> list:
+        """
+        Executes the batch service method like run_batch on the event loop of AsyncPipeforceClient.
+        Async service methods are awaited, others are executed in the default executor.
+        :param value:
+        :param payloads:
+        :return:
+        """
+        start = time.perf_counter()
+        try:
+            handler = self.handlers.get(value) or self.resolve_handler(value)
+            if not inspect.iscoroutinefunction(handler):
+                return await self.loop.run_in_executor(None, self.run_batch, value, payloads)
+
+            convert = self.batch_converter(value)
+            result = await handler([convert(payload) for payload in payloads])
+            self.metrics.observe("pipeforce_handler_duration_seconds", time.perf_counter() - start,
+                                 (("handler", value),))
+            return self.batch_failures(value, result, len(payloads))
+        except Exception as error:  # pylint: disable=broad-except
+            return self.batch_error(value, error, len(payloads))
+
+    async def handle_batch(self, lane, items):
+        """
+        Executes the batch on the event loop of AsyncPipeforceClient and settles its messages afterwards.
+        :param lane:
+        :param items:
+        :return:
+        """
+        failures = await self.run_batch_async(lane.value, [payload for _, _, _, _, payload in items])
+        self.settle_batch(lane, items, failures)
+
+    def batch_converter(self, value):
+        """
+        Returns the function converting a Payload into the list item type expected by the batch service method.
+        :param value:
+        :return:
+        """
+        convert = self.batch_converters.get(value)
+        if convert is None:
+            clazz, method_name = self.resolve_class(value)
+            convert = self.batch_converters[value] = payload_converter(getattr(clazz, method_name), batch=True)
+        return convert
+
+    def batch_failures(self, value, result, count) -> list:
+        """
+        Returns the failures of the messages of a batch from the result of the batch service method.
+        :param value:
+        :param result: None in case all messages succeeded, otherwise one entry per message:
+            An exception or False marks the message as failed.
+        :param count: The number of messages.
+        :return: The error description of each failed message or None for each succeeded one.
+        """
+        if result is None:
+            return [None] * count
+
+        result = list(result)
+        if len(result) != count:
+            raise ValueError(f"Batch service {value} returned {len(result)} results for {count} messages")
+
+        failures = [repr(entry) if isinstance(entry, BaseException) else "Failed in batch" if entry is False else None
+                    for entry in result]
+        failed = sum(failure is not None for failure in failures)
+        if failed:
+            self.metrics.inc("pipeforce_handler_errors_total", (("handler", value),), failed)
+            logger.warning("Batch service %s failed for %s of %s messages", value, failed, count,
+                           extra={"handler": value})
+        return failures
+
+    def batch_error(self, value, error, count) -> list:
+        """
+        Logs and counts the error of a batch service method, which fails all messages of the batch.
+        :param value:
+        :param error:
+        :param count: The number of messages.
+        :return: The error description for each message.
+        """
+        self.metrics.inc("pipeforce_handler_errors_total", (("handler", value),), count)
+        logger.error("Batch service %s failed for %s messages: %r", value, count, error, exc_info=error,
+                     extra={"handler": value})
+        return [repr(error)] * count
@@ -0,0 +1,805 @@
+# pylint: disable=E0401
+import heapq
+import itertools
+import queue as queues
+import threading
+import time
+from collections import deque
+from functools import partial
+
+import pika
+from pika.frame import Method
+from pika.spec import Basic, Queue
+
+from src.logs import get_logger
+from src.topics import RoutingIndex
+
+logger = get_logger("broker")
+
+# Max seconds a connection thread waits for new events before checking its state again
+POLL_INTERVAL = 0.05
+
+
+class _Message:
+    """
+        A message stored in a queue of the in-memory broker.
+    """
+    __slots__ = ("exchange", "routing_key", "properties", "body", "published_at", "redelivered")
+
+    def __init__(self, exchange, routing_key, properties, body, published_at):  # pylint: disable=too-many-arguments
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.properties = properties
+        self.body = body
+        self.published_at = published_at
+        self.redelivered = False
+
+
+class _Queue:
+    """
+        A queue of the in-memory broker with its messages and consumers.
+    """
+
+    def __init__(self, name, arguments, auto_delete, owner):
+        self.name = name
+        self.arguments = arguments or {}
+        self.auto_delete = auto_delete
+        self.owner = owner
+        self.messages = deque()
+        self.consumers = deque()
+
+    def next_consumer(self):
+        """
+        Returns the next consumer in round-robin order which has room in its prefetch window.
+        Consumers with a higher x-priority argument are served first.
+        :return: The consumer or None.
+        """
+        best = None
+        for _ in range(len(self.consumers)):
+            consumer = self.consumers[0]
+            self.consumers.rotate(-1)
+            if consumer.has_capacity() and (best is None or consumer.priority > best.priority):
+                best = consumer
+        return best
+
+
+class _Consumer:  # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    """
+        A consumer of a queue of the in-memory broker.
+    """
+
+    def __init__(self, tag, channel, queue, callback, auto_ack, arguments):  # pylint: disable=too-many-arguments
+        self.tag = tag
+        self.channel = channel
+        self.queue = queue
+        self.callback = callback
+        self.auto_ack = auto_ack
+        self.priority = (arguments or {}).get("x-priority", 0)
+        self.prefetch_count = channel.prefetch_count
+        self.unacked = 0
+
+    def has_capacity(self) -> bool:
+        """
+        Returns true in case another message can be delivered to this consumer.
+        :return:
+        """
+        return self.auto_ack or not self.prefetch_count or self.unacked < self.prefetch_count
+
+
+class InMemoryBroker:  # pylint: disable=too-many-instance-attributes,too-many-public-methods
+    """
+        In-process stand-in for the message broker, so PipeforceClient can consume and send messages without
+        RabbitMQ, for example to measure the throughput of a service with loadgen.py. Supports direct, topic and
+        fanout exchanges, bindings, prefetch windows, consumer priorities, acks, rejects, exclusive and auto-delete
+        queues and dead-lettering of expired and rejected messages. Message priorities are not emulated.
+
+        Its connections mimic pika.BlockingConnection: Deliveries, timers and callbacks run on the thread
+        calling start_consuming or process_data_events of the connection. Use attach to let a client connect
+        to this broker instead of RabbitMQ.
+    """
+
+    def __init__(self, on_ack=None):
+        """
+        :param on_ack: Optional function called with queue name, message properties and seconds since the message
+            was published each time a message is acknowledged. Called while holding the lock of the broker.
+        """
+        self.on_ack = on_ack
+        self.lock = threading.RLock()
+        self.expiry_ready = threading.Condition(self.lock)
+        self.exchanges = {"": "direct"}
+        self.bindings = {}
+        self.indexes = {}
+        self.queues = {}
+        self.connections = []
+        self.expiring = []
+        self.sequence = itertools.count()
+        self.expiry_thread = None
+        self.closed = False
+
+    def attach(self, client):
+        """
+        Lets the client and its reply consumer connect to this broker instead of the configured one.
+        :param client: The PipeforceClient.
+        :return: The client.
+        """
+        client.create_connection = self.connect
+        return client
+
+    def connect(self) -> "MemoryConnection":
+        """
+        Opens a new connection to this broker.
+        :return:
+        """
+        connection = MemoryConnection(self)
+        with self.lock:
+            self.connections.append(connection)
+        return connection
+
+    def disconnect(self):
+        """
+        Closes all connections as if the broker was lost, so the clients reconnect.
+        Unacknowledged messages are requeued.
+        :return:
+        """
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            connection.close_by_broker(pika.exceptions.StreamLostError("Connection to in-memory broker lost"))
+
+    def close(self):
+        """
+        Closes all connections and stops expiring messages.
+        :return:
+        """
+        self.disconnect()
+        with self.lock:
+            self.closed = True
+            self.expiry_ready.notify_all()
+
+    def message_count(self, queue: str) -> int:
+        """
+        Returns the number of messages ready for delivery in the given queue.
+        :param queue:
+        :return:
+        """
+        with self.lock:
+            return len(self.queues[queue].messages) if queue in self.queues else 0
+
+    def consumer_count(self, queue: str) -> int:
+        """
+        Returns the number of consumers of the given queue.
+        :param queue:
+        :return:
+        """
+        with self.lock:
+            return len(self.queues[queue].consumers) if queue in self.queues else 0
+
+    def declare_exchange(self, exchange: str, exchange_type: str):
+        """
+        Declares the exchange in case it does not exist yet.
+        :param exchange:
+        :param exchange_type: direct, topic or fanout.
+        :return:
+        """
+        with self.lock:
+            self.exchanges.setdefault(exchange, exchange_type)
+
+    def declare_queue(self, name: str, arguments, auto_delete: bool, owner) -> _Queue:
+        """
+        Declares the queue in case it does not exist yet.
+        :param name:
+        :param arguments:
+        :param auto_delete: Delete the queue once its last consumer was cancelled.
+        :param owner: The connection owning an exclusive queue, otherwise None.
+        :return:
+        """
+        with self.lock:
+            if name not in self.queues:
+                self.queues[name] = _Queue(name, arguments, auto_delete, owner)
+            return self.queues[name]
+
+    def delete_queue(self, name: str):
+        """
+        Deletes the queue with its messages and bindings.
+        :param name:
+        :return:
+        """
+        with self.lock:
+            self.queues.pop(name, None)
+            for exchange, bindings in self.bindings.items():
+                if any(queue == name for _, queue in bindings):
+                    self.bindings[exchange] = [binding for binding in bindings if binding[1] != name]
+                    self.indexes.pop(exchange, None)
+
+    def bind(self, exchange: str, queue: str, routing_key: str):
+        """
+        Binds the queue to the exchange.
+        :param exchange:
+        :param queue:
+        :param routing_key: The routing key pattern.
+        :return:
+        """
+        with self.lock:
+            self.check_exchange(exchange)
+            bindings = self.bindings.setdefault(exchange, [])
+            if (routing_key, queue) not in bindings:
+                bindings.append((routing_key, queue))
+                self.indexes.pop(exchange, None)
+
+    def unbind(self, exchange: str, queue: str, routing_key: str):
+        """
+        Removes the binding of the queue to the exchange.
+        :param exchange:
+        :param queue:
+        :param routing_key:
+        :return:
+        """
+        with self.lock:
+            bindings = self.bindings.get(exchange, [])
+            if (routing_key, queue) in bindings:
+                bindings.remove((routing_key, queue))
+                self.indexes.pop(exchange, None)
+
+    def check_exchange(self, exchange: str):
+        """
+        Fails like the message broker in case the exchange does not exist.
+        :param exchange:
+        :return:
+        """
+        if exchange not in self.exchanges:
+            raise pika.exceptions.ChannelClosedByBroker(404, f"NOT_FOUND - no exchange '{exchange}'")
+
+    def route(self, exchange: str, routing_key: str) -> list:
+        """
+        Returns the queues the exchange routes the given routing key to.
+        :param exchange:
+        :param routing_key:
+        :return:
+        """
+        if exchange == "":
+            return [self.queues[routing_key]] if routing_key in self.queues else []
+
+        self.check_exchange(exchange)
+        exchange_type = self.exchanges[exchange]
+        bindings = self.bindings.get(exchange, [])
+        if exchange_type == "fanout":
+            names = [queue for _, queue in bindings]
+        elif exchange_type == "topic":
+            index = self.indexes.get(exchange)
+            if index is None:
+                index = self.indexes[exchange] = RoutingIndex(bindings)
+            names = [queue for _, queue in index.match(routing_key)]
+        else:
+            names = [queue for key, queue in bindings if key == routing_key]
+        return [self.queues[name] for name in dict.fromkeys(names) if name in self.queues]
+
+    def publish(self, exchange: str, routing_key: str, properties, body, published_at=None):  # pylint: disable=too-many-arguments
+        """
+        Routes the message to the bound queues and delivers it to their consumers. Unroutable messages are dropped.
+        :param exchange:
+        :param routing_key:
+        :param properties:
+        :param body:
+        :param published_at: The time the message was originally published. Defaults to now.
+        :return:
+        """
+        if properties is None:
+            properties = pika.BasicProperties()
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        if published_at is None:
+            published_at = time.perf_counter()
+
+        with self.lock:
+            for queue in self.route(exchange, routing_key):
+                self.enqueue(queue, _Message(exchange, routing_key, properties, body, published_at))
+
+    def enqueue(self, queue: _Queue, message: _Message):
+        """
+        Adds the message to the queue, schedules its expiry in case the queue has a message TTL
+        and delivers the waiting messages of the queue.
+        :param queue:
+        :param message:
+        :return:
+        """
+        queue.messages.append(message)
+        ttl = queue.arguments.get("x-message-ttl")
+        if ttl is not None:
+            heapq.heappush(self.expiring, (time.monotonic() + ttl / 1000, next(self.sequence), queue, message))
+            self.start_expiry()
+        self.deliver(queue)
+
+    def deliver(self, queue: _Queue):
+        """
+        Delivers waiting messages of the queue as long as its consumers have room in their prefetch windows.
+        :param queue:
+        :return:
+        """
+        while queue.messages:
+            consumer = queue.next_consumer()
+            if consumer is None:
+                return
+            consumer.channel.deliver(consumer, queue.messages.popleft())
+
+    def settle(self, queue: _Queue, message: _Message, acked: bool, requeue: bool):
+        """
+        Settles a delivered message: Reports acked messages to on_ack, puts requeued messages back to the head
+        of their queue and dead-letters the others.
+        :param queue:
+        :param message:
+        :param acked:
+        :param requeue:
+        :return:
+        """
+        if acked:
+            if self.on_ack:
+                self.on_ack(queue.name, message.properties, time.perf_counter() - message.published_at)
+        elif requeue:
+            message.redelivered = True
+            queue.messages.appendleft(message)
+        else:
+            self.dead_letter(queue, message)
+
+    def dead_letter(self, queue: _Queue, message: _Message):
+        """
+        Publishes the message to the dead letter exchange of its queue, if any.
+        :param queue:
+        :param message:
+        :return:
+        """
+        exchange = queue.arguments.get("x-dead-letter-exchange")
+        if exchange is None:
+            return
+        routing_key = queue.arguments.get("x-dead-letter-routing-key", message.routing_key)
+        for target in self.route(exchange, routing_key):
+            self.enqueue(target, _Message(exchange, routing_key, message.properties, message.body,
+                                          message.published_at))
+
+    def start_expiry(self):
+        """
+        Starts the background thread expiring messages, in case not running yet.
+        :return:
+        """
+        if self.expiry_thread is None:
+            self.expiry_thread = threading.Thread(target=self.expire, name="pipeforce-broker-expiry", daemon=True)
+            self.expiry_thread.start()
+        self.expiry_ready.notify()
+
+    def expire(self):
+        """
+        Dead-letters messages once their TTL has passed, until the broker is closed.
+        :return:
+        """
+        with self.lock:
+            while not self.closed:
+                if not self.expiring:
+                    self.expiry_ready.wait()
+                    continue
+
+                expires_at, _, queue, message = self.expiring[0]
+                remaining = expires_at - time.monotonic()
+                if remaining > 0:
+                    self.expiry_ready.wait(remaining)
+                    continue
+
+                heapq.heappop(self.expiring)
+                if message in queue.messages:
+                    queue.messages.remove(message)
+                    self.dead_letter(queue, message)
+
+    def remove_connection(self, connection):
+        """
+        Cancels the consumers of the closed connection, requeues its unacknowledged messages
+        and deletes its exclusive queues.
+        :param connection:
+        :return:
+        """
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+            for channel in connection.channels:
+                channel.release()
+            for name in [name for name, queue in self.queues.items() if queue.owner is connection]:
+                self.delete_queue(name)
+
+
+class MemoryConnection:
+    """
+        Connection to the InMemoryBroker with the API of pika.BlockingConnection used by the clients.
+    """
+
+    def __init__(self, broker: InMemoryBroker):
+        """
+        :param broker:
+        """
+        self.broker = broker
+        self.events = queues.SimpleQueue()
+        self.timers = []
+        self.sequence = itertools.count()
+        self.channels = []
+        self.error = None
+        self._open = True
+
+    @property
+    def is_open(self) -> bool:
+        """
+        Returns true until the connection was closed.
+        :return:
+        """
+        return self._open
+
+    @property
+    def is_closed(self) -> bool:
+        """
+        Returns true once the connection was closed.
+        :return:
+        """
+        return not self._open
+
+    def channel(self) -> "MemoryChannel":
+        """
+        Opens a new channel.
+        :return:
+        """
+        self.check_open()
+        channel = MemoryChannel(self, len(self.channels) + 1)
+        self.channels.append(channel)
+        return channel
+
+    def check_open(self):
+        """
+        Raises the error the connection was closed with, in case it is closed.
+        :return:
+        """
+        if not self._open:
+            raise self.error or pika.exceptions.ConnectionWrongStateError("Connection is closed")
+
+    def call_later(self, delay, callback):
+        """
+        Calls the function on the connection thread after the given seconds.
+        :param delay:
+        :param callback:
+        :return:
+        """
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self.sequence), callback))
+
+    def add_callback_threadsafe(self, callback):
+        """
+        Calls the function on the connection thread. Can be called from any thread.
+        :param callback:
+        :return:
+        """
+        self.check_open()
+        self.events.put(callback)
+
+    def process_data_events(self, time_limit=0):
+        """
+        Runs the pending deliveries, timers and callbacks. With a time limit of 0, only the ones pending already
+        are run, otherwise new ones are run until the time limit has passed.
+        :param time_limit: Seconds.
+        :return:
+        """
+        self.check_open()
+        if not time_limit:
+            self.run_timers()
+            for _ in range(self.events.qsize()):
+                self.events.get_nowait()()
+            return
+
+        deadline = time.monotonic() + time_limit
+        self.run_until(lambda: time.monotonic() >= deadline)
+
+    def run_until(self, done):
+        """
+        Runs deliveries, timers and callbacks on the calling thread until the given function returns true.
+        :param done:
+        :return:
+        """
+        while not done():
+            self.check_open()
+            self.run_timers()
+            timeout = POLL_INTERVAL
+            if self.timers:
+                timeout = max(0, min(timeout, self.timers[0][0] - time.monotonic()))
+            try:
+                callback = self.events.get(timeout=timeout)
+            except queues.Empty:
+                continue
+            callback()
+        self.check_open()
+
+    def run_timers(self):
+        """
+        Runs the timers which are due.
+        :return:
+        """
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, callback = heapq.heappop(self.timers)
+            callback()
+
+    def close(self):
+        """
+        Closes the connection. Unacknowledged messages are requeued.
+        :return:
+        """
+        self.check_open()
+        self._open = False
+        self.broker.remove_connection(self)
+
+    def close_by_broker(self, error: Exception):
+        """
+        Closes the connection from the broker side. The connection thread raises the error.
+        :param error:
+        :return:
+        """
+        if not self._open:
+            return
+        self.error = error
+        self._open = False
+        self.broker.remove_connection(self)
+        # Wakes up the connection thread
+        self.events.put(lambda: None)
+
+
+class MemoryChannel:  # pylint: disable=too-many-instance-attributes
+    """
+        Channel of a MemoryConnection with the API of pika.adapters.blocking_connection.BlockingChannel
+        used by the clients.
+    """
+
+    def __init__(self, connection: MemoryConnection, channel_number: int):
+        """
+        :param connection:
+        :param channel_number:
+        """
+        self.connection = connection
+        self.broker = connection.broker
+        self.channel_number = channel_number
+        self.prefetch_count = 0
+        self.delivery_tag = 0
+        self.unacked = {}
+        self.consumers = {}
+        self.consuming = False
+        self.is_open = True
+
+    def check_open(self):
+        """
+        Fails in case the channel or its connection is closed.
+        :return:
+        """
+        self.connection.check_open()
+        if not self.is_open:
+            raise pika.exceptions.ChannelWrongStateError("Channel is closed.")
+
+    def exchange_declare(self, exchange, exchange_type="direct", **kwargs):  # pylint: disable=unused-argument
+        """
+        Declares the exchange.
+        :param exchange:
+        :param exchange_type:
+        :param kwargs: Further arguments of pika, which are ignored.
+        :return:
+        """
+        self.check_open()
+        self.broker.declare_exchange(exchange, exchange_type)
+
+    def queue_declare(self, queue="", exclusive=False, auto_delete=False, arguments=None, **kwargs):  # pylint: disable=unused-argument,too-many-arguments
+        """
+        Declares the queue. An empty name creates a queue with a generated name.
+        :param queue:
+        :param exclusive: Delete the queue once this connection is closed.
+        :param auto_delete: Delete the queue once its last consumer was cancelled.
+        :param arguments: The queue arguments, such as x-message-ttl and x-dead-letter-exchange.
+        :param kwargs: Further arguments of pika, which are ignored.
+        :return: The method frame with the name of the queue.
+        """
+        self.check_open()
+        name = queue or f"amq.gen-{next(self.broker.sequence)}"
+        declared = self.broker.declare_queue(name, arguments, auto_delete, self.connection if exclusive else None)
+        return Method(self.channel_number, Queue.DeclareOk(queue=name, message_count=len(declared.messages),
+                                                           consumer_count=len(declared.consumers)))
+
+    def queue_bind(self, queue, exchange, routing_key=None, arguments=None):  # pylint: disable=unused-argument
+        """
+        Binds the queue to the exchange.
+        :param queue:
+        :param exchange:
+        :param routing_key: Defaults to the queue name.
+        :param arguments:
+        :return:
+        """
+        self.check_open()
+        self.broker.bind(exchange, queue, queue if routing_key is None else routing_key)
+
+    def queue_unbind(self, queue, exchange=None, routing_key=None, arguments=None):  # pylint: disable=unused-argument
+        """
+        Removes the binding of the queue to the exchange.
+        :param queue:
+        :param exchange:
+        :param routing_key: Defaults to the queue name.
+        :param arguments:
+        :return:
+        """
+        self.check_open()
+        self.broker.unbind(exchange, queue, queue if routing_key is None else routing_key)
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, global_qos=False):  # pylint: disable=unused-argument
+        """
+        Sets the max unacked messages of the consumers started afterwards on this channel.
+        :param prefetch_size:
+        :param prefetch_count: 0 for unlimited.
+        :param global_qos:
+        :return:
+        """
+        self.check_open()
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False, exclusive=False,  # pylint: disable=unused-argument,too-many-arguments
+                      consumer_tag=None, arguments=None):
+        """
+        Starts a consumer of the queue.
+        :param queue:
+        :param on_message_callback: Called on the connection thread with channel, method, properties and body.
+        :param auto_ack:
+        :param exclusive:
+        :param consumer_tag: Defaults to a generated tag.
+        :param arguments: The consumer arguments, such as x-priority.
+        :return: The consumer tag.
+        """
+        self.check_open()
+        with self.broker.lock:
+            if queue not in self.broker.queues:
+                raise pika.exceptions.ChannelClosedByBroker(404, f"NOT_FOUND - no queue '{queue}'")
+            consumer_tag = consumer_tag or f"ctag{self.channel_number}.{next(self.broker.sequence)}"
+            declared = self.broker.queues[queue]
+            consumer = _Consumer(consumer_tag, self, declared, on_message_callback, auto_ack, arguments)
+            self.consumers[consumer_tag] = consumer
+            declared.consumers.append(consumer)
+            self.broker.deliver(declared)
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag):
+        """
+        Cancels the consumer. Its unacknowledged messages can still be acknowledged.
+        :param consumer_tag:
+        :return:
+        """
+        with self.broker.lock:
+            consumer = self.consumers.pop(consumer_tag, None)
+            if consumer is None:
+                return
+            consumer.queue.consumers.remove(consumer)
+            if consumer.queue.auto_delete and not consumer.queue.consumers:
+                self.broker.delete_queue(consumer.queue.name)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):  # pylint: disable=unused-argument,too-many-arguments
+        """
+        Publishes the message.
+        :param exchange:
+        :param routing_key:
+        :param body:
+        :param properties:
+        :param mandatory:
+        :return:
+        """
+        self.check_open()
+        self.broker.publish(exchange, routing_key, properties, body)
+
+    def deliver(self, consumer: _Consumer, message: _Message):
+        """
+        Hands the message over to the connection thread of the consumer. Called while holding the broker lock.
+        :param consumer:
+        :param message:
+        :return:
+        """
+        self.delivery_tag += 1
+        method = Basic.Deliver(consumer_tag=consumer.tag, delivery_tag=self.delivery_tag,
+                               redelivered=message.redelivered, exchange=message.exchange,
+                               routing_key=message.routing_key)
+        if consumer.auto_ack:
+            self.broker.settle(consumer.queue, message, acked=True, requeue=False)
+        else:
+            self.unacked[self.delivery_tag] = (consumer, message)
+            consumer.unacked += 1
+        self.connection.events.put(partial(consumer.callback, self, method, message.properties, message.body))
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        """
+        Acknowledges the message.
+        :param delivery_tag:
+        :param multiple: Acknowledge all messages up to the delivery tag.
+        :return:
+        """
+        self.settle(delivery_tag, multiple, acked=True, requeue=False)
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        """
+        Rejects the message.
+        :param delivery_tag:
+        :param multiple: Reject all messages up to the delivery tag.
+        :param requeue: Requeue the message, otherwise it is dead-lettered or dropped.
+        :return:
+        """
+        self.settle(delivery_tag, multiple, acked=False, requeue=requeue)
+
+    def basic_reject(self, delivery_tag=0, requeue=True):
+        """
+        Rejects the message.
+        :param delivery_tag:
+        :param requeue: Requeue the message, otherwise it is dead-lettered or dropped.
+        :return:
+        """
+        self.settle(delivery_tag, False, acked=False, requeue=requeue)
+
+    def settle(self, delivery_tag, multiple, acked, requeue):
+        """
+        Settles the unacknowledged messages with the given delivery tag or up to it.
+        :param delivery_tag:
+        :param multiple:
+        :param acked:
+        :param requeue:
+        :return:
+        """
+        self.check_open()
+        with self.broker.lock:
+            if multiple:
+                tags = [tag for tag in self.unacked if tag <= delivery_tag]
+            elif delivery_tag in self.unacked:
+                tags = [delivery_tag]
+            else:
+                raise pika.exceptions.ChannelClosedByBroker(
+                    406, f"PRECONDITION_FAILED - unknown delivery tag {delivery_tag}")
+
+            queues_to_deliver = {}
+            for tag in tags:
+                consumer, message = self.unacked.pop(tag)
+                consumer.unacked -= 1
+                self.broker.settle(consumer.queue, message, acked, requeue)
+                queues_to_deliver[consumer.queue.name] = consumer.queue
+            for queue in queues_to_deliver.values():
+                self.broker.deliver(queue)
+
+    def start_consuming(self):
+        """
+        Runs deliveries, timers and callbacks of the connection until stop_consuming was called
+        or the connection was closed.
+        :return:
+        """
+        self.check_open()
+        self.consuming = True
+        self.connection.run_until(lambda: not self.consuming or not self.connection.is_open)
+
+    def stop_consuming(self):
+        """
+        Cancels all consumers of the channel and makes start_consuming return.
+        :return:
+        """
+        for consumer_tag in list(self.consumers):
+            self.basic_cancel(consumer_tag)
+        self.consuming = False
+
+    def close(self):
+        """
+        Closes the channel. Unacknowledged messages are requeued.
+        :return:
+        """
+        self.check_open()
+        with self.broker.lock:
+            self.release()
+
+    def release(self):
+        """
+        Cancels the consumers and requeues the unacknowledged messages of the closed channel.
+        Called while holding the broker lock.
+        :return:
+        """
+        self.is_open = False
+        for consumer_tag in list(self.consumers):
+            self.basic_cancel(consumer_tag)
+
+        unacked = list(self.unacked.values())
+        self.unacked.clear()
+        for consumer, message in reversed(unacked):
+            if self.broker.queues.get(consumer.queue.name) is consumer.queue:
+                self.broker.settle(consumer.queue, message, acked=False, requeue=True)
+                self.broker.deliver(consumer.queue)
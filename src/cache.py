@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from json import dumps
+
+
+class CommandCache:
+    """
+        Caches the results of idempotent hub commands by command name and params for a limited time.
+        The least recently used results are evicted as soon as more than max_size results are cached.
+        Concurrent misses of the same command and params are coalesced into a single call to the hub (single-flight).
+        Errors are never cached. Cached results are shared between all callers, so they must not be modified.
+    """
+
+    def __init__(self, ttl: float, max_size: int, metrics=None):
+        """
+        :param ttl: Seconds a result is valid.
+        :param max_size: Max number of cached results.
+        :param metrics: Optional Metrics to count hits and misses.
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.loading = {}
+
+    @staticmethod
+    def key(name, params) -> tuple:
+        """
+        Returns the cache key of the command, which is the same for params differing in key order only.
+        :param name:
+        :param params:
+        :return:
+        """
+        return name, dumps(params, sort_keys=True, separators=(",", ":"), default=str)
+
+    def get(self, name, params, load):
+        """
+        Returns the cached result of the command or loads and caches it.
+        :param name: The name of the command.
+        :param params: The params of the command.
+        :param load: Function without arguments which executes the command in case of a miss.
+        :return:
+        """
+        key = self.key(name, params)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.count("pipeforce_hub_cache_hits_total", name)
+                return entry[1]
+
+            future = self.loading.get(key)
+            loader = future is None
+            if loader:
+                future = self.loading[key] = Future()
+
+        if not loader:
+            self.count("pipeforce_hub_cache_coalesced_total", name)
+            return future.result()
+
+        self.count("pipeforce_hub_cache_misses_total", name)
+        try:
+            value = load()
+        except BaseException as error:
+            with self.lock:
+                del self.loading[key]
+            future.set_exception(error)
+            raise
+
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            del self.loading[key]
+
+        future.set_result(value)
+        return value
+
+    def invalidate(self, name=None):
+        """
+        Removes the cached results of the given command or all cached results.
+        :param name: The name of the command. None removes all.
+        :return:
+        """
+        with self.lock:
+            if name is None:
+                self.entries.clear()
+            else:
+                for key in [key for key in self.entries if key[0] == name]:
+                    del self.entries[key]
+
+    def count(self, metric, name):
+        """
+        Increments the counter of the given metric for the command.
+        :param metric:
+        :param name:
+        :return:
+        """
+        if self.metrics is not None:
+            self.metrics.inc(metric, (("command", name),))
@@ -0,0 +1,47 @@
+"""
+    Helpers shared by the clients which hand work to the connection thread of pika and wait for its results.
+"""
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import partial
+
+
+def call_threadsafe(connection, func, *args, **kwargs):
+    """
+    Calls the function on the thread of the connection, since pika channels are not thread-safe.
+    Can be called from any thread.
+    :param connection: The pika connection.
+    :param func:
+    :param args:
+    :param kwargs:
+    :return:
+    :raises pika.exceptions.AMQPError: In case the connection was closed already.
+    """
+    connection.add_callback_threadsafe(partial(func, *args, **kwargs))
+
+
+def wait_for_result(future, timeout, description):
+    """
+    Waits for the result of the future.
+    :param future:
+    :param timeout: Max seconds to wait.
+    :param description: What is waited for, used in the error message.
+    :return: The result of the future.
+    :raises TimeoutError: In case the future has not completed in time.
+    """
+    try:
+        return future.result(timeout)
+    except FutureTimeoutError as error:
+        raise TimeoutError(f"No {description} within {timeout} seconds") from error
+
+
+def wait_for_error(future, timeout) -> Exception:
+    """
+    Waits until the future has completed.
+    :param future:
+    :param timeout: Max seconds to wait.
+    :return: None in case it succeeded, otherwise its error or the TimeoutError in case it has not completed in time.
+    """
+    try:
+        return future.exception(timeout)
+    except FutureTimeoutError as error:
+        return error
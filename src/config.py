@@ -19,6 +19,39 @@ class Config:
     # Can be Apitoken <token> or Basic <username:password>
     PIPEFORCE_SECRET = os.getenv("PIPEFORCE_SECRET")
 
+    # Seconds before expiry the access token gets refreshed, in background if enabled.
+    # Failed background refreshes are retried after PIPEFORCE_TOKEN_REFRESH_RETRY seconds.
+    PIPEFORCE_TOKEN_REFRESH_MARGIN = float(os.getenv("PIPEFORCE_TOKEN_REFRESH_MARGIN", "30"))
+    PIPEFORCE_TOKEN_REFRESH_RETRY = float(os.getenv("PIPEFORCE_TOKEN_REFRESH_RETRY", "5"))
+    PIPEFORCE_TOKEN_BACKGROUND_REFRESH = os.getenv("PIPEFORCE_TOKEN_BACKGROUND_REFRESH", "true").lower() == "true"
+
+    # HTTP settings to call the hub
+    PIPEFORCE_HUB_POOL_SIZE = int(os.getenv("PIPEFORCE_HUB_POOL_SIZE", "10"))
+    PIPEFORCE_HUB_CONNECT_TIMEOUT = float(os.getenv("PIPEFORCE_HUB_CONNECT_TIMEOUT", "5"))
+    PIPEFORCE_HUB_READ_TIMEOUT = float(os.getenv("PIPEFORCE_HUB_READ_TIMEOUT", "60"))
+    PIPEFORCE_HUB_RETRIES = int(os.getenv("PIPEFORCE_HUB_RETRIES", "3"))
+    PIPEFORCE_HUB_RETRY_BACKOFF = float(os.getenv("PIPEFORCE_HUB_RETRY_BACKOFF", "0.5"))
+
+    # Max number of commands executed concurrently by run_commands. Should not exceed PIPEFORCE_HUB_POOL_SIZE.
+    PIPEFORCE_HUB_MAX_CONCURRENCY = int(os.getenv("PIPEFORCE_HUB_MAX_CONCURRENCY", "10"))
+
+    # Comma separated status codes to retry requests on. 500 is not retried since the hub might have
+    # processed the request already.
+    PIPEFORCE_HUB_RETRY_STATUS = os.getenv("PIPEFORCE_HUB_RETRY_STATUS", "502,503,504")
+
+    # POST requests like run_pipeline and run_command are retried on connection errors only by default, since they
+    # are not idempotent. Set to true to retry them on 503 as well, which the hub answers before processing them.
+    PIPEFORCE_HUB_RETRY_POST = os.getenv("PIPEFORCE_HUB_RETRY_POST", "false").lower() == "true"
+
+    # Max bytes per chunk returned by run_pipeline_stream and run_command_stream
+    PIPEFORCE_HUB_STREAM_CHUNK_SIZE = int(os.getenv("PIPEFORCE_HUB_STREAM_CHUNK_SIZE", "65536"))
+
+    # Comma separated names of read-only commands whose results run_command caches for PIPEFORCE_HUB_CACHE_TTL seconds.
+    # Up to PIPEFORCE_HUB_CACHE_SIZE results are cached, the least recently used are evicted first.
+    PIPEFORCE_HUB_CACHE_COMMANDS = os.getenv("PIPEFORCE_HUB_CACHE_COMMANDS", "")
+    PIPEFORCE_HUB_CACHE_TTL = float(os.getenv("PIPEFORCE_HUB_CACHE_TTL", "60"))
+    PIPEFORCE_HUB_CACHE_SIZE = int(os.getenv("PIPEFORCE_HUB_CACHE_SIZE", "1000"))
+
     # Messaging settings
     PIPEFORCE_MESSAGING_HOST = os.getenv("PIPEFORCE_MESSAGING_HOST", "host.docker.internal")
     PIPEFORCE_MESSAGING_PORT = os.getenv("PIPEFORCE_MESSAGING_PORT", "5672")
@@ -26,9 +59,102 @@ class Config:
     PIPEFORCE_MESSAGING_USERNAME = os.getenv("PIPEFORCE_MESSAGING_USERNAME", "guest")
     PIPEFORCE_MESSAGING_PASSWORD = os.getenv("PIPEFORCE_MESSAGING_PASSWORD", "guest")
     PIPEFORCE_MESSAGING_DEFAULT_TOPIC = "pipeforce.topic.default"
-    PIPEFORCE_MESSAGING_DEFAULT_DLQ = "pipeforce_default_dlq"
+    PIPEFORCE_MESSAGING_DEFAULT_DLQ = os.getenv("PIPEFORCE_MESSAGING_DEFAULT_DLQ", "pipeforce_default_dlq")
     PIPEFORCE_MESSAGING_QUEUE = "pipeforce.service." + str(PIPEFORCE_SERVICE)
 
+    # Content type of incoming messages without content_type property, used to decode them for service methods
+    PIPEFORCE_MESSAGING_CONTENT_TYPE = os.getenv("PIPEFORCE_MESSAGING_CONTENT_TYPE", "application/json")
+
+    # Max number of unacked messages the broker delivers to this service at once. 0 means unlimited.
+    PIPEFORCE_MESSAGING_PREFETCH_COUNT = int(os.getenv("PIPEFORCE_MESSAGING_PREFETCH_COUNT", "20"))
+
+    # Messages whose service methods failed are retried after PIPEFORCE_MESSAGING_RETRY_DELAY seconds, doubling per
+    # attempt up to PIPEFORCE_MESSAGING_RETRY_MAX_DELAY seconds. After PIPEFORCE_MESSAGING_MAX_ATTEMPTS deliveries,
+    # they are moved to PIPEFORCE_MESSAGING_DEFAULT_DLQ. Set PIPEFORCE_MESSAGING_MAX_ATTEMPTS to 1 to never retry.
+    PIPEFORCE_MESSAGING_MAX_ATTEMPTS = int(os.getenv("PIPEFORCE_MESSAGING_MAX_ATTEMPTS", "5"))
+    PIPEFORCE_MESSAGING_RETRY_DELAY = float(os.getenv("PIPEFORCE_MESSAGING_RETRY_DELAY", "5"))
+    PIPEFORCE_MESSAGING_RETRY_MAX_DELAY = float(os.getenv("PIPEFORCE_MESSAGING_RETRY_MAX_DELAY", "300"))
+
+    # Skips redelivered duplicates of processed messages. PIPEFORCE_MESSAGING_DEDUP is empty (disabled), message_id
+    # (identified by their message_id property) or body (identified by routing key and the hash of their body using
+    # PIPEFORCE_MESSAGING_DEDUP_HASH). Messages are remembered for PIPEFORCE_MESSAGING_DEDUP_WINDOW seconds, at most
+    # PIPEFORCE_MESSAGING_DEDUP_SIZE of them. PIPEFORCE_MESSAGING_DEDUP_STORE is the module.Class of the store.
+    PIPEFORCE_MESSAGING_DEDUP = os.getenv("PIPEFORCE_MESSAGING_DEDUP", "")
+    PIPEFORCE_MESSAGING_DEDUP_HASH = os.getenv("PIPEFORCE_MESSAGING_DEDUP_HASH", "blake2b")
+    PIPEFORCE_MESSAGING_DEDUP_WINDOW = float(os.getenv("PIPEFORCE_MESSAGING_DEDUP_WINDOW", "600"))
+    PIPEFORCE_MESSAGING_DEDUP_SIZE = int(os.getenv("PIPEFORCE_MESSAGING_DEDUP_SIZE", "100000"))
+    PIPEFORCE_MESSAGING_DEDUP_STORE = os.getenv("PIPEFORCE_MESSAGING_DEDUP_STORE",
+                                                "src.idempotency.MemoryIdempotencyStore")
+
+    # Max message priority supported by the lane queues of service methods with priority or concurrency.
+    # Messages sent with a higher priority property are delivered first within a lane. 0 disables message priorities.
+    PIPEFORCE_MESSAGING_MAX_PRIORITY = int(os.getenv("PIPEFORCE_MESSAGING_MAX_PRIORITY", "10"))
+
+    # Number of workers to execute service methods in parallel. 0 executes them on the connection thread,
+    # unless there are lanes, then one worker is used. Lanes without concurrency get a worker pool of this size
+    # of their own, at least one worker.
+    PIPEFORCE_MESSAGING_WORKERS = int(os.getenv("PIPEFORCE_MESSAGING_WORKERS", "0"))
+
+    # The type of the workers: thread (for I/O bound service methods) or process (for CPU bound service methods)
+    PIPEFORCE_MESSAGING_WORKER_TYPE = os.getenv("PIPEFORCE_MESSAGING_WORKER_TYPE", "thread")
+
+    # Number of consumer processes started by service.py, each with its own connection and prefetch count.
+    # Crashed processes are restarted after PIPEFORCE_MESSAGING_RESTART_DELAY seconds. On SIGTERM, the messages
+    # in-flight are processed before exiting. Processes still running after PIPEFORCE_MESSAGING_DRAIN_TIMEOUT
+    # seconds are killed.
+    PIPEFORCE_MESSAGING_PROCESSES = int(os.getenv("PIPEFORCE_MESSAGING_PROCESSES", "1"))
+    PIPEFORCE_MESSAGING_RESTART_DELAY = float(os.getenv("PIPEFORCE_MESSAGING_RESTART_DELAY", "1"))
+    PIPEFORCE_MESSAGING_DRAIN_TIMEOUT = float(os.getenv("PIPEFORCE_MESSAGING_DRAIN_TIMEOUT", "30"))
+
+    # Reconnecting after the connection to the message broker was lost: The delay starts at
+    # PIPEFORCE_MESSAGING_RECONNECT_DELAY seconds and doubles per failed attempt up to
+    # PIPEFORCE_MESSAGING_RECONNECT_MAX_DELAY seconds. PIPEFORCE_MESSAGING_RECONNECT_ATTEMPTS failed attempts in a row
+    # stop the client, 0 retries forever.
+    PIPEFORCE_MESSAGING_RECONNECT_DELAY = float(os.getenv("PIPEFORCE_MESSAGING_RECONNECT_DELAY", "1"))
+    PIPEFORCE_MESSAGING_RECONNECT_MAX_DELAY = float(os.getenv("PIPEFORCE_MESSAGING_RECONNECT_MAX_DELAY", "30"))
+    PIPEFORCE_MESSAGING_RECONNECT_ATTEMPTS = int(os.getenv("PIPEFORCE_MESSAGING_RECONNECT_ATTEMPTS", "0"))
+
+    # Seconds between heartbeats to detect dead connections. Seconds the broker may block publishing
+    # (for example on low memory) before the connection is considered lost, 0 waits forever.
+    PIPEFORCE_MESSAGING_HEARTBEAT = int(os.getenv("PIPEFORCE_MESSAGING_HEARTBEAT", "30"))
+    PIPEFORCE_MESSAGING_BLOCKED_TIMEOUT = float(os.getenv("PIPEFORCE_MESSAGING_BLOCKED_TIMEOUT", "300"))
+
+    # Max messages sent by message_send which are buffered while the connection is lost.
+    # In case the buffer is full, message_send raises a PublishError.
+    PIPEFORCE_MESSAGING_OUTAGE_BUFFER_SIZE = int(os.getenv("PIPEFORCE_MESSAGING_OUTAGE_BUFFER_SIZE", "10000"))
+
+    # Default max seconds message_send_and_wait waits for the response
+    PIPEFORCE_MESSAGING_REPLY_TIMEOUT = float(os.getenv("PIPEFORCE_MESSAGING_REPLY_TIMEOUT", "30"))
+
+    # Batch publishing: Max messages per batch, max seconds to wait before a batch is published and
+    # max messages waiting for publisher confirms before sending blocks
+    PIPEFORCE_MESSAGING_BATCH_SIZE = int(os.getenv("PIPEFORCE_MESSAGING_BATCH_SIZE", "500"))
+    PIPEFORCE_MESSAGING_BATCH_INTERVAL = float(os.getenv("PIPEFORCE_MESSAGING_BATCH_INTERVAL", "0.05"))
+    PIPEFORCE_MESSAGING_BATCH_MAX_PENDING = int(os.getenv("PIPEFORCE_MESSAGING_BATCH_MAX_PENDING", "10000"))
+
+    # If true, consumes messages on an asyncio event loop using AsyncPipeforceClient
+    PIPEFORCE_MESSAGING_ASYNC = os.getenv("PIPEFORCE_MESSAGING_ASYNC", "false").lower() == "true"
+
+    # Max number of messages processed concurrently by AsyncPipeforceClient
+    PIPEFORCE_MESSAGING_MAX_CONCURRENCY = int(os.getenv("PIPEFORCE_MESSAGING_MAX_CONCURRENCY", "10"))
+
+    # Path to an event manifest created by python -m src.manifest. If the file exists, event mappings are read
+    # from it and service modules are imported on their first message instead of at startup.
+    PIPEFORCE_EVENT_MANIFEST = os.getenv("PIPEFORCE_EVENT_MANIFEST", "")
+
+    # Max number of routing keys to cache the matching service mappings for
+    PIPEFORCE_ROUTING_CACHE_SIZE = int(os.getenv("PIPEFORCE_ROUTING_CACHE_SIZE", "10000"))
+
+    # Logging settings. PIPEFORCE_LOG_FORMAT is either json (one JSON object per line) or text.
+    PIPEFORCE_LOG_LEVEL = os.getenv("PIPEFORCE_LOG_LEVEL", "INFO")
+    PIPEFORCE_LOG_FORMAT = os.getenv("PIPEFORCE_LOG_FORMAT", "json")
+
+    # Metrics settings. Set PIPEFORCE_METRICS_PORT to expose /metrics and /profile via HTTP.
+    # PIPEFORCE_METRICS_PROFILE_SAMPLE_RATE is the fraction (0 to 1) of service method calls to profile.
+    PIPEFORCE_METRICS_ENABLED = os.getenv("PIPEFORCE_METRICS_ENABLED", "true").lower() == "true"
+    PIPEFORCE_METRICS_PORT = int(os.getenv("PIPEFORCE_METRICS_PORT", "0"))
+    PIPEFORCE_METRICS_PROFILE_SAMPLE_RATE = float(os.getenv("PIPEFORCE_METRICS_PROFILE_SAMPLE_RATE", "0"))
+
     # Internal microservice hosts
     PIPEFORCE_SVC_PREFIX = "." + str(PIPEFORCE_NAMESPACE) + ".svc.cluster.local"
     PIPEFORCE_SVC_HOST_HUB = "hub" + str(PIPEFORCE_SVC_PREFIX)
@@ -0,0 +1,180 @@
+import json
+import os
+import pkgutil
+import sys
+from importlib import import_module
+
+from src.logs import get_logger
+
+logger = get_logger("events")
+
+# The folder of the service package. Service modules are imported relative to it, like when running src/service.py.
+SERVICE_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Event mappings registered by the @event decorator as (key, "module.Class#method") tuples in import order
+_event_registry = []
+
+# Lane options of the service methods registered with priority, concurrency or as batch by "module.Class#method"
+_lane_registry = {}
+
+
+def event(*keys, priority: int = 0, concurrency: int = 0):
+    """
+    The @event decorator. Maps the decorated service method to the given routing keys.
+    Multiple keys can be given at once or by stacking the decorator:
+
+        @event("some.event.key.*", "other.event.key.#")
+        def my_service_action(self, body):
+            pass
+
+    Service methods with a priority or concurrency get their own lane, so a flood of other messages does not
+    delay them. See Lane for details:
+
+        @event("pipeforce.order.created", priority=9, concurrency=4)
+        def on_order(self, body):
+            pass
+
+    :param keys: The routing keys. Wildcards * and # are supported.
+    :param priority: The consumer priority of the lane from 0 to 9. Each priority gets a lane of its own.
+    :param concurrency: Max messages processed in parallel by the lane. 0 uses PIPEFORCE_MESSAGING_WORKERS workers
+        of its own, at least one.
+    :return:
+    """
+
+    options = {"priority": priority, "concurrency": concurrency} if priority or concurrency else None
+    return _register(keys, options)
+
+
+def batch_event(*keys, max_size: int = 100, max_wait: float = 1.0, priority: int = 0, concurrency: int = 0):
+    """
+    The @batch_event decorator. Maps the decorated service method to the given routing keys like @event,
+    but the service method gets the bodies of up to max_size messages at once as list:
+
+        @batch_event("pipeforce.webhook.#", max_size=100, max_wait=0.5)
+        def on_webhooks(self, bodies: list[dict]):
+            pass
+
+    The items of the list are converted into the type given by the annotation list[T], see payload_converter.
+    A batch is passed as soon as max_size messages have arrived or max_wait seconds after its first message.
+    All messages of the batch are acknowledged once the service method has returned, or retried in case it raised
+    an exception. To retry single messages only, return a list with one entry per body: An exception or False marks
+    the message as failed. The service method gets its own lane, see Lane and BatchLane.
+
+    :param keys: The routing keys. Wildcards * and # are supported.
+    :param max_size: Max messages per batch.
+    :param max_wait: Max seconds to wait for more messages before passing a batch.
+    :param priority: The consumer priority of the lane from 0 to 9. Each priority gets a lane of its own.
+    :param concurrency: Max batches processed in parallel by own workers. 0 uses PIPEFORCE_MESSAGING_WORKERS workers
+        of its own, at least one.
+    :return:
+    """
+    if max_size < 1:
+        raise ValueError("max_size of @batch_event must be at least 1")
+
+    return _register(keys, {"priority": priority, "concurrency": concurrency, "max_size": max_size,
+                            "max_wait": max_wait})
+
+
+def _register(keys, options):
+    """
+    Returns the decorator registering the service method for the given routing keys and lane options.
+    :param keys:
+    :param options: The lane options or None.
+    :return:
+    """
+
+    def decorator(func):
+        class_name, method_name = func.__qualname__.rsplit(".", 1)
+        value = func.__module__ + "." + class_name + "#" + method_name
+
+        for key in keys:
+            if (key, value) not in _event_registry:
+                _event_registry.append((key, value))
+
+        if options:
+            _lane_registry[value] = options
+
+        # Return the function itself, so async def service methods can still be detected as coroutine functions
+        return func
+
+    return decorator
+
+
+def find_event_mappings(package="service") -> list:
+    """
+    Imports all modules of the given service package and returns the mappings registered by their @event decorators.
+    The package is imported by its name relative to the src folder, independent of the working directory.
+    :param package: The name of the service package.
+    :return: List of (key, "module.Class#method") tuples in the order of registration.
+    """
+    if SERVICE_ROOT not in sys.path:
+        sys.path.append(SERVICE_ROOT)
+
+    try:
+        package_path = import_module(package).__path__
+    except ModuleNotFoundError as error:
+        if error.name != package.split(".", 1)[0]:
+            raise
+        logger.warning("Service package %s not found, no service methods registered from it", package)
+        return list(_event_registry)
+
+    for _, service_module, _ in pkgutil.iter_modules(package_path):
+        import_module(package + "." + service_module)
+
+    return list(_event_registry)
+
+
+def find_event_lanes() -> dict:
+    """
+    Returns the lane options registered by the @event and @batch_event decorators. Call find_event_mappings before.
+    :return: Dict of {"priority": int, "concurrency": int} by "module.Class#method",
+        with max_size and max_wait for batch service methods.
+    """
+    return dict(_lane_registry)
+
+
+def write_event_manifest(path, package="service"):
+    """
+    Writes the event mappings of all service modules to the given manifest file.
+    Create it at build time and set PIPEFORCE_EVENT_MANIFEST, so the service can start without importing
+    all service modules upfront.
+    :param path:
+    :param package: The name of the service package.
+    :return:
+    """
+    mappings = [{"key": key, "handler": value, **_lane_registry.get(value, {})}
+                for key, value in find_event_mappings(package)]
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump({"mappings": mappings}, file, indent=2)
+
+
+def read_event_manifest(path) -> list:
+    """
+    Reads the event mappings from the given manifest file.
+    :param path:
+    :return: List of (key, "module.Class#method") tuples.
+    """
+    with open(path, encoding="utf-8") as file:
+        manifest = json.load(file)
+
+    return [(mapping["key"], mapping["handler"]) for mapping in manifest["mappings"]]
+
+
+def read_event_lanes(path) -> dict:
+    """
+    Reads the lane options of the service methods from the given manifest file.
+    :param path:
+    :return: Dict of {"priority": int, "concurrency": int} by "module.Class#method",
+        with max_size and max_wait for batch service methods.
+    """
+    with open(path, encoding="utf-8") as file:
+        manifest = json.load(file)
+
+    options = {}
+    for mapping in manifest["mappings"]:
+        if mapping.get("priority") or mapping.get("concurrency") or mapping.get("max_size"):
+            option = {"priority": mapping.get("priority", 0), "concurrency": mapping.get("concurrency", 0)}
+            if mapping.get("max_size"):
+                option.update(max_size=mapping["max_size"], max_wait=mapping.get("max_wait", 1.0))
+            options[mapping["handler"]] = option
+    return options
@@ -0,0 +1,71 @@
+# pylint: disable=E0401
+import inspect
+from importlib import import_module
+
+from src.payloads import payload_converter
+
+
+class HandlerMixin:
+    """
+        Resolves the mapping values of the form module.Class#method to the service methods of PipeforceClient.
+        Expects the client to provide mappings, handlers, payload_converters, service_instances and handlers_lock.
+    """
+
+    def resolve_handlers(self):
+        """
+        Resolves all mapped service methods to callables upfront, so no imports or
+        instantiations are required while dispatching messages.
+        :return:
+        """
+        for _, value in self.mappings:
+            self.resolve_handler(value)
+
+    def resolve_handler(self, value: str):
+        """
+        Returns the callable for the given mapping value in the form module.Class#method.
+        Service instances are created once and shared between all messages, except the service
+        class sets instance_per_message = True. In this case a fresh instance is created for each message.
+        :param value:
+        :return:
+        """
+        handler = self.handlers.get(value)
+        if handler:
+            return handler
+
+        with self.handlers_lock:
+            handler = self.handlers.get(value)
+            if handler:
+                return handler
+
+            clazz, method_name = self.resolve_class(value)
+
+            if getattr(clazz, "instance_per_message", False):
+                if inspect.iscoroutinefunction(getattr(clazz, method_name)):
+                    async def per_message_handler(*args, **kwargs):
+                        return await getattr(clazz(self), method_name)(*args, **kwargs)
+                else:
+                    def per_message_handler(*args, **kwargs):
+                        return getattr(clazz(self), method_name)(*args, **kwargs)
+
+                handler = per_message_handler
+            else:
+                service_instance = self.service_instances.get(clazz)
+                if service_instance is None:
+                    service_instance = clazz(self)
+                    self.service_instances[clazz] = service_instance
+                handler = getattr(service_instance, method_name)
+
+            self.payload_converters[value] = payload_converter(getattr(clazz, method_name))
+            self.handlers[value] = handler
+            return handler
+
+    @staticmethod
+    def resolve_class(value: str) -> tuple:
+        """
+        Imports the service class of the given mapping value in the form module.Class#method.
+        :param value:
+        :return: The class and the name of the method.
+        """
+        class_path, method_name = value.rsplit('#', 1)
+        module_path, class_name = class_path.rsplit('.', 1)
+        return getattr(import_module(module_path), class_name), method_name
@@ -0,0 +1,352 @@
+# pylint: disable=E0401
+import time
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from src.payloads import get_codec, iter_json_items
+
+
+def is_rewindable(data) -> bool:
+    """
+    Returns whether the request body can be sent again on a retry: Bytes, text, form data and seekable files.
+    :param data: The raw request body.
+    :return:
+    """
+    if data is None or isinstance(data, (bytes, bytearray, str, dict, list, tuple)):
+        return True
+    seekable = getattr(data, "seekable", None)
+    return bool(seekable and seekable())
+
+
+class HubRetry(Retry):
+    """
+        Retries requests to the hub. POST requests, if allowed at all, are retried on status 503 only,
+        since the hub might have processed them already on other status codes.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        """
+        Returns whether the request should be retried on the given status code.
+        :param method:
+        :param status_code:
+        :param has_retry_after:
+        :return:
+        """
+        if method.upper() == "POST" and status_code != 503:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def create_session(adapter) -> requests.Session:
+    """
+    Creates an HTTP session using the given connection pool.
+    :param adapter:
+    :return:
+    """
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class HubClientMixin:
+    """
+        Calls to the hub of PIPEFORCE for PipeforceClient: Executes commands and pipelines using pooled
+        keep-alive HTTP sessions and decodes the responses.
+    """
+
+    def run_pipeline(self, pipeline):
+        """
+        Executes the given pipeline on PIPEFORCE and returns the body result.
+        :param pipeline: The pipeline as YAML string. Large pipelines can be given as file object or iterator of
+            bytes, which is uploaded without loading it into memory.
+        :return:
+        """
+        return self.do_post(self.config.PIPEFORCE_HUB_URL + "/api/v3/pipeline", data=pipeline,
+                            headers=self.hub_headers('application/yaml'))
+
+    def run_command(self, name, params, cache=None, headers=None):
+        """
+        Executes a single command on PIPEFORCE and returns the body result.
+        :param name: The name of the command.
+        :param params: The params of the command.
+        :param cache: Whether to return a cached result of the same command and params, see CommandCache.
+            Defaults to True for the commands listed in PIPEFORCE_HUB_CACHE_COMMANDS. Use for read-only commands only.
+        :param headers: The headers to call the hub with. Defaults to the ones with the current access token.
+        :return:
+        """
+        if cache is None:
+            cache = name in self.cached_commands
+
+        def execute():
+            return self.do_post(self.config.PIPEFORCE_HUB_URL + f"/api/v3/command/{name}", json=params,
+                                headers=headers or self.hub_headers('application/json'))
+
+        if cache:
+            return self.command_cache.get(name, params, execute)
+        return execute()
+
+    def run_commands(self, commands, packed=False) -> list:
+        """
+        Executes many commands on PIPEFORCE concurrently, up to PIPEFORCE_HUB_MAX_CONCURRENCY at the same time.
+        All commands share the same access token and the pooled connections to the hub. Each command is executed
+        by run_command, so results of commands listed in PIPEFORCE_HUB_CACHE_COMMANDS are cached.
+        :param commands: Iterable of (name, params) tuples.
+        :param packed: In case of True, all commands are packed into a single pipeline which is executed by one call
+            to the hub. Cuts down the round-trips, but in case one command fails, all commands fail.
+        :return: For each command in the same order: The body result or the error raised by the command.
+        """
+        commands = list(commands)
+        if not commands:
+            return []
+        if packed:
+            return self.run_commands_packed(commands)
+
+        headers = self.hub_headers('application/json')
+        executor = self.get_hub_executor()
+        futures = [executor.submit(self.run_command, name, params, headers=headers) for name, params in commands]
+
+        results = []
+        for future in futures:
+            error = future.exception()
+            results.append(future.result() if error is None else error)
+
+        return results
+
+    def run_commands_packed(self, commands: list) -> list:
+        """
+        Executes the commands by a single generated pipeline. Each command writes its result to a variable
+        and the pipeline returns the list of all variables as body.
+        :param commands: List of (name, params) tuples.
+        :return: For each command in the same order: The body result or the error of the pipeline.
+        """
+        names = [f"result{i}" for i in range(len(commands))]
+        steps = [{name: dict(params or {}, output=f"#{{@vars.{var}}}")} for (name, params), var in zip(commands, names)]
+        steps.append({"body.set": {"value": "#{{" + ", ".join(f"@vars.{var}" for var in names) + "}}"}})
+
+        # JSON is valid YAML, so no YAML library is required to generate the pipeline
+        pipeline = dumps({"vars": dict.fromkeys(names), "pipeline": steps})
+
+        try:
+            results = self.run_pipeline(pipeline)
+            if not isinstance(results, list) or len(results) != len(commands):
+                raise Exception(f"Unexpected result of packed commands: {results!r}")
+        # pylint: disable=broad-except
+        except Exception as error:
+            return [error] * len(commands)
+
+        return results
+
+    def get_hub_executor(self) -> ThreadPoolExecutor:
+        """
+        Returns the pool to execute commands concurrently and creates it on first use.
+        :return:
+        """
+        if self.hub_executor is None:
+            with self.hub_executor_lock:
+                if self.hub_executor is None:
+                    self.hub_executor = ThreadPoolExecutor(max_workers=self.config.PIPEFORCE_HUB_MAX_CONCURRENCY,
+                                                           thread_name_prefix="pipeforce-hub")
+        return self.hub_executor
+
+    def run_pipeline_stream(self, pipeline, items=False, chunk_size=None):
+        """
+        Executes the given pipeline on PIPEFORCE and streams the body result instead of loading it into memory.
+        Returns as soon as the response headers have arrived.
+        :param pipeline: The pipeline as YAML string, file object or iterator of bytes. File objects and iterators
+            are uploaded without loading them into memory.
+        :param items: In case of True, the result is parsed as JSON array and its items are returned one by one.
+        :param chunk_size: Max bytes per chunk. Defaults to PIPEFORCE_HUB_STREAM_CHUNK_SIZE.
+        :return: Iterator of bytes chunks or of the parsed items.
+        """
+        return self.do_stream("POST", self.config.PIPEFORCE_HUB_URL + "/api/v3/pipeline", items, chunk_size,
+                              data=pipeline, headers=self.hub_headers('application/yaml'))
+
+    def run_command_stream(self, name, params, items=False, chunk_size=None):
+        """
+        Executes a single command on PIPEFORCE and streams the body result instead of loading it into memory.
+        Returns as soon as the response headers have arrived.
+        :param name: The name of the command.
+        :param params: The params of the command.
+        :param items: In case of True, the result is parsed as JSON array and its items are returned one by one.
+        :param chunk_size: Max bytes per chunk. Defaults to PIPEFORCE_HUB_STREAM_CHUNK_SIZE.
+        :return: Iterator of bytes chunks or of the parsed items.
+        """
+        return self.do_stream("POST", self.config.PIPEFORCE_HUB_URL + f"/api/v3/command/{name}", items, chunk_size,
+                              json=params, headers=self.hub_headers('application/json'))
+
+    def hub_headers(self, content_type) -> dict:
+        """
+        Returns the headers to call the hub with the current access token.
+        :param content_type: The content type of the request body.
+        :return:
+        """
+        return {'Content-type': content_type, 'Authorization': 'Bearer ' + self.get_pipeforce_access_token()}
+
+    def create_http_adapter(self, retry_status=True) -> HTTPAdapter:
+        """
+        Creates the connection pool to the hub with retries and exponential backoff on connection errors and
+        on the status codes configured in PIPEFORCE_HUB_RETRY_STATUS. POST requests are retried on status codes
+        only in case PIPEFORCE_HUB_RETRY_POST is set, see HubRetry.
+        :param retry_status: False for the pool of request bodies which can not be sent again, like iterators.
+            These are retried on connection errors only, before their body was sent.
+        :return:
+        """
+        retries = self.config.PIPEFORCE_HUB_RETRIES
+        allowed_methods = Retry.DEFAULT_ALLOWED_METHODS
+        if self.config.PIPEFORCE_HUB_RETRY_POST:
+            allowed_methods = allowed_methods | {"POST"}
+        retry = HubRetry(total=retries, connect=retries, read=0, status=retries if retry_status else 0,
+                         backoff_factor=self.config.PIPEFORCE_HUB_RETRY_BACKOFF,
+                         status_forcelist=[int(code) for code in self.config.PIPEFORCE_HUB_RETRY_STATUS.split(",")],
+                         allowed_methods=allowed_methods, raise_on_status=False)
+        return HTTPAdapter(pool_connections=1, pool_maxsize=self.config.PIPEFORCE_HUB_POOL_SIZE, max_retries=retry)
+
+    @property
+    def session(self) -> requests.Session:
+        """
+        Returns the HTTP session of the current thread. All sessions share the same keep-alive connection pool.
+        :return:
+        """
+        session = getattr(self.http_local, "session", None)
+        if session is None:
+            session = self.http_local.session = create_session(self.http_adapter)
+        return session
+
+    @property
+    def upload_session(self) -> requests.Session:
+        """
+        Returns the HTTP session of the current thread for request bodies which can not be sent again, like
+        iterators. A retry on an error status would send the exhausted iterator as empty body, so its connection
+        pool retries on connection errors only.
+        :return:
+        """
+        session = getattr(self.http_local, "upload_session", None)
+        if session is None:
+            session = self.http_local.upload_session = create_session(self.upload_http_adapter)
+        return session
+
+    def request_session(self, data) -> requests.Session:
+        """
+        Returns the session to send the given request body with.
+        :param data: The raw request body.
+        :return:
+        """
+        return self.session if is_rewindable(data) else self.upload_session
+
+    def do_post(self, url, json=None, headers=None, data=None):
+        """
+        Sends a POST request to given url using the pooled session and returns the extracted content.
+        :param url:
+        :param json: The request body to send as JSON.
+        :param headers:
+        :param data: The raw request body.
+        :return:
+        """
+        return self.do_request("POST", url, json=json, data=data, headers=headers)
+
+    def do_get(self, url, params=None, headers=None):
+        """
+        Sends a GET request to given url using the pooled session and returns the extracted content.
+        :param url:
+        :param params:
+        :param headers:
+        :return:
+        """
+        return self.do_request("GET", url, params=params, headers=headers)
+
+    def do_request(self, method, url, **kwargs):
+        """
+        Sends the request using the pooled session and returns the extracted content.
+        :param method: The HTTP method.
+        :param url:
+        :param kwargs: Further arguments of requests.Session.request.
+        :return:
+        """
+        return self.extract_content(self.send_request(method, url, **kwargs))
+
+    def do_stream(self, method, url, items=False, chunk_size=None, **kwargs):
+        """
+        Sends the request using the pooled session and returns an iterator over the response body.
+        The connection is released to the pool as soon as the iterator is exhausted or closed.
+        :param method: The HTTP method.
+        :param url:
+        :param items: In case of True, the body is parsed as JSON array and its items are returned one by one.
+        :param chunk_size: Max bytes per chunk. Defaults to PIPEFORCE_HUB_STREAM_CHUNK_SIZE.
+        :param kwargs: Further arguments of requests.Session.request.
+        :return: Iterator of bytes chunks or of the parsed items.
+        """
+        response = self.send_request(method, url, stream=True, **kwargs)
+        chunks = self.iter_chunks(response, chunk_size or self.config.PIPEFORCE_HUB_STREAM_CHUNK_SIZE)
+        return iter_json_items(chunks) if items else chunks
+
+    @staticmethod
+    def iter_chunks(response, chunk_size):
+        """
+        Yields the body of the streamed response chunk by chunk and closes the response afterwards.
+        :param response:
+        :param chunk_size:
+        :return:
+        """
+        with response:
+            yield from response.iter_content(chunk_size)
+
+    def send_request(self, method, url, **kwargs) -> requests.Response:
+        """
+        Sends the request using the pooled session, records its latency and raises an error on non 200 responses.
+        For streamed requests, the latency until the response headers have arrived is recorded.
+        :param method: The HTTP method.
+        :param url:
+        :param kwargs: Further arguments of requests.Session.request.
+        :return:
+        """
+        labels = (("method", method), ("path", urlsplit(url).path))
+        start = time.perf_counter()
+        try:
+            response = self.request_session(kwargs.get("data")).request(method, url, timeout=self.http_timeout(),
+                                                                          **kwargs)
+        finally:
+            self.metrics.observe("pipeforce_hub_request_duration_seconds", time.perf_counter() - start, labels)
+
+        if response.status_code != 200:
+            self.metrics.inc("pipeforce_hub_errors_total", labels)
+            with response:
+                raise Exception(f"Error response [code: {response.status_code}] from {method} to [{url}]: "
+                                f"{response.text}")
+
+        return response
+
+    def http_timeout(self) -> tuple:
+        """
+        Returns the (connect, read) timeout in seconds for requests to the hub.
+        :return:
+        """
+        return self.config.PIPEFORCE_HUB_CONNECT_TIMEOUT, self.config.PIPEFORCE_HUB_READ_TIMEOUT
+
+    def extract_content(self, response):
+        """
+        Returns the body of the response decoded by the codec of its content type, text as string.
+        For responses without known content type, JSON data is detected by its first char.
+        :param response:
+        :return:
+        """
+        if not response.content:
+            return None
+
+        content_type = response.headers.get("Content-Type", "").split(";", 1)[0].strip().lower()
+        if content_type in ("application/json", "application/msgpack", "application/x-msgpack"):
+            return get_codec(content_type).decode(response.content)
+
+        data = response.text
+        if content_type.startswith("text/"):
+            return data
+
+        if data.startswith("[") or data.startswith("{"):
+            return response.json()
+
+        return data
@@ -0,0 +1,194 @@
+# pylint: disable=E0401
+import hashlib
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from importlib import import_module
+
+from src.logs import get_logger
+from src.topics import pattern_labels
+
+logger = get_logger("idempotency")
+
+
+class IdempotencyStore(ABC):
+    """
+        Remembers the keys of messages for PipeforceClient, so duplicates can be skipped.
+        Subclass it and implement add and remove to share the keys between all instances of a service, for example
+        in Redis using SET NX EX, and set PIPEFORCE_MESSAGING_DEDUP_STORE to the module.Class of the subclass.
+    """
+
+    def __init__(self, config):
+        """
+        :param config:
+        """
+        self.window = config.PIPEFORCE_MESSAGING_DEDUP_WINDOW
+
+    @abstractmethod
+    def add(self, key: bytes) -> bool:
+        """
+        Adds the key in case it was not added within the last PIPEFORCE_MESSAGING_DEDUP_WINDOW seconds.
+        Must be atomic, since the same message might be received by several consumers at once.
+        :param key:
+        :return: True in case the key was added, False for a duplicate.
+        """
+
+    @abstractmethod
+    def remove(self, key: bytes):
+        """
+        Removes the key, so a message with this key is not a duplicate anymore.
+        :param key:
+        :return:
+        """
+
+
+class MemoryIdempotencyStore(IdempotencyStore):
+    """
+        Keeps the keys in memory of the service instance. Each key is stored as 64 bit digest with its expiry in
+        insertion order, so expired keys are removed from the front in constant time. The oldest keys are evicted
+        as soon as PIPEFORCE_MESSAGING_DEDUP_SIZE keys are stored, so memory stays bounded.
+    """
+
+    def __init__(self, config):
+        """
+        :param config:
+        """
+        super().__init__(config)
+        self.max_size = config.PIPEFORCE_MESSAGING_DEDUP_SIZE
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def digest(key: bytes) -> int:
+        """
+        Returns the compact representation of the key.
+        :param key:
+        :return:
+        """
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big")
+
+    def add(self, key: bytes) -> bool:
+        digest = self.digest(key)
+        now = time.monotonic()
+
+        with self.lock:
+            # All keys have the same window, so the oldest key expires first
+            while self.entries:
+                oldest, expires_at = next(iter(self.entries.items()))
+                if expires_at > now:
+                    break
+                del self.entries[oldest]
+
+            if digest in self.entries:
+                return False
+
+            self.entries[digest] = now + self.window
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            return True
+
+    def remove(self, key: bytes):
+        with self.lock:
+            self.entries.pop(self.digest(key), None)
+
+
+class IdempotencyMixin:
+    """
+        Skips duplicates of messages which are processed or have been processed already for PipeforceClient,
+        for example messages redelivered after the connection was lost before their ack was sent.
+        Enabled by PIPEFORCE_MESSAGING_DEDUP. A message is claimed on receipt, before its body is decoded or any
+        service method runs, and released again in case a service method failed, so its retry is not skipped.
+        The keys of the messages this instance is still processing are kept in keys_in_flight: Duplicates of these
+        are deferred instead of skipped, since the original might still fail after its channel was lost.
+        Expects the client to provide config, metrics, idempotency_store, keys_in_flight, dedup_lock, ack,
+        defer_message and message_routing_key.
+    """
+
+    def create_idempotency_store(self):
+        """
+        Creates the store configured by PIPEFORCE_MESSAGING_DEDUP_STORE or returns None in case
+        PIPEFORCE_MESSAGING_DEDUP is not set.
+        :return:
+        """
+        if not self.config.PIPEFORCE_MESSAGING_DEDUP:
+            return None
+
+        module_path, class_name = self.config.PIPEFORCE_MESSAGING_DEDUP_STORE.rsplit(".", 1)
+        return getattr(import_module(module_path), class_name)(self.config)
+
+    def message_key(self, routing_key, props, body):
+        """
+        Returns the key identifying the message depending on PIPEFORCE_MESSAGING_DEDUP.
+        :param routing_key: The original routing key of the message.
+        :param props:
+        :param body:
+        :return: The key or None for a message without message id.
+        """
+        if self.config.PIPEFORCE_MESSAGING_DEDUP == "body":
+            digest = hashlib.new(self.config.PIPEFORCE_MESSAGING_DEDUP_HASH, routing_key.encode("utf-8") + b"\0")
+            digest.update(body)
+            return digest.digest()
+
+        message_id = getattr(props, "message_id", None)
+        return message_id.encode("utf-8") if message_id else None
+
+    def claim_message(self, channel, method, props, body, matches) -> bool:  # pylint: disable=too-many-arguments
+        """
+        Claims the message for processing. A duplicate of a processed message is acknowledged without processing it.
+        A duplicate of a message still in flight, like one redelivered after the connection was lost, is deferred,
+        see defer_message, so it is processed in case the original fails.
+        :param channel:
+        :param method:
+        :param props:
+        :param body:
+        :param matches: The matching mappings, see pattern_labels.
+        :return: False in case the message was settled as duplicate.
+        """
+        if self.idempotency_store is None:
+            return True
+
+        routing_key = self.message_routing_key(method, props)
+        key = self.message_key(routing_key, props, body)
+        if key is None:
+            return True
+
+        with self.dedup_lock:
+            if self.idempotency_store.add(key):
+                self.keys_in_flight.add(key)
+                return True
+            in_flight = key in self.keys_in_flight
+
+        extra = {"routing_key": routing_key, "message_id": getattr(props, "message_id", None)}
+        if in_flight:
+            logger.info("Deferring duplicate of message in flight: %s", routing_key, extra=extra)
+            self.metrics.inc("pipeforce_messages_deferred_total")
+            self.defer_message(channel, method, props, body)
+        else:
+            logger.info("Skipping duplicate message: %s", routing_key, extra=extra)
+            self.metrics.inc("pipeforce_messages_duplicate_total", pattern_labels(matches))
+            self.ack(channel, method.delivery_tag)
+        return False
+
+    def finish_message(self, method, props, body, succeeded: bool):
+        """
+        Ends the claim of a message once its service methods have completed, whether or not it can still be settled.
+        The key of a failed message is released, so the message is processed again when retried or redelivered.
+        Can be called from any thread.
+        :param method:
+        :param props:
+        :param body:
+        :param succeeded: True in case all service methods succeeded.
+        :return:
+        """
+        if self.idempotency_store is None:
+            return
+
+        key = self.message_key(self.message_routing_key(method, props), props, body)
+        if key is None:
+            return
+
+        with self.dedup_lock:
+            self.keys_in_flight.discard(key)
+            if not succeeded:
+                self.idempotency_store.remove(key)
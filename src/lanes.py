@@ -0,0 +1,255 @@
+# pylint: disable=E0401
+import os
+
+from src.events import find_event_lanes, read_event_lanes, read_event_manifest
+from src.logs import get_logger
+from src.retries import retry_queue_declarations
+from src.topics import RoutingIndex
+
+logger = get_logger("lanes")
+
+
+class Lane:  # pylint: disable=too-many-instance-attributes
+    """
+        A separate queue of the service for the service methods registered with the same priority and concurrency
+        by @event. The lane has its own consumer with a prefetch window of its concurrency and its own worker pool
+        of this size, so a flood of messages for other service methods neither fills its prefetch window nor
+        occupies its workers. Without concurrency, the lane gets PIPEFORCE_MESSAGING_WORKERS workers of its own,
+        at least one. The service queue then uses a worker pool too, so the connection thread is never blocked by
+        a service method and keeps delivering and settling the messages of the lane. The priority is set as
+        consumer priority, which only ranks consumers of the same lane queue, so the broker does not serve one lane
+        before another. The queue supports message priorities, so messages sent with a higher priority property are
+        delivered first within the lane.
+    """
+
+    # True for lanes of batch service methods, see BatchLane
+    batch = False
+
+    def __init__(self, config, priority: int, concurrency: int, mappings: list):
+        """
+        :param config:
+        :param priority: The consumer priority.
+        :param concurrency: Max messages processed in parallel. 0 uses PIPEFORCE_MESSAGING_WORKERS, at least one.
+        :param mappings: The event mappings of the lane as (key, value) tuples.
+        """
+        self.name = f"p{priority}" + (f"-c{concurrency}" if concurrency else "")
+        self.queue = f"{config.PIPEFORCE_MESSAGING_QUEUE}.lane.{self.name}"
+        self.priority = priority
+        self.concurrency = concurrency
+        self.mappings = mappings
+        self.routing_index = RoutingIndex(mappings, cache_size=config.PIPEFORCE_ROUTING_CACHE_SIZE)
+        # The worker pool of the sync client and the semaphore of the async client
+        self.executor = None
+        self.semaphore = None
+
+    def binding_keys(self) -> list:
+        """
+        Returns the distinct routing keys to bind the lane queue to.
+        :return:
+        """
+        return list(dict.fromkeys(key for key, _ in self.mappings))
+
+
+class BatchLane(Lane):  # pylint: disable=too-many-instance-attributes
+    """
+        The lane of a single service method registered by @batch_event. Its messages are collected into a batch
+        on the connection thread until max_size messages have arrived or max_wait seconds have passed since the
+        first one. The prefetch window holds the batches in-flight and the one being collected, see
+        lane_prefetch_count, so the broker delivers enough messages to fill a batch.
+    """
+
+    batch = True
+
+    def __init__(self, config, value: str, options: dict, mappings: list):
+        """
+        :param config:
+        :param value: The batch service method in the form module.Class#method.
+        :param options: The lane options with max_size and max_wait.
+        :param mappings: The event mappings of the service method as (key, value) tuples.
+        """
+        super().__init__(config, options["priority"], options["concurrency"], mappings)
+        self.name = "batch-" + value.replace("#", ".")
+        self.queue = f"{config.PIPEFORCE_MESSAGING_QUEUE}.lane.{self.name}"
+        self.value = value
+        self.max_size = options["max_size"]
+        self.max_wait = options["max_wait"]
+        # The messages collected so far and the number of batches started, to ignore timers of earlier batches
+        self.buffer = []
+        self.generation = 0
+        # True while a timer is pending to pass the batch being collected on
+        self.flush_scheduled = False
+
+    def reset(self):
+        """
+        Starts a new batch. Timers started for the previous one are ignored.
+        :return:
+        """
+        self.buffer = []
+        self.generation += 1
+        self.flush_scheduled = False
+
+
+class LaneMixin:
+    """
+        Loads the event mappings for PipeforceClient and sets up a lane for each distinct priority and concurrency
+        declared by @event. Service methods without these options are served from the service queue as before.
+        Expects the client to provide config, channel, mappings, routing_index, executor, lanes and consumer_lanes.
+    """
+
+    def load_mappings(self):
+        """
+        Loads the event mappings and builds the routing index and lanes. In case PIPEFORCE_EVENT_MANIFEST points
+        to an existing manifest file, the mappings are read from it and the service modules are imported lazily
+        on their first message. Otherwise all service modules are imported and their handlers resolved upfront.
+        :return:
+        """
+        manifest = self.config.PIPEFORCE_EVENT_MANIFEST
+        if manifest and os.path.isfile(manifest):
+            logger.info("Loading event mappings from manifest: %s", manifest)
+            self.mappings = read_event_manifest(manifest)
+            options = read_event_lanes(manifest)
+            lazy = True
+        else:
+            self.mappings = self.find_event_mappings()
+            options = find_event_lanes()
+            lazy = False
+
+        self.lanes = self.create_lanes(options)
+        lane_values = {value for lane in self.lanes for _, value in lane.mappings}
+        self.routing_index = RoutingIndex([mapping for mapping in self.mappings if mapping[1] not in lane_values],
+                                          cache_size=self.config.PIPEFORCE_ROUTING_CACHE_SIZE)
+
+        if not lazy:
+            self.resolve_handlers()
+
+    def create_lanes(self, options: dict) -> list:
+        """
+        Groups the mappings of the service methods with lane options into lanes.
+        Each batch service method gets a lane of its own.
+        :param options: The lane options by mapping value.
+        :return: The lanes ordered by descending priority, followed by the batch lanes.
+        """
+        grouped = {}
+        batched = {}
+        for key, value in self.mappings:
+            option = options.get(value)
+            if option and option.get("max_size"):
+                batched.setdefault(value, []).append((key, value))
+            elif option:
+                grouped.setdefault((option["priority"], option["concurrency"]), []).append((key, value))
+
+        lanes = [Lane(self.config, priority, concurrency, mappings)
+                 for (priority, concurrency), mappings in sorted(grouped.items(), reverse=True)]
+        lanes += [BatchLane(self.config, value, options[value], mappings) for value, mappings in batched.items()]
+        return lanes
+
+    def binding_keys(self) -> list:
+        """
+        Returns the distinct routing keys of all event mappings to bind the service queue to,
+        except the ones served by lanes only.
+        :return:
+        """
+        lane_values = {value for lane in self.lanes for _, value in lane.mappings}
+        return list(dict.fromkeys(key for key, value in self.mappings if value not in lane_values))
+
+    def lane_declarations(self, lane: Lane) -> list:
+        """
+        Returns the arguments to declare the lane queue and its retry queues with.
+        :param lane:
+        :return: List of keyword arguments for queue_declare.
+        """
+        queue = {"queue": lane.queue, "durable": True, "exclusive": False, "auto_delete": False}
+        if self.config.PIPEFORCE_MESSAGING_MAX_PRIORITY > 0:
+            queue["arguments"] = {"x-max-priority": self.config.PIPEFORCE_MESSAGING_MAX_PRIORITY}
+        return [queue] + retry_queue_declarations(self.config, lane.queue)
+
+    def lane_prefetch_count(self, lane: Lane) -> int:
+        """
+        Returns the max unacked messages of the lane consumer. For a batch lane, these are the batches
+        processed in parallel plus the one being collected.
+        :param lane:
+        :return:
+        """
+        if lane.batch:
+            return lane.max_size * (max(lane.concurrency, 1) + 1)
+        return lane.concurrency or self.config.PIPEFORCE_MESSAGING_PREFETCH_COUNT
+
+    def create_lane_executors(self):
+        """
+        Creates the worker pool of each lane with a worker per concurrency. Lanes without concurrency get
+        PIPEFORCE_MESSAGING_WORKERS workers, at least one, so they never run on the connection thread.
+        :return:
+        """
+        for lane in self.lanes:
+            lane.executor = self.create_executor(lane.concurrency or max(self.config.PIPEFORCE_MESSAGING_WORKERS, 1))
+
+    def lane_executors(self) -> list:
+        """
+        Returns the worker pools owned by lanes.
+        :return:
+        """
+        return [lane.executor for lane in self.lanes if lane.executor is not None]
+
+    def setup_lanes(self, channel):
+        """
+        Declares and binds the lane queues and starts a consumer for each lane with its own prefetch window.
+        :param channel:
+        :return:
+        """
+        self.consumer_lanes = {}
+        for lane in self.lanes:
+            for declaration in self.lane_declarations(lane):
+                channel.queue_declare(**declaration)
+
+            for key in lane.binding_keys():
+                logger.info("Creating lane binding: %s -> %s", key, lane.queue)
+                channel.queue_bind(exchange=self.config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC, queue=lane.queue,
+                                   routing_key=key)
+
+            channel.basic_qos(prefetch_count=self.lane_prefetch_count(lane))
+            consumer_tag = channel.basic_consume(queue=lane.queue, on_message_callback=self.dispatch_message,
+                                                 auto_ack=False, arguments={"x-priority": lane.priority})
+            self.consumer_lanes[consumer_tag] = lane
+
+    async def setup_lanes_async(self):
+        """
+        Declares and binds the lane queues and starts a consumer for each lane on the channel of
+        AsyncPipeforceClient, using its wait_for to await each operation.
+        :return:
+        """
+        self.consumer_lanes = {}
+        for lane in self.lanes:
+            for declaration in self.lane_declarations(lane):
+                await self.wait_for(lambda callback, declaration=declaration: self.channel.queue_declare(
+                    callback=callback, **declaration))
+
+            for key in lane.binding_keys():
+                logger.info("Creating lane binding: %s -> %s", key, lane.queue)
+                await self.wait_for(lambda callback, key=key, lane=lane: self.channel.queue_bind(
+                    exchange=self.config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC, queue=lane.queue, routing_key=key,
+                    callback=callback))
+
+            await self.wait_for(lambda callback, lane=lane: self.channel.basic_qos(
+                prefetch_count=self.lane_prefetch_count(lane), callback=callback))
+            consumer_tag = self.channel.basic_consume(queue=lane.queue, on_message_callback=self.dispatch_message,
+                                                      auto_ack=False, arguments={"x-priority": lane.priority})
+            self.consumer_lanes[consumer_tag] = lane
+
+    def consumer_lane(self, method):
+        """
+        Returns the lane the message was delivered by or None for the service queue.
+        :param method:
+        :return:
+        """
+        if not self.consumer_lanes:
+            return None
+        return self.consumer_lanes.get(getattr(method, "consumer_tag", None))
+
+    def consumer_queue(self, method) -> str:
+        """
+        Returns the name of the queue the message was delivered from.
+        :param method:
+        :return:
+        """
+        lane = self.consumer_lane(method)
+        return lane.queue if lane else self.config.PIPEFORCE_MESSAGING_QUEUE
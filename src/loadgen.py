@@ -0,0 +1,379 @@
+"""
+    Generates load against a service running on the in-memory broker and reports the end-to-end latency
+    percentiles and throughput, so a service can be capacity-planned before deploying it. Run it from the
+    repository root, for example:
+
+    > python -m src.loadgen --rate 2000 --duration 10 --keys "pipeforce.webhook.a=8,pipeforce.order.created=2" \\
+        --sizes "100=9,100000=1" --rpc 0.1 --service-time 2 --workers 8
+
+    By default, all keys are consumed by a synthetic service method taking --service-time milliseconds per message.
+    Use --package to consume them by the @event service methods of a service package instead. All other PIPEFORCE_*
+    settings apply as for the deployed service. The latency of events is measured from publishing a message until
+    the service has acknowledged it, the latency of RPCs around message_send_and_wait answered by an echo responder.
+"""
+# pylint: disable=E0401
+import argparse
+import json
+import math
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import pika
+
+from src.broker import InMemoryBroker
+from src.config import Config
+from src.events import find_event_mappings
+from src.pipeforce import BaseService, PipeforceClient
+
+# Routing key of the requests answered by the echo responder
+RPC_KEY = "pipeforce.loadgen.rpc"
+
+# The latency percentiles to report
+PERCENTILES = (50, 90, 99, 99.9)
+
+# Max seconds to wait for the client to start consuming
+STARTUP_TIMEOUT = 10
+
+
+class LoadService(BaseService):
+    """
+        Synthetic service method consuming all keys of the load. Takes service_time seconds per message.
+    """
+
+    service_time = 0.0
+
+    def handle(self, body: bytes):
+        """
+        Simulates the work of a service method.
+        :param body:
+        :return:
+        """
+        if LoadService.service_time > 0:
+            time.sleep(LoadService.service_time)
+
+
+class EchoResponder:
+    """
+        Answers the RPC requests of the load generator with their own body, like a remote service would.
+        Consumes on its own connection to the in-memory broker on a background thread.
+    """
+
+    def __init__(self, broker: InMemoryBroker, config):
+        """
+        :param broker:
+        :param config:
+        """
+        self.connection = broker.connect()
+        self.channel = self.connection.channel()
+        self.channel.exchange_declare(exchange=config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC, exchange_type="topic")
+        queue = self.channel.queue_declare(queue="", exclusive=True).method.queue
+        self.channel.queue_bind(queue=queue, exchange=config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC, routing_key=RPC_KEY)
+        self.channel.basic_consume(queue=queue, on_message_callback=self.on_request, auto_ack=True)
+        self.thread = threading.Thread(target=self.channel.start_consuming, name="loadgen-responder", daemon=True)
+
+    def start(self):
+        """
+        Starts answering requests.
+        :return:
+        """
+        self.thread.start()
+
+    def on_request(self, channel, method, props, body):  # pylint: disable=unused-argument
+        """
+        Sends the body back to the reply queue of the request.
+        :param channel:
+        :param method:
+        :param props:
+        :param body:
+        :return:
+        """
+        channel.basic_publish(exchange="", routing_key=props.reply_to, body=body,
+                              properties=pika.BasicProperties(correlation_id=props.correlation_id))
+
+    def stop(self):
+        """
+        Stops answering requests.
+        :return:
+        """
+        self.connection.add_callback_threadsafe(self.channel.stop_consuming)
+        self.thread.join()
+
+
+class LoadResults:
+    """
+        Collects the latencies of the events and RPCs sent by the load generator.
+        Events are identified by their message id, so a retried event counts once with its final latency.
+    """
+
+    def __init__(self, queue: str):
+        """
+        :param queue: The service queue. Acks from it and its lanes complete events.
+        """
+        self.queue = queue
+        self.lock = threading.Lock()
+        self.event_latencies = {}
+        self.rpc_latencies = []
+        self.rpc_failed = 0
+        self.last_completed = None
+
+    def on_ack(self, queue, properties, seconds):
+        """
+        Records the latency of an acknowledged event. Called by the broker.
+        :param queue:
+        :param properties:
+        :param seconds:
+        :return:
+        """
+        if queue == self.queue or queue.startswith(self.queue + ".lane."):
+            self.event_latencies[properties.message_id] = seconds
+            self.last_completed = time.perf_counter()
+
+    def call(self, client: PipeforceClient, body: bytes, timeout: float):
+        """
+        Sends an RPC and records its latency.
+        :param client:
+        :param body:
+        :param timeout:
+        :return:
+        """
+        started = time.perf_counter()
+        try:
+            client.message_send_and_wait(RPC_KEY, body, timeout)
+        except (TimeoutError, pika.exceptions.AMQPError):
+            with self.lock:
+                self.rpc_failed += 1
+            return
+
+        finished = time.perf_counter()
+        with self.lock:
+            self.rpc_latencies.append(finished - started)
+            self.last_completed = finished
+
+    def wait_for_events(self, count: int, timeout: float) -> bool:
+        """
+        Waits until the given number of events has been completed.
+        :param count:
+        :param timeout:
+        :return: True in case all events have been completed in time.
+        """
+        deadline = time.monotonic() + timeout
+        while len(self.event_latencies) < count:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+
+def percentile(values: list, percent: float) -> float:
+    """
+    Returns the percentile of the sorted values using the nearest-rank method.
+    :param values:
+    :param percent:
+    :return:
+    """
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def summarize(latencies, sent: int, seconds: float) -> dict:
+    """
+    Returns the counts, throughput and latency percentiles in milliseconds.
+    :param latencies:
+    :param sent:
+    :param seconds: The time from the first message sent until the last one completed.
+    :return:
+    """
+    values = sorted(latencies)
+    latency = {f"p{percent:g}": round(percentile(values, percent) * 1000, 3) for percent in PERCENTILES}
+    latency["max"] = round(values[-1] * 1000, 3) if values else 0.0
+    return {"sent": sent, "completed": len(values),
+            "throughput": round(len(values) / seconds, 1) if seconds > 0 else 0.0, "latency_ms": latency}
+
+
+def parse_weights(text: str, value_type=str) -> tuple:
+    """
+    Parses a comma separated list of values with optional weights, like a=8,b=2.
+    :param text:
+    :param value_type: The type to convert the values to.
+    :return: The values and their weights as two lists.
+    """
+    values, weights = [], []
+    for item in text.split(","):
+        value, _, weight = item.strip().partition("=")
+        values.append(value_type(value))
+        weights.append(float(weight) if weight else 1.0)
+    return values, weights
+
+
+def create_body(sequence: int, size: int) -> bytes:
+    """
+    Returns a JSON object with the sequence number, padded to the given size.
+    :param sequence:
+    :param size:
+    :return:
+    """
+    body = json.dumps({"sequence": sequence, "data": ""})
+    return (body[:-2] + "x" * max(0, size - len(body)) + body[-2:]).encode("utf-8")
+
+
+def create_client(options, broker: InMemoryBroker, keys: list) -> PipeforceClient:
+    """
+    Creates the client of the service under load, connected to the in-memory broker.
+    :param options:
+    :param broker:
+    :param keys: The routing keys of the load.
+    :return:
+    """
+    config = Config()
+    config.PIPEFORCE_SERVICE = config.PIPEFORCE_SERVICE or "loadgen"
+    config.PIPEFORCE_NAMESPACE = config.PIPEFORCE_NAMESPACE or "local"
+    config.PIPEFORCE_MESSAGING_QUEUE = "pipeforce.service." + config.PIPEFORCE_SERVICE
+    config.PIPEFORCE_METRICS_PORT = 0
+    if options.workers is not None:
+        config.PIPEFORCE_MESSAGING_WORKERS = options.workers
+    if options.prefetch is not None:
+        config.PIPEFORCE_MESSAGING_PREFETCH_COUNT = options.prefetch
+
+    client = broker.attach(PipeforceClient(config))
+    if options.package:
+        client.find_event_mappings = partial(find_event_mappings, options.package)
+    else:
+        LoadService.service_time = options.service_time / 1000
+        client.find_event_mappings = lambda: [(key, __name__ + ".LoadService#handle") for key in dict.fromkeys(keys)]
+    return client
+
+
+def wait_for_consumer(broker: InMemoryBroker, queue: str):
+    """
+    Waits until the service queue has a consumer.
+    :param broker:
+    :param queue:
+    :return:
+    """
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while broker.consumer_count(queue) == 0:
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"No consumer for {queue} within {STARTUP_TIMEOUT} seconds")
+        time.sleep(0.01)
+
+
+def run(options) -> dict:  # pylint: disable=too-many-locals
+    """
+    Starts the service on the in-memory broker, sends the load and waits until it has been processed.
+    :param options: The parsed command line options, see parse_args.
+    :return: The report.
+    """
+    keys, key_weights = parse_weights(options.keys)
+    sizes, size_weights = parse_weights(options.sizes, int)
+    rng = random.Random(options.seed)
+
+    broker = InMemoryBroker()
+    client = create_client(options, broker, keys)
+    config = client.config
+    results = LoadResults(config.PIPEFORCE_MESSAGING_QUEUE)
+    broker.on_ack = results.on_ack
+
+    consumer = threading.Thread(target=client.start_consuming, name="loadgen-client", daemon=True)
+    consumer.start()
+    wait_for_consumer(broker, config.PIPEFORCE_MESSAGING_QUEUE)
+    responder = EchoResponder(broker, config)
+    responder.start()
+    rpc_executor = ThreadPoolExecutor(max_workers=options.rpc_concurrency, thread_name_prefix="loadgen-rpc")
+    channel = broker.connect().channel()
+
+    events = rpcs = 0
+    started = time.perf_counter()
+    for sequence in range(int(options.rate * options.duration)):
+        delay = started + sequence / options.rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+        body = create_body(sequence, rng.choices(sizes, size_weights)[0])
+        if rng.random() < options.rpc:
+            rpcs += 1
+            rpc_executor.submit(results.call, client, body, options.timeout)
+        else:
+            events += 1
+            channel.basic_publish(
+                exchange=config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC, routing_key=rng.choices(keys, key_weights)[0],
+                body=body, properties=pika.BasicProperties(content_type="application/json", message_id=str(sequence)))
+    sent_seconds = time.perf_counter() - started
+
+    rpc_executor.shutdown(wait=True)
+    drained = results.wait_for_events(events, options.timeout)
+    seconds = (results.last_completed or time.perf_counter()) - started
+
+    client.request_drain()
+    consumer.join(options.timeout)
+    responder.stop()
+    broker.close()
+
+    return {
+        "offered_rate": round((events + rpcs) / sent_seconds, 1) if sent_seconds > 0 else 0.0,
+        "seconds": round(seconds, 3),
+        "drained": drained,
+        "events": summarize(results.event_latencies.values(), events, seconds),
+        "rpc": dict(summarize(results.rpc_latencies, rpcs, seconds), failed=results.rpc_failed),
+    }
+
+
+def format_report(report: dict) -> str:
+    """
+    Returns the report as text.
+    :param report:
+    :return:
+    """
+    lines = [f"Offered {report['offered_rate']} msg/s, completed after {report['seconds']} s"
+             + ("" if report["drained"] else " (timed out waiting for events)")]
+    for name in ("events", "rpc"):
+        summary = report[name]
+        latency = ", ".join(f"{key}={value}" for key, value in summary["latency_ms"].items())
+        lines.append(f"{name}: {summary['completed']}/{summary['sent']} completed, "
+                     f"{summary['throughput']} msg/s, latency ms: {latency}")
+    return "\n".join(lines)
+
+
+def parse_args(args=None):
+    """
+    Parses the command line options.
+    :param args: Defaults to sys.argv.
+    :return:
+    """
+    parser = argparse.ArgumentParser(description="Generates load against a service on the in-memory broker.")
+    parser.add_argument("--rate", type=float, default=1000, help="messages per second to send")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to send messages for")
+    parser.add_argument("--keys", default="pipeforce.loadgen.event",
+                        help="routing keys with optional weights, like a.b=8,a.c=2")
+    parser.add_argument("--sizes", default="1000",
+                        help="payload sizes in bytes with optional weights, like 100=9,10000=1")
+    parser.add_argument("--rpc", type=float, default=0.0, help="ratio of messages sent as RPC, between 0 and 1")
+    parser.add_argument("--rpc-concurrency", type=int, default=16, help="max RPCs waiting for a response at once")
+    parser.add_argument("--service-time", type=float, default=0.0,
+                        help="milliseconds the synthetic service method takes per message")
+    parser.add_argument("--package", help="service package whose @event service methods consume the load")
+    parser.add_argument("--workers", type=int, help="overrides PIPEFORCE_MESSAGING_WORKERS")
+    parser.add_argument("--prefetch", type=int, help="overrides PIPEFORCE_MESSAGING_PREFETCH_COUNT")
+    parser.add_argument("--timeout", type=float, default=30, help="max seconds to wait for responses and events")
+    parser.add_argument("--seed", type=int, help="seed of the random key and size distribution")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args(args)
+
+
+def main():
+    """
+    Runs the load generator from the command line.
+    :return:
+    """
+    options = parse_args()
+    report = run(options)
+    print(json.dumps(report, indent=2) if options.json else format_report(report))
+    sys.exit(0 if report["drained"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import atexit
+import json
+import logging
+import os
+import sys
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+# The name of the logger all modules of the client log to
+LOGGER_NAME = "pipeforce"
+
+# Record attributes given via extra which are written as separate fields of the JSON output
+FIELDS = ("routing_key", "correlation_id", "handler", "duration_ms")
+
+_setup_lock = threading.Lock()
+_listener = None  # pylint: disable=invalid-name
+
+
+def get_logger(name: str = None) -> logging.Logger:
+    """
+    Returns the logger of the client or one of its children.
+    :param name: Optional name of the child logger, for example "tokens".
+    :return:
+    """
+    return logging.getLogger(f"{LOGGER_NAME}.{name}" if name else LOGGER_NAME)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+        Formats each record as a single line JSON object with time, level, logger and message
+        plus the structured fields given via extra, like routing key, correlation id and handler timing.
+    """
+
+    def format(self, record) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+class _AsyncQueueHandler(QueueHandler):
+    """
+        Puts the unformatted record into the queue, so formatting and writing happens on the listener thread only.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level: str = "INFO", log_format: str = "json", stream=None):
+    """
+    Configures the client logger to hand all records over to a queue which is written to the stream by a
+    background thread, so logging never blocks the consumer thread on I/O. The handler is installed once,
+    further calls only change the level.
+    :param level: The name of the log level, for example DEBUG or INFO.
+    :param log_format: Either json for one JSON object per line or text for plain messages.
+    :param stream: The stream to write to. Defaults to stdout.
+    :return: The logger of the client.
+    """
+    global _listener  # pylint: disable=global-statement,invalid-name
+
+    logger = get_logger()
+    logger.setLevel(level.upper())
+
+    with _setup_lock:
+        if _listener is None:
+            handler = logging.StreamHandler(stream or sys.stdout)
+            if log_format == "json":
+                handler.setFormatter(JsonFormatter())
+            else:
+                handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+            queue = SimpleQueue()
+            logger.addHandler(_AsyncQueueHandler(queue))
+            logger.propagate = False
+
+            _listener = QueueListener(queue, handler)
+            _listener.start()
+            atexit.register(_listener.stop)
+
+    return logger
+
+
+def _reset_after_fork():
+    """
+    The listener thread does not survive a fork, so a child process installs its own on its first setup_logging.
+    :return:
+    """
+    global _listener, _setup_lock  # pylint: disable=global-statement,invalid-name
+
+    logger = get_logger()
+    for handler in [handler for handler in logger.handlers if isinstance(handler, _AsyncQueueHandler)]:
+        logger.removeHandler(handler)
+    _listener = None
+    _setup_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,12 @@
+"""
+    Writes the event manifest of all services, so the service can start without importing all service
+    modules upfront. Run it from the repository root at build time and set PIPEFORCE_EVENT_MANIFEST to the file:
+
+    > python -m src.manifest event-manifest.json
+"""
+import sys
+
+from src.events import write_event_manifest
+
+if __name__ == "__main__":
+    write_event_manifest(sys.argv[1] if len(sys.argv) > 1 else "event-manifest.json")
@@ -0,0 +1,234 @@
+# pylint: disable=E0401
+import random
+import threading
+from concurrent.futures import Future
+
+import pika
+
+from src.concurrency import call_threadsafe, wait_for_error
+from src.logs import get_logger
+from src.payloads import encode_payload
+from src.publisher import BatchPublisher, PublishError
+from src.replies import ReplyConsumer
+
+logger = get_logger("messaging")
+
+
+def backoff_delay(attempt: int, initial: float, maximum: float) -> float:
+    """
+    Returns the seconds to wait before the given reconnect attempt. The delay doubles with each attempt up to
+    maximum and is randomized by up to half, so many clients losing the broker at once do not reconnect in lockstep.
+    :param attempt: The number of failed attempts in a row, starting at 0.
+    :param initial: The delay of the first attempt.
+    :param maximum: The max delay.
+    :return:
+    """
+    delay = min(maximum, initial * 2 ** min(attempt, 32))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class MessagingMixin:
+    """
+        Sends messages to other microservices for PipeforceClient. Expects the client to provide config, metrics,
+        connection, connection_thread, channel, publisher and reply_consumer with their locks and the outage_buffer
+        with its outage_lock.
+    """
+
+    def create_connection(self) -> pika.BlockingConnection:
+        """
+        Opens a blocking connection to the message broker. Used for consuming and for the reply queue.
+        Replaced by InMemoryBroker.attach to run the client without a message broker.
+        :return:
+        """
+        return pika.BlockingConnection(self.connection_parameters())
+
+    def log_reconnect(self, reason, delay, attempt, connected):
+        """
+        Logs and counts the next attempt to connect to the message broker.
+        :param reason: The error or close reason of the last attempt.
+        :param delay: The seconds until the next attempt.
+        :param attempt:
+        :param connected: False in case no attempt has succeeded yet, for example since the broker is not running.
+        :return:
+        """
+        if connected:
+            logger.warning("Connection to message broker lost: %r. Reconnecting in %.1f seconds (attempt %s)",
+                           reason, delay, attempt)
+        else:
+            logger.warning("Could not connect to message broker: %r. Retrying in %.1f seconds (attempt %s)",
+                           reason, delay, attempt)
+        self.metrics.inc("pipeforce_reconnects_total")
+
+    def message_send(self, key, payload, content_type=None):
+        """
+        Sends the message to given routing key and returns immediately. Can be called from any thread.
+        Since pika channels are not thread-safe, messages sent from other threads than the connection thread,
+        like the worker pool, are published on the connection thread.
+        While the connection to the message broker is lost, the message is buffered and sent after reconnecting.
+        :param key:
+        :param payload: Bytes, text, a Payload to forward or any value to encode by the codec of the content type.
+        :param content_type: The content type of the message. See encode_payload for the default.
+        :return:
+        """
+        body, properties = self.encode_message(payload, content_type)
+        if self.connection is None or threading.get_ident() == self.connection_thread:
+            self.publish(key, body, properties)
+            return
+
+        try:
+            call_threadsafe(self.connection, self.publish_logged, key, body, properties)
+        except pika.exceptions.AMQPError as error:
+            logger.warning("Buffering message %s until reconnected: %r", key, error, extra={"routing_key": key})
+            self.buffer_message(key, body, properties)
+
+    def publish_logged(self, key, body, properties):
+        """
+        Publishes the message on the connection thread and logs the error in case the outage buffer is full,
+        since there is no caller to raise it to.
+        :param key:
+        :param body:
+        :param properties:
+        :return:
+        """
+        try:
+            self.publish(key, body, properties)
+        except PublishError as error:
+            logger.error("%s", error, extra={"routing_key": key})
+
+    def publish(self, key, body, properties=None):
+        """
+        Publishes the encoded message on the channel of the client. In case there is no open channel or messages
+        of a previous outage are still waiting, the message is added to the outage buffer to keep the order.
+        :param key:
+        :param body:
+        :param properties:
+        :return:
+        :raises PublishError: In case PIPEFORCE_MESSAGING_OUTAGE_BUFFER_SIZE messages are buffered already.
+        """
+        if self.channel is not None and not self.outage_buffer:
+            try:
+                self.channel.basic_publish(
+                    exchange=self.config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC,
+                    routing_key=key,
+                    properties=properties,
+                    body=body)
+                return
+            except pika.exceptions.AMQPError as error:
+                logger.warning("Buffering message %s until reconnected: %r", key, error, extra={"routing_key": key})
+
+        self.buffer_message(key, body, properties)
+
+    def buffer_message(self, key, body, properties):
+        """
+        Adds the message to the outage buffer to be published after reconnecting. Can be called from any thread.
+        :param key:
+        :param body:
+        :param properties:
+        :return:
+        :raises PublishError: In case PIPEFORCE_MESSAGING_OUTAGE_BUFFER_SIZE messages are buffered already.
+        """
+        with self.outage_lock:
+            if len(self.outage_buffer) >= self.config.PIPEFORCE_MESSAGING_OUTAGE_BUFFER_SIZE:
+                self.metrics.inc("pipeforce_messages_dropped_total")
+                raise PublishError(f"Message {key} not sent: Connection lost and outage buffer is full")
+            self.outage_buffer.append((key, body, properties))
+
+    def flush_outage_buffer(self):
+        """
+        Publishes the messages buffered while the connection was lost in their original order.
+        Messages not published because the connection got lost again stay buffered.
+        :return:
+        """
+        with self.outage_lock:
+            messages = list(self.outage_buffer)
+            self.outage_buffer.clear()
+
+        if messages:
+            logger.info("Sending %s messages buffered while disconnected", len(messages))
+
+        for index, (key, body, properties) in enumerate(messages):
+            try:
+                self.channel.basic_publish(
+                    exchange=self.config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC,
+                    routing_key=key,
+                    properties=properties,
+                    body=body)
+            except pika.exceptions.AMQPError:
+                with self.outage_lock:
+                    self.outage_buffer.extendleft(reversed(messages[index:]))
+                raise
+
+    @staticmethod
+    def encode_message(payload, content_type=None, properties=None) -> tuple:
+        """
+        Encodes the payload of an outgoing message and sets its content type on the message properties.
+        :param payload:
+        :param content_type:
+        :param properties: Optional pika.BasicProperties to set the content type on.
+        :return: Tuple of body and properties.
+        """
+        body, content_type = encode_payload(payload, content_type)
+        if content_type:
+            if properties is None:
+                properties = pika.BasicProperties(content_type=content_type)
+            elif properties.content_type is None:
+                properties.content_type = content_type
+        return body, properties
+
+    def message_send_buffered(self, key, payload, properties=None, content_type=None) -> Future:
+        """
+        Buffers the message to be published with the next batch and returns immediately.
+        Batches are published with publisher confirms, see BatchPublisher. Can be called from any thread.
+        In case the connection of the publisher was lost, a new publisher is started.
+        :param key:
+        :param payload: Bytes, text, a Payload to forward or any value to encode by the codec of the content type.
+        :param properties: Optional pika.BasicProperties of the message.
+        :param content_type: The content type of the message. See encode_payload for the default.
+        :return: A future completed as soon as the broker has confirmed the message.
+        """
+        body, properties = self.encode_message(payload, content_type, properties)
+
+        if self.publisher is None or self.publisher.is_stopped():
+            with self.publisher_lock:
+                if self.publisher is None or self.publisher.is_stopped():
+                    publisher = BatchPublisher(self)
+                    publisher.start()
+                    self.publisher = publisher
+
+        return self.publisher.send(key, body, properties)
+
+    def message_send_batch(self, messages, timeout=None) -> list:
+        """
+        Sends all given messages in batches and waits until the broker has confirmed them.
+        :param messages: Iterable of (key, payload) tuples.
+        :param timeout: Max seconds to wait for each confirmation.
+        :return: For each message in the same order: None if it was confirmed, otherwise the error.
+        """
+        futures = [self.message_send_buffered(key, payload) for key, payload in messages]
+        if self.publisher:
+            self.publisher.flush()
+
+        return [wait_for_error(future, timeout) for future in futures]
+
+    def message_send_and_wait(self, key, payload, timeout=None):
+        """
+        Sends the message to given routing key and waits for response.
+        Can be called from any thread and by many threads at the same time. Incoming messages are
+        not blocked while waiting, since the response is received on a dedicated reply queue.
+        In case the connection of the reply queue was lost, a new one is opened.
+        :param key:
+        :param payload:
+        :param timeout: Max seconds to wait for the response. Defaults to PIPEFORCE_MESSAGING_REPLY_TIMEOUT.
+        :return: The body of the response message.
+        """
+        if self.reply_consumer is None or self.reply_consumer.is_stopped():
+            with self.reply_consumer_lock:
+                if self.reply_consumer is None or self.reply_consumer.is_stopped():
+                    reply_consumer = ReplyConsumer(self)
+                    reply_consumer.start()
+                    self.reply_consumer = reply_consumer
+
+        if timeout is None:
+            timeout = self.config.PIPEFORCE_MESSAGING_REPLY_TIMEOUT
+
+        return self.reply_consumer.request(key, payload, timeout)
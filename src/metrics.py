@@ -0,0 +1,266 @@
+import cProfile
+import io
+import pstats
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Default histogram buckets in seconds, for handler and hub latencies
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Histogram buckets in seconds for operations in the range of microseconds, like routing key lookups
+MICRO_BUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001)
+
+
+class Metrics:
+    """
+        Collects counters and latency histograms of the client in memory and renders them in the
+        Prometheus text format. Labels are given as tuple of (name, value) pairs.
+        Hooks registered by add_hook are called for each recorded value, for example to forward
+        them to another monitoring system. Collectors registered by add_collector are called on
+        rendering and return additional samples as list of (name, labels, value) tuples.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.buckets = {}
+        self.hooks = []
+        self.collectors = []
+
+    def inc(self, name, labels=(), value=1):
+        """
+        Increments the counter with given name and labels.
+        :param name:
+        :param labels:
+        :param value:
+        :return:
+        """
+        if not self.enabled:
+            return
+
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+        for hook in self.hooks:
+            hook("counter", name, labels, value)
+
+    def observe(self, name, seconds, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        Records the duration in the histogram with given name and labels.
+        :param name:
+        :param seconds:
+        :param labels:
+        :param buckets: The upper bounds of the histogram buckets. Only used on first observation of the metric.
+        :return:
+        """
+        if not self.enabled:
+            return
+
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                bounds = self.buckets.setdefault(name, buckets)
+                histogram = self.histograms[key] = [[0] * len(bounds), 0.0, 0]
+
+            bounds = self.buckets[name]
+            for i, bound in enumerate(bounds):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += seconds
+            histogram[2] += 1
+
+        for hook in self.hooks:
+            hook("histogram", name, labels, seconds)
+
+    def add_hook(self, hook):
+        """
+        Registers a hook called as hook(kind, name, labels, value) for each recorded value.
+        :param hook:
+        :return:
+        """
+        self.hooks.append(hook)
+
+    def add_collector(self, collector):
+        """
+        Registers a collector which returns additional samples as list of (name, labels, value) tuples on rendering.
+        :param collector:
+        :return:
+        """
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        """
+        Returns all metrics in the Prometheus text format.
+        :return:
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(value[0]), value[1], value[2]) for key, value in self.histograms.items()}
+
+        lines = []
+        for (name, labels), value in sorted(counters.items()):
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets[name], counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels) -> str:
+    """
+    Formats the labels in the Prometheus text format.
+    :param labels:
+    :return:
+    """
+    if not labels:
+        return ""
+
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Profiler:
+    """
+        Profiles a random sample of service method calls and aggregates the results.
+        With a sample rate of 0, calls are not profiled at all.
+    """
+
+    def __init__(self, sample_rate=0.0):
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        self.stats = None
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls the given function and profiles it in case it was sampled.
+        :param func:
+        :param args:
+        :param kwargs:
+        :return: The result of the function.
+        """
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return func(*args, **kwargs)
+
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            with self.lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+
+    def render(self, limit=50) -> str:
+        """
+        Returns the aggregated profile sorted by cumulative time.
+        :param limit: Max number of functions to list.
+        :return:
+        """
+        with self.lock:
+            if self.stats is None:
+                return "No profiled calls yet.\n"
+
+            output = io.StringIO()
+            self.stats.stream = output
+            self.stats.sort_stats("cumulative").print_stats(limit)
+            return output.getvalue()
+
+
+class MetricsServer:
+    """
+        Lightweight HTTP server running on a background thread which exposes the metrics at /metrics
+        and the sampled profile at /profile.
+    """
+
+    def __init__(self, metrics: Metrics, profiler: Profiler, port: int, host: str = "0.0.0.0"):
+        self.metrics = metrics
+        self.profiler = profiler
+        self.server = ThreadingHTTPServer((host, port), self.create_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def port(self) -> int:
+        """
+        Returns the port the server is listening on.
+        :return:
+        """
+        return self.server.server_address[1]
+
+    def create_handler(self):
+        """
+        Creates the request handler class bound to this server.
+        :return:
+        """
+        metrics_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """
+                Serves the metrics and the profile.
+            """
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """
+                Answers the request.
+                :return:
+                """
+                if self.path == "/metrics":
+                    body = metrics_server.metrics.render().encode("utf-8")
+                    content_type = "text/plain; version=0.0.4; charset=utf-8"
+                elif self.path == "/profile":
+                    body = metrics_server.profiler.render().encode("utf-8")
+                    content_type = "text/plain; charset=utf-8"
+                else:
+                    self.send_error(404)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                """
+                Does not log each scrape.
+                :return:
+                """
+
+        return Handler
+
+    def start(self):
+        """
+        Starts serving on the background thread.
+        :return:
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever, name="pipeforce-metrics", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops the server.
+        :return:
+        """
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,337 @@
+import codecs
+import inspect
+import json
+import typing
+from operator import attrgetter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # pylint: disable=invalid-name
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None  # pylint: disable=invalid-name
+
+
+class JsonCodec:
+    """
+        Encodes and decodes JSON. Uses orjson in case it is installed, otherwise the json module.
+    """
+
+    def encode(self, value) -> bytes:
+        """
+        Encodes the value as JSON.
+        :param value:
+        :return:
+        """
+        if orjson:
+            return orjson.dumps(value)
+        return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+    def decode(self, data):
+        """
+        Decodes the JSON data.
+        :param data: Bytes-like object.
+        :return:
+        """
+        if orjson:
+            return orjson.loads(data)
+        return json.loads(bytes(data) if isinstance(data, memoryview) else data)
+
+
+class MsgpackCodec:
+    """
+        Encodes and decodes MessagePack. Requires the msgpack package to be installed.
+    """
+
+    def encode(self, value) -> bytes:
+        """
+        Encodes the value as MessagePack.
+        :param value:
+        :return:
+        """
+        return self.module().packb(value)
+
+    def decode(self, data):
+        """
+        Decodes the MessagePack data.
+        :param data: Bytes-like object.
+        :return:
+        """
+        return self.module().unpackb(data)
+
+    @staticmethod
+    def module():
+        """
+        Returns the msgpack module or raises an ImportError in case it is not installed.
+        :return:
+        """
+        if msgpack is None:
+            raise ImportError("Package msgpack is required for MessagePack payloads: pip install msgpack")
+        return msgpack
+
+
+class TextCodec:
+    """
+        Encodes and decodes UTF-8 text.
+    """
+
+    def encode(self, value) -> bytes:
+        """
+        Encodes the value as UTF-8 text.
+        :param value:
+        :return:
+        """
+        return str(value).encode("utf-8")
+
+    def decode(self, data) -> str:
+        """
+        Decodes the UTF-8 text.
+        :param data: Bytes-like object.
+        :return:
+        """
+        return str(data, "utf-8")
+
+
+class BytesCodec:
+    """
+        Passes raw bytes through. Decoding returns a memoryview on the message body, so nothing is copied.
+    """
+
+    def encode(self, value) -> bytes:
+        """
+        Returns the value as bytes.
+        :param value: Bytes-like object.
+        :return:
+        """
+        return bytes(value)
+
+    def decode(self, data) -> memoryview:
+        """
+        Returns a memoryview on the data.
+        :param data: Bytes-like object.
+        :return:
+        """
+        return memoryview(data)
+
+
+# The codecs by content type, extend it using register_codec
+_codecs = {
+    "application/json": JsonCodec(),
+    "application/msgpack": MsgpackCodec(),
+    "application/x-msgpack": MsgpackCodec(),
+    "text/plain": TextCodec(),
+    "application/octet-stream": BytesCodec(),
+}
+
+
+def register_codec(content_type: str, codec):
+    """
+    Registers the codec to use for messages with given content type.
+    :param content_type: The MIME type, for example application/cbor.
+    :param codec: Object with methods encode(value) -> bytes and decode(data).
+    :return:
+    """
+    _codecs[content_type.lower()] = codec
+
+
+def get_codec(content_type: str):
+    """
+    Returns the codec for the given content type. Parameters like charset are ignored.
+    :param content_type:
+    :return:
+    """
+    mime_type = content_type.split(";", 1)[0].strip().lower()
+    codec = _codecs.get(mime_type)
+    if codec is None:
+        raise ValueError(f"No codec registered for content type: {content_type}")
+    return codec
+
+
+class Payload:
+    """
+        The body of a message together with its content type. The body is decoded on first access
+        of value only and the result is shared between all service methods of the message, so service
+        methods which only forward the payload never pay for decoding.
+    """
+
+    __slots__ = ("body", "content_type", "_value")
+
+    _NOT_DECODED = object()
+
+    def __init__(self, body, content_type: str = None):
+        """
+        :param body: The raw message body.
+        :param content_type: The content type of the body.
+        """
+        self.body = body
+        self.content_type = content_type
+        self._value = Payload._NOT_DECODED
+
+    def __reduce__(self):
+        # Only the raw body is sent to process pool workers, they decode on their own
+        return Payload, (self.body, self.content_type)
+
+    @property
+    def view(self) -> memoryview:
+        """
+        Returns a memoryview on the raw body without copying it.
+        :return:
+        """
+        return memoryview(self.body)
+
+    @property
+    def text(self) -> str:
+        """
+        Returns the body decoded as UTF-8 text.
+        :return:
+        """
+        return str(self.body, "utf-8")
+
+    @property
+    def value(self):
+        """
+        Returns the body decoded by the codec of its content type. Decodes once only.
+        :return:
+        """
+        if self._value is Payload._NOT_DECODED:
+            self._value = get_codec(self.content_type or "application/octet-stream").decode(self.body)
+        return self._value
+
+
+def encode_payload(payload, content_type: str = None) -> tuple:
+    """
+    Encodes the payload of an outgoing message.
+    Bytes are sent as they are, a Payload is forwarded with its content type without encoding it again,
+    strings are sent as text/plain and all other values are encoded by the codec of the given content type.
+    :param payload:
+    :param content_type: The content type to send. Defaults to application/json for values which are not text.
+    :return: Tuple of body and content type. The content type is None for bytes without given content type.
+    """
+    if isinstance(payload, Payload):
+        return payload.body, content_type or payload.content_type
+    if isinstance(payload, (bytes, bytearray)):
+        return payload, content_type
+    if isinstance(payload, memoryview):
+        return bytes(payload), content_type
+    if isinstance(payload, str) and content_type is None:
+        return payload.encode("utf-8"), "text/plain"
+
+    content_type = content_type or "application/json"
+    return get_codec(content_type).encode(payload), content_type
+
+
+# Characters which may follow an item of a JSON array
+JSON_DELIMITERS = frozenset(" \t\r\n,]")
+
+
+def iter_json_items(chunks):
+    """
+    Parses a JSON array incrementally from the given chunks of bytes and yields each item as soon as it is complete,
+    so the whole document is never loaded into memory. Any other JSON value is yielded as single item.
+    :param chunks: Iterable of bytes.
+    :return:
+    """
+    chunks = iter(chunks)
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+
+    buffer = ""
+    for chunk in chunks:
+        buffer = (buffer + text_decoder.decode(chunk)).lstrip()
+        if buffer:
+            break
+    if not buffer:
+        return
+
+    if buffer[0] != "[":
+        # Not an array, so there is nothing to yield before the end
+        rest = "".join(text_decoder.decode(chunk) for chunk in chunks) + text_decoder.decode(b"", final=True)
+        yield json.loads(buffer + rest)
+        return
+
+    position = 1
+    exhausted = False
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+
+        if position < len(buffer):
+            if buffer[position] == "]":
+                return
+
+            decoded = _decode_item(decoder, buffer, position, exhausted)
+            if decoded:
+                item, position = decoded
+                yield item
+                continue
+        elif exhausted:
+            raise ValueError("Unexpected end of JSON array")
+
+        chunk = next(chunks, None)
+        exhausted = chunk is None
+        buffer = buffer[position:] + text_decoder.decode(chunk or b"", final=exhausted)
+        position = 0
+
+
+def _decode_item(decoder, buffer, position, exhausted):
+    """
+    Decodes the item of a JSON array starting at the given position of the buffer.
+    :param decoder:
+    :param buffer:
+    :param position:
+    :param exhausted: True in case the buffer contains the rest of the document.
+    :return: Tuple of the item and its end or None in case the item might continue in the next chunk.
+    """
+    try:
+        item, end = decoder.raw_decode(buffer, position)
+    except json.JSONDecodeError:
+        if exhausted:
+            raise
+        return None
+
+    # An item is complete once a delimiter follows, since a number like 1500.5 might continue in the next chunk
+    if end < len(buffer) and buffer[end] in JSON_DELIMITERS or exhausted and end == len(buffer):
+        return item, end
+    if exhausted:
+        raise json.JSONDecodeError("Expecting ',' delimiter", buffer, end)
+    return None
+
+
+def payload_converter(func, batch=False):
+    """
+    Returns the function converting a Payload into the argument expected by given service method.
+    The type is taken from the annotation of the first parameter after self:
+    Payload gets the payload itself, memoryview the raw body without copy, str the body as text and
+    bytes or no annotation the raw body. Any other annotation, like dict or list, gets the decoded value.
+    :param func: The service method, bound or unbound.
+    :param batch: The service method gets a list of payloads, so the type is taken from the annotation list[T].
+        Without T, the items are the raw bodies.
+    :return:
+    """
+    parameters = list(inspect.signature(func).parameters.values())
+    if parameters and parameters[0].name == "self":
+        parameters = parameters[1:]
+    if not parameters:
+        return attrgetter("body")
+
+    try:
+        annotation = typing.get_type_hints(func).get(parameters[0].name, inspect.Parameter.empty)
+    except (NameError, TypeError):
+        annotation = parameters[0].annotation
+
+    if batch:
+        args = typing.get_args(annotation) if typing.get_origin(annotation) is list else ()
+        annotation = args[0] if args else inspect.Parameter.empty
+
+    if annotation is Payload:
+        return lambda payload: payload
+    if annotation is memoryview:
+        return attrgetter("view")
+    if annotation is str:
+        return attrgetter("text")
+    if annotation in (inspect.Parameter.empty, bytes):
+        return attrgetter("body")
+    return attrgetter("value")
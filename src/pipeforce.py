@@ -1,28 +1,55 @@
 # pylint: disable=E0401
+import asyncio
 import hashlib
 import inspect
-import pkgutil
-import random
-import re
-import string
+import logging
+import threading
 import time
-from importlib import import_module
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 
 import pika
-import requests
+from pika.adapters.asyncio_connection import AsyncioConnection
 
+from src.batches import BatchMixin
+from src.cache import CommandCache
 from src.config import Config
-
-
-class PipeforceClient:
+from src.events import (  # pylint: disable=unused-import
+    batch_event, event, find_event_mappings, read_event_manifest, write_event_manifest)
+from src.handlers import HandlerMixin
+from src.hub import HubClientMixin
+from src.idempotency import IdempotencyMixin
+from src.lanes import LaneMixin
+from src.logs import get_logger, setup_logging
+from src.messaging import MessagingMixin, backoff_delay
+from src.metrics import MICRO_BUCKETS, Metrics, MetricsServer, Profiler
+from src.payloads import Payload
+from src.publisher import PublishError
+from src.replies import ReplyConsumer  # pylint: disable=unused-import
+from src.retries import RetryMixin, retry_queue_declarations
+from src.tokens import TokenManager
+from src.topics import pattern_index, pattern_labels
+from src.workers import init_process_worker, run_in_process_worker
+
+logger = get_logger()
+
+# Seconds between checks whether draining was requested
+DRAIN_CHECK_INTERVAL = 0.5
+
+
+class PipeforceClient(  # pylint: disable=too-many-public-methods,too-many-instance-attributes
+        MessagingMixin, RetryMixin, IdempotencyMixin, LaneMixin, BatchMixin, HandlerMixin, HubClientMixin):
     """
         Messaging client to communicate with hub and other microservices inside PIPEFORCE.
         It supports async and sync message processing.
     """
 
-    def __init__(self, config: Config):
+    def __init__(self, config: Config):  # pylint: disable=too-many-statements
 
         self.config = config
+        setup_logging(self.config.PIPEFORCE_LOG_LEVEL, self.config.PIPEFORCE_LOG_FORMAT)
 
         if not self.config.PIPEFORCE_NAMESPACE and not config.PIPEFORCE_INSTANCE:
             raise ValueError("Config PIPEFORCE_NAMESPACE or PIPEFORCE_INSTANCE is required!")
@@ -59,106 +86,427 @@ class PipeforceClient:
                     v = str(hashlib.md5(str(value).encode('utf-8')).hexdigest())[0:5]
                     value = "[MD5:" + v + "...]"
 
-                print(name + ": " + str(value))
-
-        # If in sync mode blocks all messages until it gets a response from the server
-        self.sync_mode = False
+                logger.info("%s: %s", name, value)
 
-        self.response = None
-        self.correlation_id = ''.join(random.choice(string.ascii_uppercase + string.digits) for i in range(10))
         self.connection = None
         self.channel = None
-        self.mappings = None
-
-        # The timestamp in seconds when the last token was requested
-        self.last_token_timestamp: int = None
-
-        # The last response from a refresh request
-        self.last_token_response = None
+        # The thread the connection was opened on, the only one allowed to use the channel
+        self.connection_thread = None
+        # The event mappings as list of (key, "module.Class#method") tuples
+        self.mappings = []
+        self.routing_index = None
+        # The lanes of service methods with their own priority or concurrency and the lanes by consumer tag
+        self.lanes = []
+        self.consumer_lanes = {}
+
+        # Resolved handler callables by mapping value and shared service instances by class
+        self.handlers = {}
+        # Functions converting the Payload of a message into the argument type declared by the handler
+        self.payload_converters = {}
+        self.batch_converters = {}
+        self.service_instances = {}
+        self.handlers_lock = threading.Lock()
+
+        # Sends requests and receives their responses for message_send_and_wait. Started on first use.
+        self.reply_consumer = None
+        self.reply_consumer_lock = threading.Lock()
+
+        # Publishes messages in batches with publisher confirms. Started on first use.
+        self.publisher = None
+        self.publisher_lock = threading.Lock()
+
+        # The pool to execute service methods in. None executes them on the connection thread.
+        self.executor = None
+
+        # Set by request_drain to stop receiving messages once the messages in-flight have been processed
+        self.draining = False
+        # Set by stop_consuming, so a closed connection is not reconnected
+        self.stopped = False
+
+        # Keys of the messages processed recently to skip duplicates. None unless PIPEFORCE_MESSAGING_DEDUP is set.
+        # The keys of messages still being processed by this instance are kept in flight as well.
+        self.idempotency_store = self.create_idempotency_store()
+        self.keys_in_flight = set()
+        self.dedup_lock = threading.Lock()
+
+        # Messages sent by message_send while the connection is lost, published after reconnecting
+        self.outage_buffer = deque()
+        self.outage_lock = threading.Lock()
+
+        # Connection pools to the hub shared by all threads. Each thread gets its own session mounting a pool.
+        # Uploads from iterators use the one without status retries, since they can not be sent again.
+        self.http_adapter = self.create_http_adapter()
+        self.upload_http_adapter = self.create_http_adapter(retry_status=False)
+        self.http_local = threading.local()
+
+        # Executes the commands of run_commands concurrently. Started on first use.
+        self.hub_executor = None
+        self.hub_executor_lock = threading.Lock()
+
+        # Caches the access token and refreshes it ahead of expiry
+        self.token_manager = TokenManager(self)
+
+        # Instrumentation of the hot paths, optionally exposed via HTTP
+        self.metrics = Metrics(enabled=self.config.PIPEFORCE_METRICS_ENABLED)
+        self.metrics.add_collector(lambda: [(f"pipeforce_token_{name}_total", (), value)
+                                            for name, value in self.token_manager.metrics().items()])
+        self.profiler = Profiler(sample_rate=self.config.PIPEFORCE_METRICS_PROFILE_SAMPLE_RATE)
+        self.metrics_server = None
+
+        # Results of the commands listed in PIPEFORCE_HUB_CACHE_COMMANDS, see run_command
+        self.command_cache = CommandCache(self.config.PIPEFORCE_HUB_CACHE_TTL, self.config.PIPEFORCE_HUB_CACHE_SIZE,
+                                          self.metrics)
+        self.cached_commands = {name.strip() for name in self.config.PIPEFORCE_HUB_CACHE_COMMANDS.split(",")
+                                if name.strip()}
 
     def start_consuming(self):
         """
         Starts the client and consumes for new incoming messages.
-        Blocks while consuming.
+        Blocks while consuming. In case the connection to the message broker is lost, reconnects with
+        exponential backoff between PIPEFORCE_MESSAGING_RECONNECT_DELAY and PIPEFORCE_MESSAGING_RECONNECT_MAX_DELAY
+        seconds. Unacknowledged messages are redelivered by the broker after reconnecting.
         :return:
         """
-        self.mappings = self.find_event_mappings()
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.config.PIPEFORCE_MESSAGING_HOST))
+        self.load_mappings()
+        self.start_metrics_server()
+        # With lanes, the connection thread only dispatches and settles, so slow service methods of the
+        # service queue cannot hold up the deliveries and acks of the lanes
+        workers = self.config.PIPEFORCE_MESSAGING_WORKERS
+        self.executor = self.create_executor(max(workers, 1) if self.lanes else workers)
+        self.create_lane_executors()
+
+        attempt = 0
+        connected = False
+        while True:
+            try:
+                self.connect()
+                attempt = 0
+                connected = True
+                logger.info("Receiving messages...")
+                self.channel.start_consuming()
+                break
+            except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as error:
+                if self.stopped or self.draining:
+                    break
+
+                max_attempts = self.config.PIPEFORCE_MESSAGING_RECONNECT_ATTEMPTS
+                if 0 < max_attempts <= attempt:
+                    raise
+
+                delay = backoff_delay(attempt, self.config.PIPEFORCE_MESSAGING_RECONNECT_DELAY,
+                                      self.config.PIPEFORCE_MESSAGING_RECONNECT_MAX_DELAY)
+                attempt += 1
+                self.log_reconnect(error, delay, attempt, connected)
+                if not self.wait_before_reconnect(delay):
+                    break
+
+        if self.draining:
+            self.finish_in_flight()
+            self.stop_consuming()
+            logger.info("Drained and stopped")
+
+    def connect(self):
+        """
+        Opens the connection and channel to the message broker, declares exchange, queue and bindings of the
+        loaded mappings and publishes the messages buffered while the connection was lost.
+        Called again on each reconnect.
+        :return:
+        """
+        self.connection_thread = threading.get_ident()
+        self.connection = self.create_connection()
         self.channel = self.connection.channel()
         self.setup_queues(self.channel)
         self.setup_consumers(self.channel)
-        print("Receiving messages...")
-        self.channel.start_consuming()
+        self.reset_batches()
+        self.setup_lanes(self.channel)
+        self.connection.call_later(DRAIN_CHECK_INTERVAL, self.check_drain)
+        self.flush_outage_buffer()
+
+    def wait_before_reconnect(self, delay) -> bool:
+        """
+        Sleeps the given seconds or until draining or stop was requested.
+        :param delay:
+        :return: True in case the client should reconnect.
+        """
+        deadline = time.monotonic() + delay
+        while not (self.draining or self.stopped):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            time.sleep(min(remaining, DRAIN_CHECK_INTERVAL))
+        return False
+
+    def request_drain(self):
+        """
+        Requests to stop receiving new messages and to stop the client as soon as all messages in-flight
+        have been processed and acknowledged. Safe to be called from signal handlers and any thread.
+        :return:
+        """
+        self.draining = True
+
+    def check_drain(self):
+        """
+        Stops consuming once draining was requested, otherwise checks again later. Runs on the connection thread.
+        :return:
+        """
+        if self.draining:
+            logger.info("Draining: Stopped receiving messages, waiting for messages in-flight")
+            self.channel.stop_consuming()
+        else:
+            self.connection.call_later(DRAIN_CHECK_INTERVAL, self.check_drain)
+
+    def finish_in_flight(self):
+        """
+        Waits until the worker pool has processed all messages in-flight and sends their acknowledgements.
+        Batches being collected are passed on first.
+        :return:
+        """
+        self.flush_batches()
+        for executor in [self.executor] + self.lane_executors():
+            if executor:
+                executor.shutdown(wait=True)
+        try:
+            self.connection.process_data_events(time_limit=0)
+        except pika.exceptions.AMQPConnectionError as error:
+            logger.warning("Connection lost while draining, unacked messages will be redelivered: %r", error)
+
+    def start_metrics_server(self):
+        """
+        Starts the HTTP server exposing /metrics and /profile in case PIPEFORCE_METRICS_PORT is set.
+        :return:
+        """
+        if self.config.PIPEFORCE_METRICS_PORT <= 0 or self.metrics_server:
+            return
+
+        self.metrics_server = MetricsServer(self.metrics, self.profiler, self.config.PIPEFORCE_METRICS_PORT)
+        self.metrics_server.start()
+        logger.info("Serving metrics on port %s", self.metrics_server.port)
+
+    def create_executor(self, workers=None):
+        """
+        Creates the worker pool to execute service methods in, depending on PIPEFORCE_MESSAGING_WORKERS
+        and PIPEFORCE_MESSAGING_WORKER_TYPE. Returns None in case service methods should be executed
+        directly on the connection thread.
+        :param workers: The number of workers. Defaults to PIPEFORCE_MESSAGING_WORKERS.
+        :return:
+        """
+        if workers is None:
+            workers = self.config.PIPEFORCE_MESSAGING_WORKERS
+        if workers <= 0:
+            return None
+
+        if self.config.PIPEFORCE_MESSAGING_WORKER_TYPE == "process":
+            return ProcessPoolExecutor(max_workers=workers, initializer=init_process_worker,
+                                       initargs=(type(self), self.config))
+
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pipeforce-worker")
+
+    def connection_parameters(self) -> pika.ConnectionParameters:
+        """
+        Returns the parameters to connect to the message broker.
+        :return:
+        """
+        return pika.ConnectionParameters(
+            host=self.config.PIPEFORCE_MESSAGING_HOST,
+            port=int(self.config.PIPEFORCE_MESSAGING_PORT),
+            credentials=pika.PlainCredentials(self.config.PIPEFORCE_MESSAGING_USERNAME,
+                                              self.config.PIPEFORCE_MESSAGING_PASSWORD),
+            heartbeat=self.config.PIPEFORCE_MESSAGING_HEARTBEAT,
+            blocked_connection_timeout=self.config.PIPEFORCE_MESSAGING_BLOCKED_TIMEOUT or None)
 
     def stop_consuming(self):
         """
         Stops the client and closes any connection to the message broker.
         :return:
         """
-        self.connection.close()
+        self.stopped = True
+        for executor in [self.executor] + self.lane_executors():
+            if executor:
+                executor.shutdown(wait=False)
+        self.close_resources()
+        if self.connection.is_open:
+            self.connection.close()
+
+    def close_resources(self):
+        """
+        Stops the hub worker pool, the metrics server, the reply consumer, the publisher and background refreshes
+        of the access token. Shared by the sync and async client.
+        :return:
+        """
+        if self.hub_executor:
+            self.hub_executor.shutdown(wait=False)
+        if self.metrics_server:
+            self.metrics_server.stop()
+        if self.reply_consumer:
+            self.reply_consumer.stop()
+        if self.publisher:
+            self.publisher.close()
+        self.token_manager.stop()
 
     # Adding this to disabled config .pylintrc W0613 didnt work so adding the ignore marker here:
     # pylint: disable=unused-argument
     def dispatch_message(self, channel, method, props, body):
         """
         Callback which dispatches all incoming messages.
-        If the client is in sync_mode, the correlation_id of the current message is checked. If it matches,
-        the current message is treated as a response of a (blocking) request call and is set as response.
-        Otherwise the incoming message is forwarded to a mapped service function.
-        Any receiving message during a blocking sync call which is not the response message is re-queued
-        by rejecting it. So it will be delivered again.
+        The incoming message is forwarded to all mapped service functions and acknowledged once they have completed.
+        In case a service function fails, the others are executed anyway and the message is retried, see RetryMixin.
+        In case a worker pool is configured, the service functions are executed inside the pool and
+        the message is settled from the connection thread once they have completed.
+        Messages of a lane are dispatched to the service functions and worker pool of this lane.
+        Duplicates of processed messages are acknowledged without executing them, see IdempotencyMixin.
+        Messages of a batch lane are collected into batches, see BatchMixin.
         :param channel:
         :param method:
         :param props:
         :param body:
         :return:
         """
+        routing_key = self.message_routing_key(method, props)
+        lane = self.consumer_lane(method)
+        executor = lane.executor if lane else self.executor
 
-        # RPC response -> no service mapping
-        if self.sync_mode:
-            if props.correlation_id == self.correlation_id:
-                self.channel.basic_ack(method.delivery_tag)
-                self.response = body
-                print("Dispatching: Response message received: correlation_id=" + self.correlation_id +
-                      ", routing_key=" + method.routing_key)
-                return
+        # Map message to service
+        start = time.perf_counter()
+        matches = self.retried_matches((lane or self).routing_index.match(routing_key), props)
+        self.metrics.observe("pipeforce_routing_lookup_seconds", time.perf_counter() - start, buckets=MICRO_BUCKETS)
+        self.metrics.inc("pipeforce_messages_received_total", pattern_labels(matches))
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received message: %s", routing_key, extra={
+                "routing_key": routing_key, "correlation_id": getattr(props, "correlation_id", None)})
+
+        if not matches:
+            logger.warning("Incoming message did not match any service: %s", routing_key,
+                           extra={"routing_key": routing_key})
+            self.metrics.inc("pipeforce_messages_unmatched_total")
+            self.ack(channel, method.delivery_tag)
+            return
 
-            # Put message back to queue since we're waiting for the response message
-            self.channel.basic_reject(method.delivery_tag)
-            print("Dispatching: Message rejected to queue (waiting for response message): " + method.routing_key)
+        if not self.claim_message(channel, method, props, body, matches):
             return
 
-        # Map message to service
-        found = False
-        for key, value in self.mappings.items():
-            if self.amqp_match(method.routing_key, key):
-                found = True
-                self.channel.basic_ack(method.delivery_tag)
-                print(f"Dispatching message: {method.routing_key} -> {key} -> {value}()")
+        payload = Payload(body, getattr(props, "content_type", None) or self.config.PIPEFORCE_MESSAGING_CONTENT_TYPE)
+
+        if lane is not None and lane.batch:
+            self.collect_batch(lane, channel, method, props, body, payload)
+            return
 
-                class_path, method_name = value.rsplit('#', 1)
-                module_path, class_name = class_path.rsplit('.', 1)
+        if executor is None:
+            self.settle_message(channel, method, props, body, self.run_handlers(routing_key, matches, payload))
+            return
 
-                module = import_module(module_path)
+        if isinstance(executor, ProcessPoolExecutor):
+            future = executor.submit(run_in_process_worker, routing_key, matches, payload)
+        else:
+            future = executor.submit(self.run_handlers, routing_key, matches, payload)
 
-                clazz = getattr(module, class_name)
-                service_instance = clazz(self)
+        future.add_done_callback(partial(self.on_handlers_done, channel, method, props, body))
 
-                service_meth = getattr(service_instance, method_name)
-                service_meth(body)  # Execute service function
+    def run_handlers(self, routing_key, matches, payload: Payload) -> list:
+        """
+        Executes the service functions of all given matches in order.
+        Each service function gets the payload converted into the type declared by its body parameter.
+        A failing service function does not stop the following ones.
+        :param routing_key:
+        :param matches: List of (pattern, value) tuples as returned by the routing index.
+        :param payload: The body of the message.
+        :return: List of (value, error) tuples of the failed service functions.
+        """
+        message_start = time.perf_counter()
+        failures = []
+
+        for key, value in matches:
+            labels = (("handler", value),)
+            start = time.perf_counter()
+            try:
+                handler = self.handlers.get(value) or self.resolve_handler(value)
+                convert = self.payload_converters.get(value)
+                self.profiler.call(handler, convert(payload) if convert else payload.body)  # Execute service function
+            except Exception as error:  # pylint: disable=broad-except
+                self.metrics.inc("pipeforce_handler_errors_total", labels)
+                logger.error("Service %s failed for message %s: %r", value, routing_key, error, exc_info=error,
+                             extra={"routing_key": routing_key, "handler": value})
+                failures.append((value, repr(error)))
+            finally:
+                duration = time.perf_counter() - start
+                self.metrics.observe("pipeforce_handler_duration_seconds", duration, labels)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Dispatched message: %s -> %s -> %s()", routing_key, key, value, extra={
+                        "routing_key": routing_key, "handler": value, "duration_ms": round(duration * 1000, 3)})
+
+        self.metrics.observe("pipeforce_message_duration_seconds", time.perf_counter() - message_start,
+                             pattern_labels(matches))
+        return failures
+
+    def on_handlers_done(self, channel, method, props, body, future):  # pylint: disable=too-many-arguments
+        """
+        Called inside the worker pool after the service functions of a message have completed.
+        Schedules settling the message on the connection thread, since pika channels are not thread-safe.
+        :param channel:
+        :param method:
+        :param props:
+        :param body:
+        :param future: Its result are the failures as returned by run_handlers.
+        :return:
+        """
+        error = future.exception()
+        if error:
+            logger.error("Worker failed for message %s: %r", method.routing_key, error, exc_info=error,
+                         extra={"routing_key": method.routing_key})
+            failures = None
+        else:
+            failures = future.result()
 
-        if not found:
-            print("Dispatching: Warning: Incoming message did not match any service: " + method.routing_key)
+        try:
+            self.connection.add_callback_threadsafe(partial(self.settle_message, channel, method, props, body,
+                                                            failures))
+        except pika.exceptions.AMQPError:
+            logger.warning("Connection lost, message %s will be redelivered", method.routing_key,
+                           extra={"routing_key": method.routing_key})
+            self.finish_message(method, props, body, failures == [])
+
+    def ack(self, channel, delivery_tag):
+        """
+        Acknowledges the message and counts it. Must be called on the connection thread.
+        In case the channel was closed meanwhile, the broker redelivers the message instead.
+        :param channel:
+        :param delivery_tag:
+        :return:
+        """
+        try:
+            channel.basic_ack(delivery_tag)
+        except pika.exceptions.AMQPError as error:
+            logger.warning("Could not ack message %s, it will be redelivered: %r", delivery_tag, error)
+            return
+        self.metrics.inc("pipeforce_messages_acked_total")
+
+    def reject(self, channel, delivery_tag, requeue=False):
+        """
+        Rejects the message and counts it. Must be called on the connection thread.
+        :param channel:
+        :param delivery_tag:
+        :param requeue:
+        :return:
+        """
+        try:
+            channel.basic_reject(delivery_tag, requeue=requeue)
+        except pika.exceptions.AMQPError as error:
+            logger.warning("Could not reject message %s, it will be redelivered: %r", delivery_tag, error)
+            return
+        self.metrics.inc("pipeforce_messages_rejected_total")
 
     def setup_queues(self, channel):
         """
-        Sets up all default queues to listen on the default exchange.
+        Sets up all default queues to listen on the default exchange. Declarations are idempotent,
+        so they are repeated on each reconnect in case the broker has lost them.
         :param channel:
         :return:
         """
         channel.exchange_declare(exchange=self.config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC, exchange_type='topic')
-        channel.queue_declare(queue=self.self.config.PIPEFORCE_MESSAGING_QUEUE, durable=True, exclusive=False,
-                              auto_delete=True)
+        channel.queue_declare(queue=self.config.PIPEFORCE_MESSAGING_QUEUE, durable=True, exclusive=False,
+                              auto_delete=False)
+        for declaration in retry_queue_declarations(self.config):
+            channel.queue_declare(**declaration)
 
     def setup_consumers(self, channel):
         """
@@ -168,194 +516,458 @@ class PipeforceClient:
         :return:
         """
 
-        for key, value in self.mappings.items():
-            print(f'Creating Binding: {key} -> {value}() ')
+        for key, value in self.mappings:
+            logger.info("Creating binding: %s -> %s()", key, value)
 
+        for key in self.binding_keys():
             # Set the routing rules at the broker
             channel.queue_bind(
                 exchange=self.config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC, queue=self.config.PIPEFORCE_MESSAGING_QUEUE,
                 routing_key=key)
 
+        # Limit the unacked messages in flight, so bursts do not pile up in memory
+        channel.basic_qos(prefetch_count=self.config.PIPEFORCE_MESSAGING_PREFETCH_COUNT)
+
         # Listen to all messages on the service queue
         channel.basic_consume(
             queue=self.config.PIPEFORCE_MESSAGING_QUEUE,
             on_message_callback=self.dispatch_message,
             auto_ack=False)
 
-    def message_send(self, key, payload):
+    def amqp_match(self, key: str, pattern: str) -> bool:
         """
-        Sends the message to given routing key and returns immediately.
+        Checks if given key matches the given AMQP pattern.
+        Wildcards follow the RabbitMQ topic semantics: * matches exactly one word, # matches zero or more words.
+        The pattern is compiled only once and cached for subsequent calls.
         :param key:
-        :param payload:
+        :param pattern:
         :return:
         """
-        self.channel.basic_publish(
-            exchange=self.config.default_exchange_topic,
-            routing_key=key,
-            body=payload)
+        if key == pattern:
+            return True
+        return len(pattern_index(pattern).match(key)) > 0
 
-    def message_send_and_wait(self, key, payload):
+    def find_event_mappings(self):
         """
-        Sends the message to given routing key and waits for response.
-        :param key:
-        :param payload:
+        Collects all event mappings from all service classes.
+        Imports all modules of the service package, so their @event decorators register the mappings.
+        :return: List of (key, "module.Class#method") tuples in the order of registration.
+        """
+        return find_event_mappings()
+
+    def get_pipeforce_access_token(self):
+        """
+        Returns the current access token to login to PIPEFORCE.
+        In case the current access token is about to expire or doesn't exist yet,
+        refreshes it using the PIPEFORCE_SECRET env and caches the result.
+        See TokenManager for details.
         :return:
         """
-        self.sync_mode = True
+        return self.token_manager.get_access_token()
 
-        try:
-            self.channel.basic_publish(
-                exchange=self.config.default_exchange_topic,
-                routing_key=key,
-                properties=pika.BasicProperties(content_type='text/plain',
-                                                reply_to=self.config.PIPEFORCE_MESSAGING_QUEUE,
-                                                correlation_id=self.correlation_id),
-                body=payload)
-
-            # Block until we get the response
-            print(f"Waiting for server response to queue:{self.config.PIPEFORCE_MESSAGING_QUEUE} with "
-                  f"correlation_id:{self.correlation_id}...")
-            while self.response is None:
-                self.connection.process_data_events()
-                time.sleep(0.5)  # Do not do potential re-queueing too frequently -> Give server time to respond
 
-        finally:
-            self.sync_mode = False
+# pylint: disable=unused-argument
+class AsyncPipeforceClient(PipeforceClient):  # pylint: disable=too-many-instance-attributes
+    """
+        Messaging client which consumes messages on an asyncio event loop.
+        Service methods mapped by @event can be declared as async def. They are awaited on the event loop,
+        while normal methods are executed in the default executor, so they do not block the loop.
+        Up to PIPEFORCE_MESSAGING_MAX_CONCURRENCY messages are processed concurrently and each message
+        is acknowledged as soon as all of its service methods have completed.
+    """
 
-        resp = self.response
-        self.response = None
-        return resp
+    def __init__(self, config: Config):
+        super().__init__(config)
+        self.loop = None
+        self.semaphore = None
+        self.closed = None
+        self.tasks = set()
+        self.reply_queue = None
+        self.pending_replies = {}
+        self.consumer_tag = None
 
-    def amqp_match(self, key: str, pattern: str) -> bool:
+    def start_consuming(self):
         """
-        Checks if given key matches the given AMQP pattern.
-        :param key:
-        :param pattern:
+        Starts the client and consumes for new incoming messages.
+        Blocks while consuming.
         :return:
         """
-        if key == pattern:
-            return True
-        replaced = pattern.replace(r'*', r'([^.]+)').replace(r'#', r'([^.]+.?)+')
-        regex_string = f"^{replaced}$"
-        match = re.search(regex_string, key)
-        return match is not None
+        asyncio.run(self.consume())
 
-    def find_event_mappings(self):
+    async def consume(self):
         """
-        Collects all event mappings from all service classes.
+        Connects to the message broker, sets up queues and consumers and processes messages until the
+        client was stopped. In case the connection is lost, reconnects with exponential backoff.
+        Once stopped or drained, closes the resources of the client like the sync client, see close_resources.
         :return:
         """
-        decorator_name = "event"
-        mapping = {}
-
-        for _, service_module, _ in pkgutil.iter_modules(['service']):
-
-            module = import_module("service." + service_module)
-
-            for name, cls in inspect.getmembers(module):
-                if not inspect.isclass(cls):
-                    continue
+        self.load_mappings()
+        self.start_metrics_server()
+
+        self.loop = asyncio.get_running_loop()
+        self.semaphore = asyncio.Semaphore(self.config.PIPEFORCE_MESSAGING_MAX_CONCURRENCY)
+        for lane in self.lanes:
+            lane.semaphore = asyncio.Semaphore(self.lane_prefetch_count(lane))
+
+        attempt = 0
+        connected = False
+        while True:
+            self.closed = self.loop.create_future()
+            try:
+                await self.connect_async()
+                attempt = 0
+                connected = True
+                logger.info("Receiving messages...")
+                reason = await self.closed
+            except pika.exceptions.AMQPError as error:
+                reason = error
+
+            self.fail_pending_replies(pika.exceptions.AMQPConnectionError(reason))
+            if self.stopped or self.draining:
+                break
+
+            max_attempts = self.config.PIPEFORCE_MESSAGING_RECONNECT_ATTEMPTS
+            if 0 < max_attempts <= attempt:
+                raise pika.exceptions.AMQPConnectionError(reason)
+
+            delay = backoff_delay(attempt, self.config.PIPEFORCE_MESSAGING_RECONNECT_DELAY,
+                                  self.config.PIPEFORCE_MESSAGING_RECONNECT_MAX_DELAY)
+            attempt += 1
+            self.log_reconnect(reason, delay, attempt, connected)
+
+            deadline = self.loop.time() + delay
+            while not (self.stopped or self.draining) and self.loop.time() < deadline:
+                await asyncio.sleep(min(deadline - self.loop.time(), DRAIN_CHECK_INTERVAL))
+
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        # Closing the publisher blocks until its messages are confirmed
+        await self.loop.run_in_executor(None, self.close_resources)
+
+    async def connect_async(self):
+        """
+        Opens the connection and channel, declares exchange, queues and bindings, starts the consumers and
+        publishes the messages buffered while the connection was lost. Called again on each reconnect.
+        :return:
+        """
+        self.connection = await self.open_connection()
+        self.channel = await self.wait_for(lambda callback: self.connection.channel(on_open_callback=callback))
+
+        await self.wait_for(lambda callback: self.channel.exchange_declare(
+            exchange=self.config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC, exchange_type='topic', callback=callback))
+        await self.wait_for(lambda callback: self.channel.queue_declare(
+            queue=self.config.PIPEFORCE_MESSAGING_QUEUE, durable=True, exclusive=False, auto_delete=False,
+            callback=callback))
+        for declaration in retry_queue_declarations(self.config):
+            await self.wait_for(lambda callback, declaration=declaration: self.channel.queue_declare(
+                callback=callback, **declaration))
+
+        for key, value in self.mappings:
+            logger.info("Creating binding: %s -> %s()", key, value)
+
+        for key in self.binding_keys():
+            await self.wait_for(lambda callback, key=key: self.channel.queue_bind(
+                exchange=self.config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC, queue=self.config.PIPEFORCE_MESSAGING_QUEUE,
+                routing_key=key, callback=callback))
 
-                sourcelines = inspect.getsourcelines(cls)[0]
+        # Exclusive queue to receive the responses of message_send_and_wait
+        result = await self.wait_for(lambda callback: self.channel.queue_declare(
+            queue='', exclusive=True, auto_delete=True, callback=callback))
+        self.reply_queue = result.method.queue
 
-                for i, line in enumerate(sourcelines):
-                    line = line.strip()
-                    if line.split('(')[0].strip() == '@' + decorator_name:  # leaving a bit out
-                        key = line.split('"')[1]
-                        method_line = sourcelines[i + 1]
-                        method_name = method_line.split('def')[1].split('(')[0].strip()
-                        mapping[key] = cls.__module__ + "." + cls.__name__ + "#" + method_name
+        # Let the broker never push more messages than we're able to process concurrently
+        await self.wait_for(lambda callback: self.channel.basic_qos(
+            prefetch_count=self.config.PIPEFORCE_MESSAGING_MAX_CONCURRENCY, callback=callback))
 
-        return mapping
+        self.consumer_tag = self.channel.basic_consume(
+            queue=self.config.PIPEFORCE_MESSAGING_QUEUE,
+            on_message_callback=self.dispatch_message,
+            auto_ack=False)
+        self.channel.basic_consume(queue=self.reply_queue, on_message_callback=self.on_reply, auto_ack=True)
+        self.reset_batches()
+        await self.setup_lanes_async()
+        self.flush_outage_buffer()
 
-    def run_pipeline(self, pipeline):
+    async def open_connection(self) -> AsyncioConnection:
         """
-        Executes the given pipeline on PIPEFORCE and returns the body result.
-        :param pipeline: The pipeline as YAML string
+        Opens a new connection to the message broker on the running event loop.
         :return:
         """
+        opened = self.loop.create_future()
+        closed = self.closed
+
+        def on_open(connection):
+            opened.set_result(connection)
 
-        access_token = self.get_pipeforce_access_token()
-        headers = {'Content-type': 'application/yaml', 'Authorization': 'Bearer ' + access_token}
-        return self.do_post(self.config.PIPEFORCE_HUB_URL + f"/api/v3/pipeline", data=pipeline, headers=headers)
+        def on_open_error(connection, error):
+            opened.set_exception(pika.exceptions.AMQPConnectionError(error))
 
-    def run_command(self, name, params):
+        def on_close(connection, reason):
+            if not closed.done():
+                closed.set_result(reason)
+
+        AsyncioConnection(self.connection_parameters(), on_open_callback=on_open,
+                          on_open_error_callback=on_open_error, on_close_callback=on_close, custom_ioloop=self.loop)
+        return await opened
+
+    async def wait_for(self, call):
         """
-        Executes a single command on PIPEFORCE and returns the body result.
-        :param name: The name of the command.
-        :return: params: The params of the command.
+        Calls the given function with a callback argument and waits until this callback was called.
+        :param call: Function which starts the asynchronous operation and takes the callback as argument.
+        :return: The first argument passed to the callback.
         """
+        future = self.loop.create_future()
 
-        access_token = self.get_pipeforce_access_token()
-        headers = {'Content-type': 'application/json', 'Authorization': 'Bearer ' + access_token}
-        return self.do_post(self.config.PIPEFORCE_HUB_URL + f"/api/v3/command/{name}", json=params,
-                            headers=headers)
+        def callback(result=None):
+            if not future.done():
+                future.set_result(result)
 
-    def get_pipeforce_access_token(self):
+        call(callback)
+        return await future
+
+    def stop_consuming(self):
         """
-        Returns the current access token to login to PIPEFORCE.
-        In case the current access token was invalidated because of timeout or doesn't exist yet,
-        exchanges a new one using the PIPEFORCE_SECRET env and caches the result.
+        Stops the client and closes any connection to the message broker. Can be called from any thread.
         :return:
         """
+        self.stopped = True
+        self.loop.call_soon_threadsafe(self.close_connection)
 
-        # If current token is still valid -> Return it
-        if self.last_token_response:
-            current = int(time.time())
-            if (current - self.last_token_timestamp) < self.last_token_response['expires_in']:
-                return self.last_token_response['access_token']
+    def close_connection(self):
+        """
+        Closes the connection to the message broker unless it is closed already. Runs on the event loop.
+        :return:
+        """
+        if self.connection.is_open:
+            self.connection.close()
 
-        token = None
+    def request_drain(self):
+        """
+        Requests to stop receiving new messages and to stop the client as soon as all messages in-flight
+        have been processed and acknowledged. Safe to be called from signal handlers and any thread.
+        :return:
+        """
+        if not self.draining and self.loop:
+            self.loop.call_soon_threadsafe(lambda: self.loop.create_task(self.drain()))
+        super().request_drain()
 
-        # Is it Basic secret?
-        if self.config.PIPEFORCE_SECRET.startswith("Basic "):
-            value = self.config.PIPEFORCE_SECRET[len("Basic "):]
-            split = value.split(":")
-            username = split[0]
-            password = split[1]
+    async def drain(self):
+        """
+        Cancels the consumer, waits for the messages in-flight and closes the connection afterwards.
+        :return:
+        """
+        logger.info("Draining: Stopped receiving messages, waiting for messages in-flight")
+        if self.channel.is_open:
+            for consumer_tag in [self.consumer_tag, *self.consumer_lanes]:
+                await self.wait_for(lambda callback, consumer_tag=consumer_tag: self.channel.basic_cancel(
+                    consumer_tag, callback=callback))
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.flush_batches()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.close_connection()
+        logger.info("Drained and stopped")
+
+    def schedule_batch_flush(self, lane):
+        """
+        Passes the batch being collected by the lane on after max_wait seconds using the event loop.
+        :param lane:
+        :return:
+        """
+        self.loop.call_later(lane.max_wait, self.flush_batch, lane, lane.generation)
 
-            json = self.do_post(self.config.PIPEFORCE_HUB_URL + "/api/v3/command/iam.token",
-                                json={"username": username, "password": password})
+    def execute_batch(self, lane, items):
+        """
+        Schedules the batch as task on the event loop, see handle_batch.
+        :param lane:
+        :param items:
+        :return:
+        """
+        task = self.loop.create_task(self.handle_batch(lane, items))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
 
-            token = json['refresh_token']
+    def dispatch_message(self, channel, method, props, body):
+        """
+        Callback which schedules each incoming message as task on the event loop.
+        :param channel:
+        :param method:
+        :param props:
+        :param body:
+        :return:
+        """
+        task = self.loop.create_task(self.handle_message(channel, method, props, body))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
 
-        # Is it Apitoken secret?
-        elif self.config.PIPEFORCE_SECRET.startswith("Apitoken "):
-            token = self.config.PIPEFORCE_SECRET[len("Apitoken "):]
+    async def handle_message(self, channel, method, props, body):
+        """
+        Executes all service methods matching the routing key of the message in the order of the mappings
+        and acknowledges the message afterwards. In case a service method fails, the others are executed
+        anyway and the message is retried, see RetryMixin.
+        :param channel:
+        :param method:
+        :param props:
+        :param body:
+        :return:
+        """
+        lane = self.consumer_lane(method)
+        async with (lane or self).semaphore:
+            routing_key = self.message_routing_key(method, props)
+            matches = self.retried_matches((lane or self).routing_index.match(routing_key), props)
+            self.metrics.inc("pipeforce_messages_received_total", pattern_labels(matches))
+            if not matches:
+                logger.warning("Incoming message did not match any service: %s", routing_key,
+                               extra={"routing_key": routing_key})
+                self.metrics.inc("pipeforce_messages_unmatched_total")
+                self.ack(channel, method.delivery_tag)
+                return
 
-        # Exchange offline token for new refresh token and store it
-        self.last_token_response = self.do_post(self.config.PIPEFORCE_HUB_URL + "/api/v3/command/iam.token.refresh",
-                                                json={"refreshToken": token})
+            if not self.claim_message(channel, method, props, body, matches):
+                return
 
-        self.last_token_timestamp = int(time.time())
-        return self.last_token_response['access_token']
+            payload = Payload(body, getattr(props, "content_type", None)
+                              or self.config.PIPEFORCE_MESSAGING_CONTENT_TYPE)
+            if lane is not None and lane.batch:
+                self.collect_batch(lane, channel, method, props, body, payload)
+                return
 
-    def do_post(self, url, json, headers={}):
-        response = requests.post(url, json=json, headers=headers)
+            message_start = time.perf_counter()
+            failures = []
+            try:
+                for key, value in matches:
+                    try:
+                        await self.run_handler(routing_key, key, value, payload)
+
+                    # pylint: disable=broad-except
+                    except Exception as error:
+                        logger.error("Service %s failed for message %s: %r", value, routing_key, error,
+                                     exc_info=error, extra={"routing_key": routing_key, "handler": value})
+                        failures.append((value, repr(error)))
+            except asyncio.CancelledError:
+                # Stopped before settling, the message is redelivered and must not be deferred then
+                self.finish_message(method, props, body, False)
+                raise
+
+            self.metrics.observe("pipeforce_message_duration_seconds", time.perf_counter() - message_start,
+                                 pattern_labels(matches))
+            self.settle_message(channel, method, props, body, failures)
+
+    async def run_handler(self, routing_key, key, value, payload: Payload):
+        """
+        Executes a single service method. Async methods are awaited, others are executed in the default executor.
+        :param routing_key: The routing key of the message.
+        :param key: The mapping key matching the routing key.
+        :param value: The mapping value in the form module.Class#method.
+        :param payload: The body of the message.
+        :return:
+        """
+        handler = self.handlers.get(value) or self.resolve_handler(value)
+        convert = self.payload_converters.get(value)
+        argument = convert(payload) if convert else payload.body
+        labels = (("handler", value),)
+        start = time.perf_counter()
+        try:
+            if inspect.iscoroutinefunction(handler):
+                await handler(argument)
+            else:
+                await self.loop.run_in_executor(None, self.profiler.call, handler, argument)
+        except Exception:
+            self.metrics.inc("pipeforce_handler_errors_total", labels)
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            self.metrics.observe("pipeforce_handler_duration_seconds", duration, labels)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Dispatched message: %s -> %s -> %s()", routing_key, key, value, extra={
+                    "routing_key": routing_key, "handler": value, "duration_ms": round(duration * 1000, 3)})
 
-        if response.status_code != 200:
-            raise Exception(f"Error response [code: {response.status_code}] from POST to [{url}]: {response.text}")
+    def message_send(self, key, payload, content_type=None):
+        """
+        Sends the message to given routing key and returns immediately. Can be called from any thread.
+        While the connection to the message broker is lost, the message is buffered and sent after reconnecting.
+        :param key:
+        :param payload: Bytes, text, a Payload to forward or any value to encode by the codec of the content type.
+        :param content_type: The content type of the message. See encode_payload for the default.
+        :return:
+        """
+        body, properties = self.encode_message(payload, content_type)
+        self.loop.call_soon_threadsafe(self.publish_logged, key, body, properties)
 
-        return self.extract_content(response)
+    def message_send_and_wait(self, key, payload, timeout=None):
+        """
+        Sends the message to given routing key and blocks the calling thread until the response has arrived.
+        Use this from non-async service methods only, since they run outside of the event loop.
+        Async service methods should use message_send_and_wait_async instead.
+        :param key:
+        :param payload:
+        :param timeout: Max seconds to wait for the response. Defaults to PIPEFORCE_MESSAGING_REPLY_TIMEOUT.
+        :return: The body of the response message.
+        """
+        future = asyncio.run_coroutine_threadsafe(self.message_send_and_wait_async(key, payload, timeout), self.loop)
+        return future.result()
 
-    def do_get(self, url, params={}, headers={}):
-        response = requests.get(url, params=params, headers=headers)
+    async def message_send_and_wait_async(self, key, payload, timeout=None):
+        """
+        Sends the message to given routing key and waits for the response without blocking the event loop.
+        Unlike message_send, the message is not buffered while the connection to the message broker is lost,
+        since the reply queue is deleted with the connection.
+        :param key:
+        :param payload:
+        :param timeout: Max seconds to wait for the response. Defaults to PIPEFORCE_MESSAGING_REPLY_TIMEOUT.
+        :return: The body of the response message.
+        :raises PublishError: In case the client is not connected.
+        """
+        if self.reply_queue is None or not self.channel.is_open:
+            raise PublishError(f"Message {key} not sent: Not connected to message broker")
 
-        if response.status_code != 200:
-            raise Exception(f"Error response [code: {response.status_code}] from GET to [{url}]: {response.text}")
+        if timeout is None:
+            timeout = self.config.PIPEFORCE_MESSAGING_REPLY_TIMEOUT
 
-        return self.extract_content(response)
+        correlation_id = uuid.uuid4().hex
+        future = self.loop.create_future()
+        self.pending_replies[correlation_id] = future
+        body, properties = self.encode_message(
+            payload, properties=pika.BasicProperties(reply_to=self.reply_queue, correlation_id=correlation_id))
 
-    def extract_content(self, response):
-        data = response.text
+        try:
+            self.publish(key, body, properties)
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError as error:
+            raise TimeoutError(f"No response for message {key} with correlation_id:{correlation_id} "
+                               f"within {timeout} seconds") from error
+        finally:
+            self.pending_replies.pop(correlation_id, None)
 
-        if not data:
-            return None
+    def fail_pending_replies(self, error: Exception):
+        """
+        Fails all requests waiting for a response, since the reply queue is deleted with the connection.
+        :param error:
+        :return:
+        """
+        self.reply_queue = None
+        for future in self.pending_replies.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending_replies.clear()
 
-        if data.startswith("[") or data.startswith("{"):
-            return response.json()
+    def on_reply(self, channel, method, props, body):
+        """
+        Completes the pending request matching the correlation id of the response message.
+        :param channel:
+        :param method:
+        :param props:
+        :param body:
+        :return:
+        """
+        future = self.pending_replies.pop(props.correlation_id, None)
+        if future is None or future.done():
+            logger.warning("Response message without pending request: correlation_id=%s", props.correlation_id,
+                           extra={"correlation_id": props.correlation_id})
+            return
 
-        return data
+        future.set_result(body)
 
 
 class BaseService:
@@ -367,24 +979,13 @@ class BaseService:
                 pass
 
         And then map your service methods in the routing.py.
-    """
-
-    def __init__(self, client):
-        self.client: PipeforceClient = client
 
-
-# pylint: disable=unused-argument
-def event(key):
-    """
-    The @event decorator.
-    :param key:
-    :return:
+        By default, a single instance of a service class is shared by all incoming messages.
+        In case your service keeps state per request, set instance_per_message = True
+        in order to get a new instance for each message.
     """
 
-    def decorator(func):
-        def func_wrapper(self, *args, **kwargs):
-            return func(self, *args, **kwargs)
+    instance_per_message = False
 
-        return func_wrapper
-
-    return decorator
+    def __init__(self, client):
+        self.client: PipeforceClient = client
@@ -0,0 +1,254 @@
+# pylint: disable=E0401
+import threading
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import pika
+
+
+class PublishError(Exception):
+    """
+        Raised for a message which was not confirmed by the message broker.
+    """
+
+
+class BatchPublisher:  # pylint: disable=too-many-instance-attributes
+    """
+        Buffers outgoing messages and publishes them in batches with publisher confirms enabled.
+        Uses its own connection with an I/O loop running on a background thread. A batch is published as soon as
+        PIPEFORCE_MESSAGING_BATCH_SIZE messages are buffered or PIPEFORCE_MESSAGING_BATCH_INTERVAL seconds have
+        passed. Each message gets a future which is completed when the broker confirms the message and fails
+        with a PublishError in case the broker rejects it or the connection gets lost.
+        In case PIPEFORCE_MESSAGING_BATCH_MAX_PENDING messages are waiting for their confirmation, send blocks
+        until confirmations arrive, so memory stays bounded.
+    """
+
+    def __init__(self, client):
+        """
+        :param client: The PipeforceClient to publish messages for.
+        """
+        self.client = client
+        self.config = client.config
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.unconfirmed = {}
+        self.delivery_tag = 0
+        self.pending = threading.BoundedSemaphore(self.config.PIPEFORCE_MESSAGING_BATCH_MAX_PENDING)
+        self.ready = threading.Event()
+        self.error = None
+        self.closing = False
+        self.connection = None
+        self.channel = None
+        self.thread = None
+
+    def start(self):
+        """
+        Starts the background thread and waits until the channel is ready to publish.
+        :return:
+        """
+        self.thread = threading.Thread(target=self.run, name="pipeforce-publisher", daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+
+    def is_stopped(self) -> bool:
+        """
+        Returns true in case the background thread has exited, for example because the connection was lost.
+        :return:
+        """
+        return self.thread is not None and not self.thread.is_alive()
+
+    def run(self):
+        """
+        Runs the I/O loop of the publisher connection on the background thread until the connection was closed.
+        :return:
+        """
+        self.connection = pika.SelectConnection(self.client.connection_parameters(),
+                                                on_open_callback=self.on_connection_open,
+                                                on_open_error_callback=self.on_connection_error,
+                                                on_close_callback=self.on_connection_closed)
+        self.connection.ioloop.start()
+
+    def on_connection_open(self, connection):
+        """
+        Opens the channel once the connection is established.
+        :param connection:
+        :return:
+        """
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_connection_error(self, connection, error):
+        """
+        Reports the error to start.
+        :param connection:
+        :param error:
+        :return:
+        """
+        self.error = pika.exceptions.AMQPConnectionError(error)
+        self.ready.set()
+        connection.ioloop.stop()
+
+    def on_connection_closed(self, connection, reason):
+        """
+        Fails all messages not confirmed yet and stops the I/O loop.
+        :param connection:
+        :param reason:
+        :return:
+        """
+        self.fail_all(PublishError(f"Connection closed before message was confirmed: {reason}"))
+        if not self.ready.is_set():
+            self.error = PublishError(f"Connection closed while opening the channel: {reason}")
+            self.ready.set()
+        connection.ioloop.stop()
+
+    def on_channel_open(self, channel):
+        """
+        Enables publisher confirms on the channel.
+        :param channel:
+        :return:
+        """
+        self.channel = channel
+        channel.confirm_delivery(ack_nack_callback=self.on_confirm, callback=self.on_confirm_enabled)
+
+    def on_confirm_enabled(self, frame):
+        """
+        Starts the flush timer and signals the publisher is ready.
+        :param frame:
+        :return:
+        """
+        self.connection.ioloop.call_later(self.config.PIPEFORCE_MESSAGING_BATCH_INTERVAL, self.on_timer)
+        self.ready.set()
+
+    def on_timer(self):
+        """
+        Publishes the buffered messages periodically.
+        :return:
+        """
+        self.publish_buffered()
+        if not self.closing:
+            self.connection.ioloop.call_later(self.config.PIPEFORCE_MESSAGING_BATCH_INTERVAL, self.on_timer)
+
+    def send(self, key, payload, properties=None) -> Future:
+        """
+        Buffers the message for publishing. Can be called from any thread.
+        :param key: The routing key.
+        :param payload:
+        :param properties: Optional pika.BasicProperties of the message.
+        :return: A future completed as soon as the message was confirmed by the broker.
+        """
+        if self.closing:
+            raise PublishError("Publisher is closed")
+
+        self.pending.acquire()  # pylint: disable=consider-using-with
+        future = Future()
+
+        with self.lock:
+            self.buffer.append((key, payload, properties, future))
+            full = len(self.buffer) >= self.config.PIPEFORCE_MESSAGING_BATCH_SIZE
+
+        if full:
+            self.flush()
+
+        return future
+
+    def flush(self):
+        """
+        Publishes all buffered messages without waiting for the flush interval. Can be called from any thread.
+        :return:
+        """
+        self.connection.ioloop.add_callback_threadsafe(self.publish_buffered)
+
+    def publish_buffered(self):
+        """
+        Publishes all buffered messages as one batch. Runs on the I/O loop thread.
+        In case publishing fails, the futures of the message and all messages after it in the batch fail.
+        :return:
+        """
+        failed = []
+        with self.lock:
+            batch = self.buffer
+            self.buffer = []
+
+            for index, (key, payload, properties, future) in enumerate(batch):
+                self.delivery_tag += 1
+                self.unconfirmed[self.delivery_tag] = future
+                try:
+                    self.channel.basic_publish(exchange=self.config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC,
+                                               routing_key=key, body=payload, properties=properties)
+                # pylint: disable=broad-except
+                except Exception as error:
+                    # The message was not sent, so the broker does not count its delivery tag
+                    del self.unconfirmed[self.delivery_tag]
+                    self.delivery_tag -= 1
+                    failed = [(item[0], item[3], error) for item in batch[index:]]
+                    break
+
+        for key, future, error in failed:
+            self.pending.release()
+            future.set_exception(PublishError(f"Message {key} not published: {error!r}"))
+
+    def on_confirm(self, frame):
+        """
+        Completes the futures of all messages confirmed by the broker. Runs on the I/O loop thread.
+        :param frame:
+        :return:
+        """
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+
+        with self.lock:
+            if method.multiple:
+                # Delivery tags are ascending, so all confirmed messages are at the start of the dict
+                tags = []
+                for tag in self.unconfirmed:
+                    if tag > method.delivery_tag:
+                        break
+                    tags.append(tag)
+            else:
+                tags = [method.delivery_tag]
+
+            confirmed = [(tag, self.unconfirmed.pop(tag)) for tag in tags if tag in self.unconfirmed]
+
+        for tag, future in confirmed:
+            self.pending.release()
+            if acked:
+                future.set_result(tag)
+            else:
+                future.set_exception(PublishError(f"Message was rejected by the broker: delivery_tag={tag}"))
+
+    def fail_all(self, error: Exception):
+        """
+        Fails all buffered and unconfirmed messages with the given error.
+        :param error:
+        :return:
+        """
+        with self.lock:
+            futures = [future for _, _, _, future in self.buffer] + list(self.unconfirmed.values())
+            self.buffer = []
+            self.unconfirmed.clear()
+
+        for future in futures:
+            self.pending.release()
+            if not future.done():
+                future.set_exception(error)
+
+    def close(self, timeout=None):
+        """
+        Publishes all buffered messages, waits for their confirmation and closes the connection.
+        :param timeout: Max seconds to wait for outstanding confirmations.
+        :return:
+        """
+        with self.lock:
+            futures = [future for _, _, _, future in self.buffer] + list(self.unconfirmed.values())
+
+        self.flush()
+        for future in futures:
+            try:
+                future.exception(timeout)
+            except FutureTimeoutError:
+                break
+
+        self.closing = True
+        self.connection.ioloop.add_callback_threadsafe(self.connection.close)
+        self.thread.join()
@@ -0,0 +1,155 @@
+# pylint: disable=E0401
+import threading
+import uuid
+from concurrent.futures import Future
+
+import pika
+
+from src.concurrency import call_threadsafe, wait_for_result
+from src.logs import get_logger
+from src.publisher import PublishError
+
+logger = get_logger("replies")
+
+
+# pylint: disable=unused-argument
+class ReplyConsumer:  # pylint: disable=too-many-instance-attributes
+    """
+        Sends request messages and receives their responses for PipeforceClient.message_send_and_wait.
+        Uses its own connection running on a background thread with an exclusive reply queue. Each request
+        gets a unique correlation id and a future which is completed as soon as the response arrives,
+        so any number of requests can wait at the same time without polling.
+    """
+
+    def __init__(self, client):
+        """
+        :param client: The PipeforceClient to send requests for.
+        """
+        self.client = client
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.error = None
+        self.connection = None
+        self.channel = None
+        self.queue = None
+        self.thread = None
+
+    def start(self):
+        """
+        Starts the background thread and waits until the reply queue is ready.
+        :return:
+        """
+        self.thread = threading.Thread(target=self.run, name="pipeforce-replies", daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.error:
+            raise self.error
+
+    def is_stopped(self) -> bool:
+        """
+        Returns true in case the background thread has exited, for example because the connection was lost.
+        :return:
+        """
+        return self.thread is not None and not self.thread.is_alive()
+
+    def run(self):
+        """
+        Connects, declares the reply queue and consumes responses until stopped or the connection was lost.
+        Pending requests fail as soon as the reply queue is gone, since their responses can not arrive anymore.
+        :return:
+        """
+        try:
+            self.connection = self.client.create_connection()
+            self.channel = self.connection.channel()
+            result = self.channel.queue_declare(queue='', exclusive=True, auto_delete=True)
+            self.queue = result.method.queue
+            self.channel.basic_consume(queue=self.queue, on_message_callback=self.on_reply, auto_ack=True)
+
+        # pylint: disable=broad-except
+        except Exception as error:
+            self.error = error
+            self.ready.set()
+            return
+
+        self.ready.set()
+        try:
+            self.channel.start_consuming()
+        except pika.exceptions.AMQPError as error:
+            logger.warning("Connection of the reply queue lost: %r", error)
+            self.fail_all(error)
+            return
+
+        self.fail_all(pika.exceptions.ConnectionClosedByClient(200, "Reply consumer stopped"))
+        self.connection.close()
+
+    def fail_all(self, error: Exception):
+        """
+        Fails all pending requests with the given error. Requests sent afterwards fail immediately.
+        :param error:
+        :return:
+        """
+        with self.lock:
+            self.error = error
+            futures = list(self.pending.values())
+            self.pending.clear()
+
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    def stop(self):
+        """
+        Stops consuming responses and closes the connection.
+        :return:
+        """
+        self.connection.add_callback_threadsafe(self.channel.stop_consuming)
+        self.thread.join()
+
+    def request(self, key, payload, timeout):
+        """
+        Publishes the request message and blocks the calling thread until its response has arrived.
+        :param key:
+        :param payload:
+        :param timeout: Max seconds to wait.
+        :return: The body of the response message.
+        :raises PublishError: In case the reply queue was closed already.
+        """
+        correlation_id = uuid.uuid4().hex
+        future = Future()
+
+        with self.lock:
+            if self.error:
+                raise PublishError(f"Message {key} not sent: Reply queue closed") from self.error
+            self.pending[correlation_id] = future
+
+        body, properties = self.client.encode_message(
+            payload, properties=pika.BasicProperties(reply_to=self.queue, correlation_id=correlation_id))
+        call_threadsafe(self.connection, self.channel.basic_publish,
+                        exchange=self.client.config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC, routing_key=key,
+                        properties=properties, body=body)
+
+        try:
+            return wait_for_result(future, timeout, f"response for message {key} with correlation_id:{correlation_id}")
+        finally:
+            with self.lock:
+                self.pending.pop(correlation_id, None)
+
+    def on_reply(self, channel, method, props, body):
+        """
+        Completes the pending request matching the correlation id of the response message.
+        :param channel:
+        :param method:
+        :param props:
+        :param body:
+        :return:
+        """
+        with self.lock:
+            future = self.pending.pop(props.correlation_id, None)
+
+        if future is None:
+            logger.warning("Response message without pending request: correlation_id=%s", props.correlation_id,
+                           extra={"correlation_id": props.correlation_id})
+            return
+
+        future.set_result(body)
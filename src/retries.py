@@ -0,0 +1,193 @@
+# pylint: disable=E0401
+import pika
+
+from src.logs import get_logger
+
+logger = get_logger("retries")
+
+# Headers of retried and dead-lettered messages
+ATTEMPTS_HEADER = "x-pipeforce-attempts"
+ROUTING_KEY_HEADER = "x-pipeforce-routing-key"
+HANDLERS_HEADER = "x-pipeforce-handlers"
+ERROR_HEADER = "x-pipeforce-error"
+
+# Max length of the error description written to the error header
+MAX_ERROR_LENGTH = 1000
+
+
+def retry_delay(attempt: int, initial: float, maximum: float) -> float:
+    """
+    Returns the seconds to wait before the given retry. The delay doubles with each retry up to maximum.
+    :param attempt: The number of the retry, starting at 1.
+    :param initial: The delay of the first retry.
+    :param maximum: The max delay.
+    :return:
+    """
+    return min(maximum, initial * 2 ** min(attempt - 1, 32))
+
+
+def retry_queue_name(queue: str, delay: float) -> str:
+    """
+    Returns the name of the queue which holds failed messages of given service queue for given seconds.
+    :param queue:
+    :param delay:
+    :return:
+    """
+    return f"{queue}.retry.{int(delay * 1000)}"
+
+
+def retry_queue_declarations(config, queue: str = None) -> list:
+    """
+    Returns the arguments to declare the retry queues and the dead letter queue with.
+    There is one retry queue per distinct delay. Messages expire after the delay of their queue and are
+    dead-lettered back into the service queue, so waiting messages never block the consumer.
+    Since all messages of a retry queue have the same delay, they expire in order.
+    :param config:
+    :param queue: The queue to retry messages of. Defaults to PIPEFORCE_MESSAGING_QUEUE.
+    :return: List of keyword arguments for queue_declare.
+    """
+    queue = queue or config.PIPEFORCE_MESSAGING_QUEUE
+    delays = dict.fromkeys(retry_delay(attempt, config.PIPEFORCE_MESSAGING_RETRY_DELAY,
+                                       config.PIPEFORCE_MESSAGING_RETRY_MAX_DELAY)
+                           for attempt in range(1, config.PIPEFORCE_MESSAGING_MAX_ATTEMPTS))
+
+    declarations = [{"queue": config.PIPEFORCE_MESSAGING_DEFAULT_DLQ, "durable": True}]
+    for delay in delays:
+        declarations.append({
+            "queue": retry_queue_name(queue, delay), "durable": True,
+            "arguments": {"x-message-ttl": int(delay * 1000), "x-dead-letter-exchange": "",
+                          "x-dead-letter-routing-key": queue}})
+    return declarations
+
+
+class RetryMixin:
+    """
+        Handles messages whose service methods have failed for PipeforceClient.
+        A failed message is published to a retry queue and acknowledged, so it comes back after a delay growing
+        with each attempt. Only the failed service methods are executed again. After PIPEFORCE_MESSAGING_MAX_ATTEMPTS
+        deliveries, the message is moved to PIPEFORCE_MESSAGING_DEFAULT_DLQ with the last error in its headers.
+        Expects the client to provide config, metrics, ack, reject, consumer_queue and finish_message.
+    """
+
+    @staticmethod
+    def message_routing_key(method, props) -> str:
+        """
+        Returns the routing key the message was originally sent with, which differs for retried messages.
+        :param method:
+        :param props:
+        :return:
+        """
+        headers = getattr(props, "headers", None)
+        if headers and ROUTING_KEY_HEADER in headers:
+            return headers[ROUTING_KEY_HEADER]
+        return method.routing_key
+
+    @staticmethod
+    def retried_matches(matches, props) -> list:
+        """
+        Returns the matches to execute for the message. For retried messages, these are the failed ones only.
+        :param matches: List of (pattern, value) tuples.
+        :param props:
+        :return:
+        """
+        headers = getattr(props, "headers", None)
+        if not headers or HANDLERS_HEADER not in headers:
+            return matches
+        handlers = set(headers[HANDLERS_HEADER])
+        return [match for match in matches if match[1] in handlers]
+
+    def settle_message(self, channel, method, props, body, failures):  # pylint: disable=too-many-arguments
+        """
+        Acknowledges the message in case all service methods succeeded, otherwise retries or dead-letters it.
+        Must be called on the connection thread.
+        :param channel:
+        :param method:
+        :param props:
+        :param body:
+        :param failures: List of (value, error) tuples of the failed service methods.
+            None in case the worker failed, which retries all service methods of the message.
+        :return:
+        """
+        self.finish_message(method, props, body, failures == [])
+        if failures == []:
+            self.ack(channel, method.delivery_tag)
+            return
+
+        routing_key = self.message_routing_key(method, props)
+        headers = dict(getattr(props, "headers", None) or {})
+        attempts = int(headers.get(ATTEMPTS_HEADER, 1))
+
+        headers[ROUTING_KEY_HEADER] = routing_key
+        headers[ATTEMPTS_HEADER] = attempts + 1
+        if failures is not None:
+            headers[HANDLERS_HEADER] = [value for value, _ in failures]
+            headers[ERROR_HEADER] = "; ".join(error for _, error in failures)[:MAX_ERROR_LENGTH]
+
+        if attempts < self.config.PIPEFORCE_MESSAGING_MAX_ATTEMPTS:
+            delay = retry_delay(attempts, self.config.PIPEFORCE_MESSAGING_RETRY_DELAY,
+                                self.config.PIPEFORCE_MESSAGING_RETRY_MAX_DELAY)
+            queue = retry_queue_name(self.consumer_queue(method), delay)
+            metric = "pipeforce_messages_retried_total"
+            logger.warning("Retrying message %s in %s seconds (attempt %s of %s)", routing_key, delay, attempts + 1,
+                           self.config.PIPEFORCE_MESSAGING_MAX_ATTEMPTS, extra={"routing_key": routing_key})
+        else:
+            queue = self.config.PIPEFORCE_MESSAGING_DEFAULT_DLQ
+            metric = "pipeforce_messages_dead_lettered_total"
+            logger.error("Moving message %s to dead letter queue %s after %s attempts", routing_key, queue, attempts,
+                         extra={"routing_key": routing_key})
+
+        try:
+            channel.basic_publish(exchange="", routing_key=queue, body=body,
+                                  properties=self.copy_properties(props, headers))
+        except pika.exceptions.AMQPError as error:
+            logger.warning("Could not move message %s to %s, it will be redelivered: %r", routing_key, queue, error)
+            return
+
+        self.metrics.inc(metric)
+        self.ack(channel, method.delivery_tag)
+
+    def defer_message(self, channel, method, props, body):
+        """
+        Publishes the message to the first retry queue and acknowledges it, without counting an attempt, so it comes
+        back after the shortest retry delay. Without retry queues, the message is requeued instead.
+        Must be called on the connection thread.
+        :param channel:
+        :param method:
+        :param props:
+        :param body:
+        :return:
+        """
+        if self.config.PIPEFORCE_MESSAGING_MAX_ATTEMPTS < 2:
+            self.reject(channel, method.delivery_tag, requeue=True)
+            return
+
+        routing_key = self.message_routing_key(method, props)
+        headers = dict(getattr(props, "headers", None) or {})
+        headers[ROUTING_KEY_HEADER] = routing_key
+        delay = retry_delay(1, self.config.PIPEFORCE_MESSAGING_RETRY_DELAY,
+                            self.config.PIPEFORCE_MESSAGING_RETRY_MAX_DELAY)
+        queue = retry_queue_name(self.consumer_queue(method), delay)
+        try:
+            channel.basic_publish(exchange="", routing_key=queue, body=body,
+                                  properties=self.copy_properties(props, headers))
+        except pika.exceptions.AMQPError as error:
+            logger.warning("Could not move message %s to %s, it will be redelivered: %r", routing_key, queue, error)
+            return
+
+        self.ack(channel, method.delivery_tag)
+
+    @staticmethod
+    def copy_properties(props, headers) -> pika.BasicProperties:
+        """
+        Returns a copy of the message properties with the given headers.
+        :param props: The properties of the message, might be None.
+        :param headers:
+        :return:
+        """
+        if props is None:
+            return pika.BasicProperties(headers=headers, delivery_mode=2)
+        return pika.BasicProperties(
+            content_type=props.content_type, content_encoding=props.content_encoding, headers=headers,
+            delivery_mode=2, priority=props.priority, correlation_id=props.correlation_id, reply_to=props.reply_to,
+            message_id=props.message_id, timestamp=props.timestamp, type=props.type, user_id=props.user_id,
+            app_id=props.app_id)
@@ -1,4 +1,11 @@
-from pipeforce import PipeforceClient
+from config import Config
+from pipeforce import AsyncPipeforceClient, PipeforceClient
+from supervisor import Supervisor, run_worker
 
-pipeforce = PipeforceClient()
-pipeforce.start_consuming()
+config = Config()
+client_class = AsyncPipeforceClient if config.PIPEFORCE_MESSAGING_ASYNC else PipeforceClient  # pylint: disable=invalid-name
+
+if config.PIPEFORCE_MESSAGING_PROCESSES > 1:
+    Supervisor(config, client_class).run()
+else:
+    run_worker(client_class, config)
@@ -0,0 +1,135 @@
+import multiprocessing
+import signal
+import time
+from multiprocessing.connection import wait
+
+from src.logs import get_logger
+
+logger = get_logger("supervisor")
+
+
+def run_worker(client_class, config, index=0):
+    """
+    Consumes messages with a new client in the current process until SIGTERM or SIGINT, which drains it gracefully.
+    :param client_class: PipeforceClient or AsyncPipeforceClient.
+    :param config:
+    :param index: The number of the worker. Offsets the metrics port, so the workers do not clash.
+    :return:
+    """
+    if config.PIPEFORCE_METRICS_PORT > 0:
+        config.PIPEFORCE_METRICS_PORT += index
+
+    client = client_class(config)
+
+    def on_signal(signum, frame):  # pylint: disable=unused-argument
+        client.request_drain()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    client.start_consuming()
+
+
+class Supervisor:
+    """
+        Runs PIPEFORCE_MESSAGING_PROCESSES worker processes, each with its own client consuming from the shared
+        PIPEFORCE_MESSAGING_QUEUE, so service methods can use more than one CPU core. The prefetch count applies per
+        worker. Workers which exit unexpectedly are restarted after PIPEFORCE_MESSAGING_RESTART_DELAY seconds.
+        On SIGTERM or SIGINT, all workers are drained: They stop receiving messages, process their messages in-flight
+        and exit. Workers still running after PIPEFORCE_MESSAGING_DRAIN_TIMEOUT seconds are killed.
+    """
+
+    def __init__(self, config, client_class):
+        """
+        :param config:
+        :param client_class: The client to start in each worker, PipeforceClient or AsyncPipeforceClient.
+        """
+        self.config = config
+        self.client_class = client_class
+        self.processes = []
+        self.restart_at = {}
+        self.stopping = False
+
+    def run(self):
+        """
+        Starts the workers and supervises them until stop was requested. Blocks until all workers have exited.
+        Must be called from the main thread.
+        :return:
+        """
+        previous_handlers = {signum: signal.signal(signum, self.on_signal)
+                             for signum in (signal.SIGTERM, signal.SIGINT)}
+
+        try:
+            self.processes = [self.start_worker(index) for index in range(self.config.PIPEFORCE_MESSAGING_PROCESSES)]
+            while not self.stopping:
+                wait([process.sentinel for process in self.processes], timeout=0.5)
+                self.restart_exited()
+        finally:
+            self.stop_workers()
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+    def on_signal(self, signum, frame):  # pylint: disable=unused-argument
+        """
+        Requests to stop in case the supervisor process receives SIGTERM or SIGINT.
+        :param signum:
+        :param frame:
+        :return:
+        """
+        self.request_stop()
+
+    def request_stop(self):
+        """
+        Requests to drain and stop all workers.
+        :return:
+        """
+        self.stopping = True
+
+    def start_worker(self, index) -> multiprocessing.Process:
+        """
+        Starts the worker process with given number.
+        :param index:
+        :return:
+        """
+        process = multiprocessing.Process(target=run_worker, args=(self.client_class, self.config, index),
+                                          name=f"pipeforce-worker-{index}", daemon=False)
+        process.start()
+        logger.info("Started worker %s with pid %s", index, process.pid)
+        return process
+
+    def restart_exited(self):
+        """
+        Restarts the workers which have exited, each after the restart delay.
+        :return:
+        """
+        now = time.monotonic()
+        for index, process in enumerate(self.processes):
+            if process.is_alive() or self.stopping:
+                continue
+
+            restart_at = self.restart_at.get(index)
+            if restart_at is None:
+                logger.warning("Worker %s with pid %s exited with code %s, restarting in %s seconds", index,
+                               process.pid, process.exitcode, self.config.PIPEFORCE_MESSAGING_RESTART_DELAY)
+                self.restart_at[index] = now + self.config.PIPEFORCE_MESSAGING_RESTART_DELAY
+            elif restart_at <= now:
+                del self.restart_at[index]
+                self.processes[index] = self.start_worker(index)
+
+    def stop_workers(self):
+        """
+        Sends SIGTERM to all workers to drain them, waits up to the drain timeout and kills the remaining ones.
+        :return:
+        """
+        logger.info("Draining %s workers", len(self.processes))
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+
+        deadline = time.monotonic() + self.config.PIPEFORCE_MESSAGING_DRAIN_TIMEOUT
+        for process in self.processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning("Worker with pid %s did not drain within %s seconds, killing it", process.pid,
+                               self.config.PIPEFORCE_MESSAGING_DRAIN_TIMEOUT)
+                process.kill()
+                process.join()
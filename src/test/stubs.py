@@ -0,0 +1,222 @@
+"""
+    Stand-ins for the connection and channel of pika, used by the tests instead of a message broker.
+    End-to-end tests use the InMemoryBroker instead.
+"""
+import threading
+import time
+
+import pika
+
+from src.config import Config
+
+
+def create_config(**settings) -> Config:
+    """
+    Creates the config of the service myservice in namespace somens.
+    :param settings: Further settings, for example PIPEFORCE_MESSAGING_WORKERS=2.
+    :return:
+    """
+    config = Config()
+    config.PIPEFORCE_NAMESPACE = "somens"
+    config.PIPEFORCE_SERVICE = "myservice"
+    for name, value in settings.items():
+        setattr(config, name, value)
+    return config
+
+
+def start_in_thread(client, ready) -> threading.Thread:
+    """
+    Starts the client consuming on a background thread and waits up to 5 seconds until it is ready.
+    :param client:
+    :param ready: Function returning True once the client is ready, for example has started its consumers.
+    :return: The thread.
+    """
+    thread = threading.Thread(target=client.start_consuming, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 5
+    while not ready() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return thread
+
+
+class RecordingChannel:  # pylint: disable=too-many-instance-attributes
+    """
+    Channel stand-in which records declarations, consumers, acks, rejects and published messages.
+    Once is_open is set to False, it fails like the channel of a lost connection.
+    """
+
+    def __init__(self, connection=None):
+        self.connection = connection
+        self.is_open = True
+        # The declarations in order as ("exchange", name), ("queue", name), ("binding", key) or ("consumer", queue)
+        self.declared = []
+        self.arguments = {}
+        self.bindings = []
+        self.consumers = []
+        self.prefetch_count = None
+        self.acks = []
+        self.rejects = []
+        self.published = []
+
+    def check_open(self):
+        """
+        Raises the error of pika in case the channel was closed.
+        :return:
+        """
+        if not self.is_open:
+            raise pika.exceptions.ChannelWrongStateError("Channel is closed.")
+
+    def exchange_declare(self, exchange, exchange_type):
+        """
+        Records the exchange.
+        :param exchange:
+        :param exchange_type:
+        :return:
+        """
+        self.declared.append(("exchange", exchange))
+
+    def queue_declare(self, queue, **kwargs):
+        """
+        Records the queue and its arguments.
+        :param queue:
+        :param kwargs:
+        :return:
+        """
+        self.declared.append(("queue", queue))
+        self.arguments[queue] = kwargs.get("arguments")
+
+    def queue_bind(self, exchange, queue, routing_key):
+        """
+        Records the binding.
+        :param exchange:
+        :param queue:
+        :param routing_key:
+        :return:
+        """
+        self.declared.append(("binding", routing_key))
+        self.bindings.append((queue, routing_key))
+
+    def basic_qos(self, prefetch_count):
+        """
+        Records the prefetch count for the next consumer.
+        :param prefetch_count:
+        :return:
+        """
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False, arguments=None):
+        """
+        Records the consumer with its prefetch count.
+        :param queue:
+        :param on_message_callback:
+        :param auto_ack:
+        :param arguments:
+        :return: The consumer tag.
+        """
+        self.declared.append(("consumer", queue))
+        self.consumers.append((queue, self.prefetch_count, arguments))
+        return f"ctag{len(self.consumers)}"
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        """
+        Records the message as (routing_key, body, properties).
+        :param exchange:
+        :param routing_key:
+        :param body:
+        :param properties:
+        :return:
+        """
+        self.check_open()
+        self.published.append((routing_key, body, properties))
+
+    def basic_ack(self, delivery_tag):
+        """
+        Records the ack.
+        :param delivery_tag:
+        :return:
+        """
+        self.check_open()
+        self.acks.append(delivery_tag)
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        """
+        Records the reject.
+        :param delivery_tag:
+        :param requeue:
+        :return:
+        """
+        self.check_open()
+        self.rejects.append(delivery_tag)
+
+    def start_consuming(self):
+        """
+        Runs the behavior of the connection instead of consuming.
+        :return:
+        """
+        self.connection.on_consume(self)
+
+    def stop_consuming(self):
+        """
+        Does nothing, start_consuming returns anyway.
+        :return:
+        """
+
+
+class RecordingConnection:
+    """
+    Connection stand-in whose channels call on_consume with themselves instead of consuming.
+    """
+
+    def __init__(self, on_consume=None):
+        self.on_consume = on_consume
+        self.is_open = True
+        self.channels = []
+
+    def channel(self):
+        """
+        Opens a new channel.
+        :return:
+        """
+        channel = RecordingChannel(self)
+        self.channels.append(channel)
+        return channel
+
+    def call_later(self, delay, callback):
+        """
+        Ignores the timer.
+        :param delay:
+        :param callback:
+        :return:
+        """
+
+    def process_data_events(self, time_limit=None):
+        """
+        Nothing to process.
+        :param time_limit:
+        :return:
+        """
+
+    def close(self):
+        """
+        Closes the connection.
+        :return:
+        """
+        self.is_open = False
+
+
+class ImmediateConnection:
+    """
+    Connection or I/O loop stand-in which executes thread-safe callbacks immediately on the calling thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def add_callback_threadsafe(self, callback):
+        """
+        Executes the callback.
+        :param callback:
+        :return:
+        """
+        with self.lock:
+            callback()
@@ -0,0 +1,163 @@
+import threading
+from types import SimpleNamespace
+
+from src.broker import InMemoryBroker
+from src.config import Config
+from src.events import batch_event, find_event_lanes, read_event_lanes, write_event_manifest
+from src.pipeforce import BaseService, PipeforceClient
+from src.test.stubs import RecordingChannel, create_config, start_in_thread
+
+
+class BatchService(BaseService):
+    """
+    Service which receives its messages in batches and fails the first delivery of bodies marked with fail.
+    """
+
+    batches = []
+    failed = []
+    done = threading.Event()
+
+    @batch_event("batches.#", max_size=3, max_wait=0.05)
+    def on_batch(self, bodies: list[dict]):
+        """
+        Records the batch and fails the bodies with fail set on their first delivery.
+        :param bodies:
+        :return:
+        """
+        BatchService.batches.append(bodies)
+        if sum(len(batch) for batch in BatchService.batches) >= 6:
+            BatchService.done.set()
+
+        results = []
+        for body in bodies:
+            if body.get("fail") and body not in BatchService.failed:
+                BatchService.failed.append(body)
+                results.append(ValueError("failed"))
+            else:
+                results.append(None)
+        return results
+
+
+def batch_config() -> Config:
+    """
+    Creates the config of the batch service with short retry delays.
+    :return:
+    """
+    return create_config(PIPEFORCE_MESSAGING_RETRY_DELAY=0.05, PIPEFORCE_MESSAGING_RETRY_MAX_DELAY=0.05)
+
+
+def test_batches_are_passed_by_size_and_wait():
+    """
+    A batch is passed once it is full or by the timer of its first message. Failed messages are retried only.
+    :return:
+    """
+    client = PipeforceClient(batch_config())
+    client.find_event_mappings = lambda: [("batches.#", __name__ + ".BatchService#on_batch")]
+    client.load_mappings()
+    lane = client.lanes[0]
+    client.consumer_lanes = {"ctag1": lane}
+    timers = []
+    client.connection = SimpleNamespace(call_later=lambda delay, callback: timers.append((delay, callback)))
+    BatchService.batches = []
+    BatchService.failed = []
+    channel = RecordingChannel()
+
+    queue = client.config.PIPEFORCE_MESSAGING_QUEUE
+    assert lane.queue == queue + ".lane.batch-" + __name__ + ".BatchService.on_batch"
+    assert client.binding_keys() == []
+    assert client.lane_prefetch_count(lane) == 6
+
+    bodies = [b'{"a": 1}', b'{"fail": true}', b'{"a": 3}', b'{"a": 4}']
+    for tag, body in enumerate(bodies):
+        client.dispatch_message(channel, SimpleNamespace(routing_key="batches.x", delivery_tag=tag,
+                                                         consumer_tag="ctag1"), None, body)
+
+    assert BatchService.batches == [[{"a": 1}, {"fail": True}, {"a": 3}]]
+    assert channel.acks == [0, 1, 2]
+    assert channel.published[0][0] == lane.queue + ".retry.50"
+    assert channel.published[0][2].headers["x-pipeforce-handlers"] == [__name__ + ".BatchService#on_batch"]
+
+    # The first timer belongs to the batch passed by size already
+    assert [delay for delay, _ in timers] == [0.05, 0.05]
+    timers[0][1]()
+    assert len(BatchService.batches) == 1
+    timers[1][1]()
+    assert BatchService.batches[1] == [{"a": 4}]
+    assert channel.acks == [0, 1, 2, 3]
+
+
+def test_batches_are_reset_on_reconnect():
+    """
+    Messages collected from a lost connection are dropped on reconnect and the next message starts a new timer.
+    :return:
+    """
+    broker = InMemoryBroker()
+    client = broker.attach(PipeforceClient(batch_config()))
+    client.find_event_mappings = lambda: [("batches.#", __name__ + ".BatchService#on_batch")]
+    client.load_mappings()
+    lane = client.lanes[0]
+    client.consumer_lanes = {"ctag1": lane}
+    timers = []
+    client.connection = SimpleNamespace(call_later=lambda delay, callback: timers.append((delay, callback)))
+    BatchService.batches = []
+    lost_channel = RecordingChannel()
+    client.dispatch_message(lost_channel, SimpleNamespace(routing_key="batches.x", delivery_tag=1,
+                                                          consumer_tag="ctag1"), None, b'{"a": 1}')
+    lost_channel.is_open = False
+
+    client.connect()
+    broker.close()
+    assert not lane.buffer
+
+    client.connection = SimpleNamespace(call_later=lambda delay, callback: timers.append((delay, callback)))
+    client.consumer_lanes = {"ctag1": lane}
+    channel = RecordingChannel()
+    client.dispatch_message(channel, SimpleNamespace(routing_key="batches.x", delivery_tag=1, consumer_tag="ctag1"),
+                            None, b'{"a": 2}')
+
+    assert len(timers) == 2
+    timers[0][1]()
+    assert not BatchService.batches
+    timers[1][1]()
+    assert BatchService.batches == [[{"a": 2}]]
+    assert channel.acks == [1] and not lost_channel.acks
+
+
+def test_batches_on_in_memory_broker():
+    """
+    Batches are collected from the lane queue and failed messages come back in a later batch.
+    :return:
+    """
+    broker = InMemoryBroker()
+    client = broker.attach(PipeforceClient(batch_config()))
+    client.find_event_mappings = lambda: [("batches.#", __name__ + ".BatchService#on_batch")]
+    BatchService.batches = []
+    BatchService.failed = []
+    BatchService.done.clear()
+
+    thread = start_in_thread(client, lambda: client.consumer_lanes)
+
+    for index in range(5):
+        client.message_send("batches.created", {"index": index, "fail": index == 2})
+    assert BatchService.done.wait(5)
+    client.request_drain()
+    thread.join(5)
+
+    indexes = sorted(body["index"] for batch in BatchService.batches for body in batch)
+    assert indexes == [0, 1, 2, 2, 3, 4]
+    assert all(len(batch) <= 3 for batch in BatchService.batches)
+
+
+def test_batch_lanes_in_manifest(tmp_path):
+    """
+    The batch options are written to the event manifest and read from it.
+    :param tmp_path:
+    :return:
+    """
+    manifest = str(tmp_path / "event-manifest.json")
+    write_event_manifest(manifest, package="nonexisting")
+
+    options = {"priority": 0, "concurrency": 0, "max_size": 3, "max_wait": 0.05}
+    value = __name__ + ".BatchService#on_batch"
+    assert read_event_lanes(manifest)[value] == options
+    assert find_event_lanes()[value] == options
@@ -0,0 +1,231 @@
+import threading
+import time
+
+import pika
+
+from src.broker import InMemoryBroker
+from src.loadgen import EchoResponder, parse_args, run
+from src.pipeforce import BaseService, PipeforceClient
+from src.test.stubs import create_config, start_in_thread
+
+
+class BrokerService(BaseService):
+    """
+    Service which fails on the first delivery of a message and records the successful ones.
+    """
+
+    calls = []
+    done = threading.Event()
+
+    def handle(self, body: bytes):
+        """
+        Fails on the first attempt.
+        :param body:
+        :return:
+        """
+        BrokerService.calls.append(body)
+        if len(BrokerService.calls) == 1:
+            raise ValueError("failed")
+        BrokerService.done.set()
+
+
+class ForwardService(BaseService):
+    """
+    Service which forwards each message to another routing key.
+    """
+
+    def handle(self, body: bytes):
+        """
+        Sends the body on.
+        :param body:
+        :return:
+        """
+        self.client.message_send("forwarded.b", body)
+
+
+class SlowService(BaseService):
+    """
+    Service which blocks on its first message until the test lets it proceed.
+    """
+
+    calls = []
+    started = threading.Event()
+    proceed = threading.Event()
+
+    def handle(self, body: bytes):
+        """
+        Records the body and waits for the test on the first message.
+        :param body:
+        :return:
+        """
+        SlowService.calls.append(body)
+        SlowService.started.set()
+        SlowService.proceed.wait(5)
+
+
+def start_client(broker, mapping=("broker.#", __name__ + ".BrokerService#handle"), workers=0) -> tuple:
+    """
+    Starts a client consuming from the in-memory broker on a background thread.
+    :param broker:
+    :param mapping: The event mapping of the client.
+    :param workers: The size of the worker pool.
+    :return: The client and its thread.
+    """
+    config = create_config(PIPEFORCE_MESSAGING_RETRY_DELAY=0.05, PIPEFORCE_MESSAGING_RETRY_MAX_DELAY=0.05,
+                           PIPEFORCE_MESSAGING_WORKERS=workers)
+    client = broker.attach(PipeforceClient(config))
+    client.find_event_mappings = lambda: [mapping]
+
+    thread = start_in_thread(client, lambda: broker.consumer_count(config.PIPEFORCE_MESSAGING_QUEUE))
+    return client, thread
+
+
+def test_client_runs_on_in_memory_broker():
+    """
+    The client consumes, retries via the retry queue, acks and sends requests without RabbitMQ.
+    :return:
+    """
+    acks = []
+    broker = InMemoryBroker(on_ack=lambda queue, props, seconds: acks.append((queue, props.message_id)))
+    BrokerService.calls = []
+    BrokerService.done.clear()
+    client, thread = start_client(broker)
+    queue = client.config.PIPEFORCE_MESSAGING_QUEUE
+    responder = EchoResponder(broker, client.config)
+    responder.start()
+
+    channel = broker.connect().channel()
+    channel.basic_publish(exchange=client.config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC, routing_key="broker.a",
+                          body=b"hello", properties=pika.BasicProperties(message_id="m1"))
+
+    assert BrokerService.done.wait(5)
+    assert BrokerService.calls == [b"hello", b"hello"]
+    assert client.message_send_and_wait("pipeforce.loadgen.rpc", b"ping", timeout=5) == b"ping"
+
+    client.request_drain()
+    thread.join(5)
+    responder.stop()
+    broker.close()
+
+    assert not thread.is_alive()
+    # Acked once after moving it to the retry queue and once after it succeeded
+    assert [ack for ack in acks if ack[0] == queue] == [(queue, "m1"), (queue, "m1")]
+
+
+def test_messages_sent_by_workers_are_published_on_connection_thread():
+    """
+    Messages sent from the worker pool are published on the connection thread, since channels are not thread-safe.
+    :return:
+    """
+    broker = InMemoryBroker()
+    client, thread = start_client(broker, ("forward.#", __name__ + ".ForwardService#handle"), workers=2)
+    publish = client.channel.basic_publish
+    publishing_threads = []
+
+    def record_thread(**kwargs):
+        publishing_threads.append(threading.get_ident())
+        publish(**kwargs)
+
+    client.channel.basic_publish = record_thread
+    channel = broker.connect().channel()
+    channel.queue_declare(queue="forwarded")
+    channel.queue_bind(exchange=client.config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC, queue="forwarded",
+                       routing_key="forwarded.#")
+    for _ in range(3):
+        channel.basic_publish(exchange=client.config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC, routing_key="forward.a",
+                              body=b"x")
+
+    deadline = time.monotonic() + 5
+    while broker.message_count("forwarded") < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    client.request_drain()
+    thread.join(5)
+    broker.close()
+
+    assert broker.message_count("forwarded") == 3
+    assert publishing_threads == [thread.ident] * 3
+
+
+def test_unacked_messages_are_requeued_on_disconnect():
+    """
+    Messages not acknowledged before the connection is lost are delivered again as redelivered.
+    :return:
+    """
+    broker = InMemoryBroker()
+    deliveries = []
+    consumer = broker.connect().channel()
+    consumer.queue_declare(queue="q1")
+    consumer.basic_consume(queue="q1", on_message_callback=lambda *args: deliveries.append(args[1]))
+    consumer.basic_publish(exchange="", routing_key="q1", body=b"x")
+    consumer.connection.process_data_events()
+
+    broker.disconnect()
+    assert not consumer.connection.is_open
+    assert broker.message_count("q1") == 1
+
+    consumer = broker.connect().channel()
+    consumer.basic_consume(queue="q1", on_message_callback=lambda *args: deliveries.append(args[1]))
+    consumer.connection.process_data_events()
+
+    assert [method.redelivered for method in deliveries] == [False, True]
+
+
+def test_unacked_messages_survive_client_reconnect():
+    """
+    The service queue outlives the connection, so messages delivered but not acknowledged before the connection
+    was lost are processed after the client has reconnected.
+    :return:
+    """
+    broker = InMemoryBroker()
+    SlowService.calls = []
+    SlowService.started.clear()
+    SlowService.proceed.clear()
+    client, thread = start_client(broker, ("slow.#", __name__ + ".SlowService#handle"))
+    client.config.PIPEFORCE_MESSAGING_RECONNECT_DELAY = 0.01
+    queue = client.config.PIPEFORCE_MESSAGING_QUEUE
+    channel = broker.connect().channel()
+    for body in (b"1", b"2", b"3"):
+        channel.basic_publish(exchange=client.config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC, routing_key="slow.a",
+                              body=body)
+
+    assert SlowService.started.wait(5)
+    broker.disconnect()
+    SlowService.proceed.set()
+
+    deadline = time.monotonic() + 5
+    while not {b"1", b"2", b"3"} <= set(SlowService.calls) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    client.request_drain()
+    thread.join(5)
+    broker.close()
+
+    assert {b"1", b"2", b"3"} <= set(SlowService.calls)
+    assert broker.message_count(queue) == 0
+
+
+def test_load_generator_reports_latencies():
+    """
+    The load generator sends events and RPCs and reports all of them completed.
+    :return:
+    """
+    report = run(parse_args(["--rate", "400", "--duration", "0.25", "--keys", "load.a=3,load.b=1",
+                             "--sizes", "10,1000", "--rpc", "0.25", "--workers", "2", "--seed", "1"]))
+
+    assert report["drained"]
+    assert report["events"]["sent"] + report["rpc"]["sent"] == 100
+    assert report["events"]["completed"] == report["events"]["sent"]
+    assert report["rpc"]["completed"] == report["rpc"]["sent"]
+    assert report["events"]["latency_ms"]["p50"] <= report["events"]["latency_ms"]["max"]
+
+
+def test_load_generator_runs_service_package():
+    """
+    The documented --package service runs the @event service methods of the service package from any directory.
+    :return:
+    """
+    report = run(parse_args(["--rate", "200", "--duration", "0.1", "--keys", "pipeforce.webhook.foo.a",
+                             "--sizes", "10", "--package", "service", "--seed", "1"]))
+
+    assert report["drained"]
+    assert report["events"]["sent"] > 0
+    assert report["events"]["completed"] == report["events"]["sent"]
@@ -0,0 +1,107 @@
+import threading
+
+import pytest
+
+from src.cache import CommandCache
+from src.config import Config
+from src.metrics import Metrics
+from src.pipeforce import PipeforceClient
+
+
+def test_cache_ttl_and_lru(mocker):
+    """
+    Results expire after the TTL and the least recently used result is evicted first.
+    :param mocker:
+    :return:
+    """
+    now = mocker.patch("src.cache.time.monotonic", return_value=100.0)
+    cache = CommandCache(ttl=10, max_size=2)
+    load = mocker.Mock(side_effect=lambda: load.call_count)
+
+    assert cache.get("a", {"x": 1, "y": 2}, load) == 1
+    assert cache.get("a", {"y": 2, "x": 1}, load) == 1
+    assert cache.get("b", {}, load) == 2
+    assert cache.get("a", {"x": 1, "y": 2}, load) == 1
+    assert cache.get("c", {}, load) == 3
+    assert cache.get("b", {}, load) == 4
+
+    now.return_value = 111.0
+    assert cache.get("b", {}, load) == 5
+
+
+def test_cache_single_flight_and_errors():
+    """
+    Concurrent misses execute the command once, errors are passed to all waiters and are not cached.
+    :return:
+    """
+    metrics = Metrics()
+    cache = CommandCache(ttl=60, max_size=10, metrics=metrics)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def load():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {"value": 1}
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(cache.get("config.get", {}, load)))
+    first.start()
+    started.wait(5)
+    others = [threading.Thread(target=lambda: results.append(cache.get("config.get", {}, load))) for _ in range(3)]
+    for thread in others:
+        thread.start()
+    release.set()
+    for thread in [first] + others:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [{"value": 1}] * 4
+
+    def fail():
+        raise ValueError("Hub not reachable")
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            cache.get("failing", {}, fail)
+
+    output = metrics.render()
+    assert 'pipeforce_hub_cache_misses_total{command="config.get"} 1' in output
+    assert 'pipeforce_hub_cache_misses_total{command="failing"} 2' in output
+
+
+def test_client_run_command_cached_per_command(mocker):
+    """
+    Only the commands listed in PIPEFORCE_HUB_CACHE_COMMANDS are cached, unless requested otherwise.
+    :param mocker:
+    :return:
+    """
+    config = Config()
+    config.PIPEFORCE_NAMESPACE = "somens"
+    config.PIPEFORCE_SERVICE = "myservice"
+    config.PIPEFORCE_HUB_CACHE_COMMANDS = "property.list, config.get"
+    client = PipeforceClient(config)
+    mocker.patch("src.pipeforce.PipeforceClient.get_pipeforce_access_token", return_value="token")
+    do_post = mocker.patch("src.pipeforce.PipeforceClient.do_post", return_value={"result": "ok"})
+
+    for _ in range(3):
+        client.run_command("config.get", {"key": "a"})
+        client.run_command("data.put", {"key": "a"})
+    client.run_command("data.get", {"key": "a"}, cache=True)
+    client.run_command("data.get", {"key": "a"}, cache=True)
+    client.run_command("config.get", {"key": "a"}, cache=False)
+
+    assert [call.args[0].rsplit("/", 1)[1] for call in do_post.call_args_list].count("config.get") == 2
+    assert do_post.call_count == 1 + 3 + 1 + 1
+    assert 'pipeforce_hub_cache_hits_total{command="config.get"} 2' in client.metrics.render()
+
+    client.command_cache.invalidate("config.get")
+    client.run_command("config.get", {"key": "a"})
+    assert do_post.call_count == 7
+
+    # Commands executed concurrently use the cache as well
+    assert client.run_commands([("config.get", {"key": "a"}), ("data.put", {"key": "a"})]) == [{"result": "ok"}] * 2
+    assert do_post.call_count == 8
+    assert 'pipeforce_hub_cache_hits_total{command="config.get"} 3' in client.metrics.render()
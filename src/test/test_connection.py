@@ -0,0 +1,210 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pika
+import pytest
+
+from src.broker import InMemoryBroker
+from src.messaging import backoff_delay
+from src.pipeforce import AsyncPipeforceClient, PipeforceClient, PublishError, ReplyConsumer
+from src.retries import retry_queue_declarations
+from src.test.stubs import RecordingChannel, RecordingConnection, create_config
+
+
+def create_client() -> PipeforceClient:
+    """
+    Creates a client with two bindings and a short reconnect delay.
+    :return:
+    """
+    client = PipeforceClient(create_config(PIPEFORCE_MESSAGING_RECONNECT_DELAY=0.01,
+                                           PIPEFORCE_MESSAGING_RECONNECT_MAX_DELAY=0.02))
+    client.load_mappings = lambda: setattr(client, "mappings", [("a.*", "x.A#a"), ("b.#", "x.B#b")])
+    return client
+
+
+def lose_connection(channel):
+    """
+    Simulates a broker restart while consuming.
+    :param channel:
+    :return:
+    """
+    channel.is_open = False
+    channel.connection.is_open = False
+    return pika.exceptions.StreamLostError("Stream connection lost: ConnectionResetError(104)")
+
+
+def test_backoff_delay():
+    """
+    The delay doubles per attempt with jitter and is capped.
+    :return:
+    """
+    for attempt in range(100):
+        delay = backoff_delay(attempt, 1, 30)
+        expected = min(30, 2 ** attempt)
+        assert expected / 2 <= delay <= expected
+
+
+def test_reconnect_redeclares_and_flushes_outage_buffer(monkeypatch):
+    """
+    After the connection is lost, the client reconnects, declares exchange, queue and bindings again and
+    sends the messages buffered while disconnected. Failing to connect initially is not logged as lost connection.
+    :param monkeypatch:
+    :return:
+    """
+    client = create_client()
+    log_reconnect = client.log_reconnect
+    reconnects = []
+
+    def record_reconnect(reason, delay, attempt, connected):
+        reconnects.append((attempt, connected))
+        log_reconnect(reason, delay, attempt, connected)
+
+    client.log_reconnect = record_reconnect
+
+    def send_and_lose_connection(channel):
+        client.message_send("c.1", b"before")
+        error = lose_connection(channel)
+        client.message_send("c.2", b"during")
+        raise error
+
+    def drain(channel):
+        client.request_drain()
+
+    refused = pika.exceptions.AMQPConnectionError("Connection refused")
+    attempts = [refused, send_and_lose_connection, refused, drain]
+    connections = []
+
+    def connect(parameters):
+        attempt = attempts.pop(0)
+        if isinstance(attempt, Exception):
+            raise attempt
+        connections.append(RecordingConnection(attempt))
+        return connections[-1]
+
+    monkeypatch.setattr(pika, "BlockingConnection", connect)
+    client.start_consuming()
+    assert reconnects == [(1, False), (1, True), (2, True)]
+
+    first, second = connections[0].channels[0], connections[1].channels[0]
+    queue = client.config.PIPEFORCE_MESSAGING_QUEUE
+    retry_queues = [("queue", declaration["queue"]) for declaration in retry_queue_declarations(client.config)]
+    assert first.declared == second.declared == [
+        ("exchange", client.config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC), ("queue", queue), *retry_queues,
+        ("binding", "a.*"), ("binding", "b.#"), ("consumer", queue)]
+    assert [(routing_key, body) for routing_key, body, _ in first.published] == [("c.1", b"before")]
+    assert [(routing_key, body) for routing_key, body, _ in second.published] == [("c.2", b"during")]
+    assert not connections[1].is_open
+
+
+def test_outage_buffer_order_and_limit():
+    """
+    Messages sent while disconnected are published in order after reconnecting. A full buffer raises.
+    :return:
+    """
+    client = create_client()
+    client.config.PIPEFORCE_MESSAGING_OUTAGE_BUFFER_SIZE = 3
+    client.channel = RecordingChannel()
+    client.channel.is_open = False
+
+    for i in range(3):
+        client.message_send("a.b", f"message{i}".encode())
+    with pytest.raises(PublishError, match="buffer is full"):
+        client.message_send("a.b", b"dropped")
+
+    client.channel = RecordingChannel()
+    client.flush_outage_buffer()
+    client.message_send("a.b", b"message3")
+
+    assert [body for _, body, _ in client.channel.published] == [f"message{i}".encode() for i in range(4)]
+    assert not client.outage_buffer
+
+
+def test_ack_on_closed_channel():
+    """
+    Acknowledging a message of a lost channel does not fail, the broker redelivers it instead.
+    :return:
+    """
+    client = create_client()
+    channel = RecordingChannel()
+    channel.is_open = False
+
+    client.ack(channel, 1)
+    client.reject(channel, 2)
+
+
+def test_async_requests_fail_on_connection_loss():
+    """
+    The async client does not buffer requests while disconnected and fails the pending ones once the
+    connection is lost, instead of waiting for responses to a deleted reply queue.
+    :return:
+    """
+    client = AsyncPipeforceClient(create_config())
+
+    async def run():
+        client.loop = asyncio.get_running_loop()
+        with pytest.raises(PublishError):
+            await client.message_send_and_wait_async("a.b", b"request", timeout=5)
+
+        client.channel = RecordingChannel()
+        client.reply_queue = "amq.gen-replies"
+        request = client.loop.create_task(client.message_send_and_wait_async("a.b", b"request", timeout=5))
+        await asyncio.sleep(0)
+        client.fail_pending_replies(pika.exceptions.AMQPConnectionError("lost"))
+        with pytest.raises(pika.exceptions.AMQPConnectionError):
+            await request
+
+    asyncio.run(run())
+    assert client.channel.published[0][2].reply_to == "amq.gen-replies"
+    assert not client.outage_buffer and not client.pending_replies and client.reply_queue is None
+
+
+def test_reply_consumer_fails_pending_requests_on_stop():
+    """
+    Requests waiting for a response fail once the reply consumer was stopped and later requests fail immediately.
+    :return:
+    """
+    broker = InMemoryBroker()
+    consumer = ReplyConsumer(broker.attach(create_client()))
+    consumer.start()
+    errors = []
+
+    def request():
+        try:
+            consumer.request("a.b", b"request", 5)
+        except pika.exceptions.AMQPError as error:
+            errors.append(error)
+
+    thread = threading.Thread(target=request)
+    thread.start()
+    while not consumer.pending and thread.is_alive():
+        thread.join(0.01)
+    consumer.stop()
+    thread.join(1)
+    broker.close()
+
+    assert len(errors) == 1
+    with pytest.raises(PublishError):
+        consumer.request("a.b", b"request", 5)
+
+
+def test_async_client_closes_resources_when_stopped():
+    """
+    Like the sync client, the async client shuts down the hub worker pool and stops background token refreshes
+    once it was stopped.
+    :return:
+    """
+    client = AsyncPipeforceClient(create_config())
+    client.load_mappings = lambda: None
+    client.hub_executor = ThreadPoolExecutor(1)
+
+    async def connect_async():
+        client.stopped = True
+        raise pika.exceptions.AMQPConnectionError("Connection refused")
+
+    client.connect_async = connect_async
+    client.start_consuming()
+
+    assert client.token_manager.stopped
+    with pytest.raises(RuntimeError):
+        client.hub_executor.submit(print)
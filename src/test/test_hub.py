@@ -0,0 +1,252 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src.config import Config
+from src.pipeforce import PipeforceClient
+
+
+class StreamingHubHandler(BaseHTTPRequestHandler):
+    """
+    Hub stand-in which reads chunked uploads and answers with a chunked JSON array of one item per uploaded line.
+    """
+
+    protocol_version = "HTTP/1.1"
+    uploads = []
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """
+        Answers the request.
+        :return:
+        """
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                body += self.rfile.read(size + 2)[:size]
+                if size == 0:
+                    break
+        else:
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+        StreamingHubHandler.uploads.append(body)
+
+        if self.path.endswith("/failing") or self.path.endswith("/busy"):
+            self.send_response(503 if self.path.endswith("/busy") else 500)
+            self.send_header("Content-Length", "5")
+            self.end_headers()
+            self.wfile.write(b"error")
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        lines = body.decode().splitlines() or ["empty"]
+        parts = [b"["] + [json.dumps({"line": line}).encode() + b"," for line in lines[:-1]] + [
+            json.dumps({"line": lines[-1]}).encode() + b"]"]
+        for part in parts:
+            self.wfile.write(f"{len(part):x}\r\n".encode() + part + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """
+        Keeps the test output clean.
+        :return:
+        """
+
+
+@pytest.fixture(name="client")
+def client_fixture(mocker):
+    """
+    Creates a client calling a local streaming hub.
+    :param mocker:
+    :return:
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StreamingHubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    config = Config()
+    config.PIPEFORCE_NAMESPACE = "somens"
+    config.PIPEFORCE_SERVICE = "myservice"
+    config.PIPEFORCE_HUB_URL = f"http://127.0.0.1:{server.server_address[1]}"
+    config.PIPEFORCE_HUB_RETRY_BACKOFF = 0
+    mocker.patch("src.pipeforce.PipeforceClient.get_pipeforce_access_token", lambda self: "token")
+    StreamingHubHandler.uploads.clear()
+
+    yield PipeforceClient(config)
+    server.shutdown()
+
+
+def enable_retries(client, retry_post, status="502,503,504"):
+    """
+    Recreates the connection pool of the client with the given retry settings.
+    :param client:
+    :param retry_post: The value of PIPEFORCE_HUB_RETRY_POST.
+    :param status: The value of PIPEFORCE_HUB_RETRY_STATUS.
+    :return:
+    """
+    client.config.PIPEFORCE_HUB_RETRY_POST = retry_post
+    client.config.PIPEFORCE_HUB_RETRY_STATUS = status
+    client.http_adapter = client.create_http_adapter()
+    client.http_local.session = None
+
+
+def test_run_pipeline_stream_items_with_streamed_upload(client):
+    """
+    The pipeline is uploaded from an iterator and the JSON result is parsed item by item.
+    :param client:
+    :return:
+    """
+
+    def upload():
+        for i in range(3):
+            yield f"line{i}\n".encode()
+
+    items = client.run_pipeline_stream(upload(), items=True)
+
+    assert list(items) == [{"line": "line0"}, {"line": "line1"}, {"line": "line2"}]
+    assert StreamingHubHandler.uploads == [b"line0\nline1\nline2\n"]
+
+
+def test_iterator_uploads_are_not_retried_on_status(client):
+    """
+    An upload from an iterator is not retried on 503, since the exhausted iterator would be sent as empty body.
+    :param client:
+    :return:
+    """
+    url = client.config.PIPEFORCE_HUB_URL + "/api/v3/command/busy"
+
+    with pytest.raises(Exception, match="code: 503"):
+        client.do_post(url, data=(line for line in [b"line0\n", b"line1\n"]))
+    assert StreamingHubHandler.uploads == [b"line0\nline1\n"]
+    assert client.request_session(iter([])).get_adapter(url).max_retries.status == 0
+
+    StreamingHubHandler.uploads.clear()
+    enable_retries(client, retry_post=True)
+    with pytest.raises(Exception, match="code: 503"):
+        client.do_post(url, data=b"line0\n")
+    assert StreamingHubHandler.uploads == [b"line0\n"] * (client.config.PIPEFORCE_HUB_RETRIES + 1)
+
+
+def test_post_is_retried_on_503_only_when_enabled(client):
+    """
+    POST requests are not retried on status codes by default, and only on 503 once enabled, since the hub might
+    have processed them already.
+    :param client:
+    :return:
+    """
+    for path, retry_post, attempts in [("busy", False, 1), ("busy", True, 4), ("failing", True, 1)]:
+        enable_retries(client, retry_post, status="500,503")
+        StreamingHubHandler.uploads.clear()
+        with pytest.raises(Exception, match="code: 50"):
+            client.run_command(path, {"param": 1})
+        assert len(StreamingHubHandler.uploads) == attempts
+
+
+def test_run_command_stream_chunks(client):
+    """
+    Without items, the raw body is returned in chunks of at most chunk_size bytes.
+    :param client:
+    :return:
+    """
+    chunks = list(client.run_command_stream("some.command", {"param": 1}, chunk_size=4))
+
+    assert all(len(chunk) <= 4 for chunk in chunks)
+    assert json.loads(b"".join(chunks)) == [{"line": '{"param": 1}'}]
+
+    with pytest.raises(Exception, match="code: 500"):
+        client.run_command_stream("failing", {})
+
+
+class SlowCommandHandler(BaseHTTPRequestHandler):
+    """
+    Hub stand-in which answers commands slowly and records the max number of concurrent requests.
+    """
+
+    protocol_version = "HTTP/1.1"
+    lock = threading.Lock()
+    running = 0
+    max_running = 0
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """
+        Answers the request with the params of the command, fails the command named failing.
+        :return:
+        """
+        params = self.rfile.read(int(self.headers["Content-Length"]))
+        with SlowCommandHandler.lock:
+            SlowCommandHandler.running += 1
+            SlowCommandHandler.max_running = max(SlowCommandHandler.max_running, SlowCommandHandler.running)
+        time.sleep(0.05)
+        with SlowCommandHandler.lock:
+            SlowCommandHandler.running -= 1
+
+        status = 500 if self.path.endswith("/failing") else 200
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(params)))
+        self.end_headers()
+        self.wfile.write(params)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """
+        Keeps the test output clean.
+        :return:
+        """
+
+
+def test_run_commands_concurrently_in_order(mocker):
+    """
+    Commands are executed concurrently up to the limit and results are returned in order with per command errors.
+    :param mocker:
+    :return:
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowCommandHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    config = Config()
+    config.PIPEFORCE_NAMESPACE = "somens"
+    config.PIPEFORCE_SERVICE = "myservice"
+    config.PIPEFORCE_HUB_URL = f"http://127.0.0.1:{server.server_address[1]}"
+    config.PIPEFORCE_HUB_MAX_CONCURRENCY = 4
+    token = mocker.patch("src.pipeforce.PipeforceClient.get_pipeforce_access_token", return_value="token")
+    client = PipeforceClient(config)
+
+    commands = [("some.command", {"i": i}) for i in range(12)]
+    commands[5] = ("failing", {"i": 5})
+    try:
+        results = client.run_commands(commands)
+    finally:
+        server.shutdown()
+
+    assert [result["i"] for i, result in enumerate(results) if i != 5] == [i for i in range(12) if i != 5]
+    assert isinstance(results[5], Exception)
+    assert SlowCommandHandler.max_running == 4
+    assert token.call_count == 1
+
+
+def test_run_commands_packed(mocker):
+    """
+    Packed commands are executed by a single pipeline which returns all results.
+    :param mocker:
+    :return:
+    """
+    config = Config()
+    config.PIPEFORCE_NAMESPACE = "somens"
+    config.PIPEFORCE_SERVICE = "myservice"
+    client = PipeforceClient(config)
+    run_pipeline = mocker.patch("src.pipeforce.PipeforceClient.run_pipeline", return_value=["a", "b"])
+
+    assert client.run_commands([("first.command", {"x": 1}), ("second.command", None)], packed=True) == ["a", "b"]
+
+    pipeline = json.loads(run_pipeline.call_args.args[0])
+    assert pipeline["pipeline"] == [
+        {"first.command": {"x": 1, "output": "#{@vars.result0}"}},
+        {"second.command": {"output": "#{@vars.result1}"}},
+        {"body.set": {"value": "#{{@vars.result0, @vars.result1}}"}}]
+
+    run_pipeline.side_effect = Exception("Pipeline failed")
+    assert [str(error) for error in client.run_commands([("a", {}), ("b", {})], packed=True)] == ["Pipeline failed"] * 2
@@ -0,0 +1,160 @@
+from types import SimpleNamespace
+
+import pika
+import pytest
+
+from src.idempotency import IdempotencyStore, MemoryIdempotencyStore
+from src.pipeforce import BaseService, PipeforceClient
+from src.test.stubs import RecordingChannel, create_config
+from src.topics import RoutingIndex
+
+
+class CountingService(BaseService):
+    """
+    Service which records its calls and fails while failing is set.
+    """
+
+    calls = []
+    failing = False
+
+    def handle(self, body: dict):
+        """
+        Records the decoded body.
+        :param body:
+        :return:
+        """
+        CountingService.calls.append(body)
+        if CountingService.failing:
+            raise ValueError("failed")
+
+
+def create_client(mode) -> PipeforceClient:
+    """
+    Creates a client with deduplication enabled.
+    :param mode: The value of PIPEFORCE_MESSAGING_DEDUP.
+    :return:
+    """
+    client = PipeforceClient(create_config(PIPEFORCE_MESSAGING_DEDUP=mode))
+    client.mappings = [("a.*", __name__ + ".CountingService#handle")]
+    client.routing_index = RoutingIndex(client.mappings)
+    CountingService.calls = []
+    CountingService.failing = False
+    return client
+
+
+def test_memory_store_is_bounded_and_time_windowed(monkeypatch):
+    """
+    Keys are duplicates within the window only and the oldest keys are evicted beyond the max size.
+    :param monkeypatch:
+    :return:
+    """
+    now = [100.0]
+    monkeypatch.setattr("src.idempotency.time.monotonic", lambda: now[0])
+    config = SimpleNamespace(PIPEFORCE_MESSAGING_DEDUP_WINDOW=10, PIPEFORCE_MESSAGING_DEDUP_SIZE=2)
+    store = MemoryIdempotencyStore(config)
+
+    assert store.add(b"m1")
+    assert not store.add(b"m1")
+    assert store.add(b"m2")
+    assert store.add(b"m3")
+    assert len(store.entries) == 2
+    assert store.add(b"m1")
+
+    now[0] += 11
+    assert store.add(b"m3")
+    assert len(store.entries) == 1
+
+    store.remove(b"m3")
+    assert store.add(b"m3")
+
+
+def test_incomplete_store_fails_on_creation():
+    """
+    A store implementing add only cannot be created, instead of failing on the first message to retry.
+    :return:
+    """
+    class AddOnlyStore(IdempotencyStore):
+        """
+        Store without remove.
+        """
+
+        def add(self, key: bytes) -> bool:
+            """
+            Adds every key.
+            :param key:
+            :return:
+            """
+            return True
+
+    with pytest.raises(TypeError, match="remove"):
+        AddOnlyStore(SimpleNamespace(PIPEFORCE_MESSAGING_DEDUP_WINDOW=10))
+
+
+def test_duplicate_message_id_is_acked_without_running_handlers():
+    """
+    A redelivered message with the same message id is acknowledged without decoding it or calling the service.
+    :return:
+    """
+    client = create_client("message_id")
+    channel = RecordingChannel()
+    props = pika.BasicProperties(content_type="application/json", message_id="m1")
+
+    for tag in range(2):
+        client.dispatch_message(channel, SimpleNamespace(routing_key="a.b", delivery_tag=tag), props, b"{}")
+    client.dispatch_message(channel, SimpleNamespace(routing_key="a.b", delivery_tag=2), None, b"{}")
+
+    assert CountingService.calls == [{}, {}]
+    assert channel.acks == [0, 1, 2]
+    assert client.metrics.counters[("pipeforce_messages_duplicate_total", (("pattern", "a.*"),))] == 1
+
+
+def test_failed_message_is_not_a_duplicate_of_its_retry():
+    """
+    In body mode, a message whose service method failed is processed again when it comes back from the retry queue.
+    :return:
+    """
+    client = create_client("body")
+    channel = RecordingChannel()
+    CountingService.failing = True
+    client.dispatch_message(channel, SimpleNamespace(routing_key="a.b", delivery_tag=0), None, b'{"a": 1}')
+
+    _, _, retry_props = channel.published[0]
+    CountingService.failing = False
+    client.dispatch_message(channel, SimpleNamespace(routing_key="myservice.retry", delivery_tag=1), retry_props,
+                            b'{"a": 1}')
+    client.dispatch_message(channel, SimpleNamespace(routing_key="a.b", delivery_tag=2), None, b'{"a": 1}')
+    client.dispatch_message(channel, SimpleNamespace(routing_key="a.c", delivery_tag=3), None, b'{"a": 1}')
+
+    assert CountingService.calls == [{"a": 1}, {"a": 1}, {"a": 1}]
+    assert channel.acks == [0, 1, 2, 3]
+
+
+def test_duplicate_of_message_in_flight_is_deferred():
+    """
+    A message redelivered while the original is still processed is moved to the retry queue instead of being
+    skipped, so it is processed in case the original fails.
+    :return:
+    """
+    client = create_client("message_id")
+    channel = RecordingChannel()
+    props = pika.BasicProperties(content_type="application/json", message_id="m1")
+    original = SimpleNamespace(routing_key="a.b", delivery_tag=0)
+    assert client.claim_message(channel, original, props, b"{}", [])
+
+    client.dispatch_message(channel, SimpleNamespace(routing_key="a.b", delivery_tag=1), props, b"{}")
+    assert not CountingService.calls
+    assert channel.acks == [1]
+    queue, _, deferred_props = channel.published[0]
+    assert queue == client.config.PIPEFORCE_MESSAGING_QUEUE + ".retry.5000"
+    assert "x-pipeforce-attempts" not in deferred_props.headers
+    assert client.metrics.counters[("pipeforce_messages_deferred_total", ())] == 1
+
+    # The original fails on a lost channel, so its deferred duplicate is processed
+    lost_channel = RecordingChannel()
+    lost_channel.is_open = False
+    client.settle_message(lost_channel, original, props, b"{}", [("handle", "ValueError('failed')")])
+    client.dispatch_message(channel, SimpleNamespace(routing_key="myservice.retry", delivery_tag=2), deferred_props,
+                            b"{}")
+    assert CountingService.calls == [{}]
+    assert channel.acks == [1, 2]
+    assert not client.keys_in_flight
@@ -0,0 +1,191 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from src.broker import InMemoryBroker
+from src.events import event, find_event_lanes, read_event_lanes, write_event_manifest
+from src.pipeforce import BaseService, PipeforceClient
+from src.test.stubs import RecordingChannel, create_config, start_in_thread
+
+
+class LaneService(BaseService):
+    """
+    Service with a time-critical method in its own lane and a bulk method in the service queue.
+    """
+
+    threads = {}
+
+    @event("lanes.order.created", priority=9, concurrency=2)
+    def on_order(self, body):
+        """
+        Records the executing thread.
+        :param body:
+        :return:
+        """
+        LaneService.threads["order"] = threading.current_thread().name
+
+    @event("lanes.invoice.created", priority=5)
+    def on_invoice(self, body):
+        """
+        Records the executing thread.
+        :param body:
+        :return:
+        """
+        LaneService.threads["invoice"] = threading.current_thread().name
+
+    @event("lanes.webhook.#")
+    def on_webhook(self, body):
+        """
+        Records the executing thread.
+        :param body:
+        :return:
+        """
+        LaneService.threads["webhook"] = threading.current_thread().name
+
+
+class SlowService(BaseService):
+    """
+    Service of the service queue which is slow until the lane message was acknowledged.
+    """
+
+    lane_acked = threading.Event()
+
+    def handle(self, body):
+        """
+        Waits for the lane.
+        :param body:
+        :return:
+        """
+        SlowService.lane_acked.wait(5)
+
+
+def create_client() -> PipeforceClient:
+    """
+    Creates a client with the mappings of LaneService.
+    :return:
+    """
+    client = PipeforceClient(create_config())
+    client.find_event_mappings = lambda: [("lanes.order.created", __name__ + ".LaneService#on_order"),
+                                          ("lanes.webhook.#", __name__ + ".LaneService#on_webhook")]
+    client.load_mappings()
+    return client
+
+
+def test_lanes_are_set_up_per_priority_and_concurrency():
+    """
+    Service methods with priority or concurrency get their own queue and consumer with their own prefetch window.
+    :return:
+    """
+    client = create_client()
+    queue = client.config.PIPEFORCE_MESSAGING_QUEUE
+    lane_queue = queue + ".lane.p9-c2"
+
+    assert [lane.queue for lane in client.lanes] == [lane_queue]
+    assert client.binding_keys() == ["lanes.webhook.#"]
+
+    channel = RecordingChannel()
+    client.setup_lanes(channel)
+
+    assert channel.arguments[lane_queue] == {"x-max-priority": client.config.PIPEFORCE_MESSAGING_MAX_PRIORITY}
+    assert queue + ".lane.p9-c2.retry.5000" in channel.arguments
+    assert channel.bindings == [(lane_queue, "lanes.order.created")]
+    assert channel.consumers == [(lane_queue, 2, {"x-priority": 9})]
+    assert client.consumer_queue(SimpleNamespace(consumer_tag="ctag1")) == lane_queue
+    assert client.consumer_queue(SimpleNamespace(consumer_tag="other")) == queue
+
+
+def test_lane_messages_run_in_lane_workers():
+    """
+    Messages of a lane are executed by its own worker pool, others by the shared one.
+    :return:
+    """
+    client = create_client()
+    client.executor = client.create_executor()
+    client.create_lane_executors()
+    channel = RecordingChannel()
+    client.setup_lanes(channel)
+    client.connection = SimpleNamespace(add_callback_threadsafe=lambda callback: callback())
+
+    client.dispatch_message(channel, SimpleNamespace(routing_key="lanes.webhook.x", delivery_tag=1), None, b"{}")
+    client.dispatch_message(channel, SimpleNamespace(routing_key="lanes.order.created", delivery_tag=2,
+                                                     consumer_tag="ctag1"), None, b"{}")
+    for executor in client.lane_executors():
+        executor.shutdown(wait=True)
+
+    assert LaneService.threads["webhook"] == threading.current_thread().name
+    assert LaneService.threads["order"].startswith("pipeforce-worker")
+
+
+def test_lanes_without_concurrency_run_in_own_workers():
+    """
+    A lane with a priority only gets a worker of its own, even though other service methods run on the
+    connection thread.
+    :return:
+    """
+    client = create_client()
+    client.find_event_mappings = lambda: [("lanes.invoice.created", __name__ + ".LaneService#on_invoice")]
+    client.load_mappings()
+    client.executor = client.create_executor()
+    client.create_lane_executors()
+    channel = RecordingChannel()
+    client.setup_lanes(channel)
+    client.connection = SimpleNamespace(add_callback_threadsafe=lambda callback: callback())
+
+    client.dispatch_message(channel, SimpleNamespace(routing_key="lanes.invoice.created", delivery_tag=1,
+                                                     consumer_tag="ctag1"), None, b"{}")
+    for executor in client.lane_executors():
+        executor.shutdown(wait=True)
+
+    lane_queue = client.config.PIPEFORCE_MESSAGING_QUEUE + ".lane.p5"
+    assert client.executor is None
+    assert channel.consumers == [(lane_queue, client.config.PIPEFORCE_MESSAGING_PREFETCH_COUNT, {"x-priority": 5})]
+    assert LaneService.threads["invoice"].startswith("pipeforce-worker")
+
+
+def test_lanes_in_manifest(tmp_path):
+    """
+    The lane options are written to the event manifest and read from it.
+    :param tmp_path:
+    :return:
+    """
+    manifest = str(tmp_path / "event-manifest.json")
+    write_event_manifest(manifest, package="nonexisting")
+
+    value = __name__ + ".LaneService#on_order"
+    assert read_event_lanes(manifest)[value] == {"priority": 9, "concurrency": 2}
+    assert find_event_lanes()[value] == {"priority": 9, "concurrency": 2}
+    assert __name__ + ".LaneService#on_webhook" not in read_event_lanes(manifest)
+
+
+def test_slow_service_queue_does_not_hold_up_lanes():
+    """
+    Service methods of the service queue run in a worker as soon as there are lanes, so a slow one neither delays
+    the delivery nor the acknowledgement of lane messages.
+    :return:
+    """
+    acks = []
+
+    def on_ack(queue, props, seconds):
+        acks.append(queue)
+        if queue.endswith(".lane.p5"):
+            SlowService.lane_acked.set()
+
+    broker = InMemoryBroker(on_ack=on_ack)
+    client = broker.attach(PipeforceClient(create_config()))
+    client.find_event_mappings = lambda: [("lanes.slow", __name__ + ".SlowService#handle"),
+                                          ("lanes.invoice.created", __name__ + ".LaneService#on_invoice")]
+    SlowService.lane_acked.clear()
+    thread = start_in_thread(client, lambda: client.consumer_lanes)
+
+    channel = broker.connect().channel()
+    for key in ("lanes.slow", "lanes.invoice.created"):
+        channel.basic_publish(exchange=client.config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC, routing_key=key, body=b"{}")
+    deadline = time.monotonic() + 10
+    while len(acks) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    client.request_drain()
+    thread.join(5)
+    broker.close()
+
+    queue = client.config.PIPEFORCE_MESSAGING_QUEUE
+    assert acks == [queue + ".lane.p5", queue]
@@ -0,0 +1,45 @@
+import json
+import logging
+
+from src.logs import JsonFormatter, get_logger, setup_logging
+
+
+def test_json_formatter_fields():
+    """
+    Records are formatted as JSON with the structured fields given via extra.
+    :return:
+    """
+    record = logging.LogRecord("pipeforce", logging.INFO, __file__, 1, "Dispatched message: %s", ("some.key",), None)
+    record.routing_key = "some.key"
+    record.duration_ms = 1.5
+
+    entry = json.loads(JsonFormatter().format(record))
+
+    assert entry["level"] == "INFO"
+    assert entry["message"] == "Dispatched message: some.key"
+    assert entry["routing_key"] == "some.key"
+    assert entry["duration_ms"] == 1.5
+    assert "correlation_id" not in entry
+
+
+def test_setup_logging_skips_disabled_levels():
+    """
+    Messages below the configured level are never formatted.
+    :return:
+    """
+
+    class Counting:
+        """
+        Counts how often it was formatted.
+        """
+        count = 0
+
+        def __str__(self):
+            Counting.count += 1
+            return "counted"
+
+    logger = setup_logging("INFO")
+    logger.debug("Not formatted: %s", Counting())
+    get_logger("child").debug("Not formatted: %s", Counting())
+
+    assert Counting.count == 0
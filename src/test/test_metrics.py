@@ -0,0 +1,96 @@
+from types import SimpleNamespace
+from urllib.request import urlopen
+
+from src.config import Config
+from src.metrics import Metrics, MetricsServer, Profiler
+from src.pipeforce import PipeforceClient
+from src.topics import RoutingIndex
+
+
+def test_metrics_render():
+    """
+    Counters and histograms are rendered in the Prometheus text format with cumulative buckets.
+    :return:
+    """
+    metrics = Metrics()
+    metrics.inc("pipeforce_messages_received_total", (("routing_key", "some.key"),))
+    metrics.inc("pipeforce_messages_received_total", (("routing_key", "some.key"),))
+    metrics.observe("pipeforce_handler_duration_seconds", 0.002, buckets=(0.001, 0.01))
+    metrics.observe("pipeforce_handler_duration_seconds", 0.005, buckets=(0.001, 0.01))
+    metrics.observe("pipeforce_handler_duration_seconds", 5, buckets=(0.001, 0.01))
+    metrics.add_collector(lambda: [("pipeforce_token_hits_total", (), 7)])
+
+    lines = metrics.render().splitlines()
+
+    assert 'pipeforce_messages_received_total{routing_key="some.key"} 2' in lines
+    assert 'pipeforce_handler_duration_seconds_bucket{le="0.001"} 0' in lines
+    assert 'pipeforce_handler_duration_seconds_bucket{le="0.01"} 2' in lines
+    assert 'pipeforce_handler_duration_seconds_bucket{le="+Inf"} 3' in lines
+    assert "pipeforce_handler_duration_seconds_count 3" in lines
+    assert "pipeforce_token_hits_total 7" in lines
+
+
+def test_metrics_disabled_and_hooks():
+    """
+    Hooks receive each recorded value, disabled metrics record nothing.
+    :return:
+    """
+    recorded = []
+    metrics = Metrics()
+    metrics.add_hook(lambda kind, name, labels, value: recorded.append((kind, name, value)))
+    metrics.inc("some_total")
+    metrics.observe("some_seconds", 0.5)
+
+    assert recorded == [("counter", "some_total", 1), ("histogram", "some_seconds", 0.5)]
+
+    disabled = Metrics(enabled=False)
+    disabled.inc("some_total")
+    assert disabled.render() == "\n"
+
+
+def test_client_dispatch_metrics():
+    """
+    Dispatching a message counts it and records the duration of its service method.
+    :return:
+    """
+    config = Config()
+    config.PIPEFORCE_NAMESPACE = "somens"
+    config.PIPEFORCE_SERVICE = "myservice"
+    client = PipeforceClient(config)
+    client.mappings = [("pipeforce.#", __name__ + ".handle")]
+    client.routing_index = RoutingIndex(client.mappings)
+    client.handlers[__name__ + ".handle"] = lambda body: None
+    channel = SimpleNamespace(basic_ack=lambda delivery_tag: None)
+
+    client.dispatch_message(channel, SimpleNamespace(routing_key="pipeforce.some.key", delivery_tag=1), None, b"")
+    client.dispatch_message(channel, SimpleNamespace(routing_key="other.key", delivery_tag=2), None, b"")
+
+    output = client.metrics.render()
+    assert 'pipeforce_messages_received_total{pattern="pipeforce.#"} 1' in output
+    assert 'pipeforce_messages_received_total{pattern="unmatched"} 1' in output
+    assert 'pipeforce_message_duration_seconds_count{pattern="pipeforce.#"} 1' in output
+    assert "pipeforce_messages_unmatched_total 1" in output
+    assert "pipeforce_messages_acked_total 2" in output
+    assert 'pipeforce_handler_duration_seconds_count{handler="' + __name__ + '.handle"} 1' in output
+    assert "pipeforce_token_refreshes_total 0" in output
+
+
+def test_metrics_server():
+    """
+    The server exposes the metrics and the sampled profile via HTTP.
+    :return:
+    """
+    metrics = Metrics()
+    metrics.inc("some_total")
+    profiler = Profiler(sample_rate=1)
+    assert profiler.call(sorted, [3, 1, 2]) == [1, 2, 3]
+
+    server = MetricsServer(metrics, profiler, 0, host="127.0.0.1")
+    server.start()
+    try:
+        with urlopen(f"http://127.0.0.1:{server.port}/metrics") as response:
+            assert "some_total 1" in response.read().decode("utf-8")
+        with urlopen(f"http://127.0.0.1:{server.port}/profile") as response:
+            assert "sorted" in response.read().decode("utf-8")
+    finally:
+        server.stop()
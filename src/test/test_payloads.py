@@ -0,0 +1,153 @@
+import json
+import pickle
+from types import SimpleNamespace
+
+import pytest
+
+from src.config import Config
+from src.payloads import Payload, encode_payload, get_codec, iter_json_items, payload_converter
+from src.pipeforce import BaseService, PipeforceClient
+from src.topics import RoutingIndex
+
+
+class TypedService(BaseService):
+    """
+    Service declaring the payload types it expects.
+    """
+    received = []
+
+    def parsed(self, body: dict):
+        """
+        Gets the decoded body.
+        :param body:
+        :return:
+        """
+        TypedService.received.append(body)
+
+    def forward(self, body: Payload):
+        """
+        Gets the payload without decoding it.
+        :param body:
+        :return:
+        """
+        TypedService.received.append(body)
+
+    def raw(self, body):
+        """
+        Gets the raw body.
+        :param body:
+        :return:
+        """
+        TypedService.received.append(body)
+
+
+def test_payload_decodes_lazily_once(mocker):
+    """
+    The body is decoded on first access of value only.
+    :param mocker:
+    :return:
+    """
+    decode = mocker.spy(get_codec("application/json"), "decode")
+    payload = Payload(b'{"a": 1}', "application/json; charset=utf-8")
+
+    assert decode.call_count == 0
+    assert payload.value == {"a": 1}
+    assert payload.value == {"a": 1}
+    assert decode.call_count == 1
+    assert pickle.loads(pickle.dumps(payload)).value == {"a": 1}
+    assert isinstance(Payload(b"raw", "application/octet-stream").value, memoryview)
+
+
+def test_encode_payload():
+    """
+    Bytes are sent as they are, text as text/plain, payloads with their content type and values as JSON.
+    :return:
+    """
+    assert encode_payload(b"raw") == (b"raw", None)
+    assert encode_payload("text") == (b"text", "text/plain")
+    assert encode_payload({"a": [1]}) == (b'{"a":[1]}', "application/json")
+    assert encode_payload(Payload(b"data", "application/msgpack")) == (b"data", "application/msgpack")
+
+    with pytest.raises(ValueError, match="No codec registered"):
+        encode_payload({"a": 1}, "application/unknown")
+
+
+def test_payload_converter():
+    """
+    The argument type is taken from the annotation of the body parameter.
+    :return:
+    """
+    payload = Payload(b'{"a": 1}', "application/json")
+
+    assert payload_converter(TypedService.parsed)(payload) == {"a": 1}
+    assert payload_converter(TypedService.forward)(payload) is payload
+    assert payload_converter(TypedService.raw)(payload) == b'{"a": 1}'
+    assert payload_converter(lambda body: None)(payload) == b'{"a": 1}'
+
+
+def test_client_dispatch_typed_handlers():
+    """
+    All handlers of a message share the payload, which is decoded according to the content type of the message.
+    :return:
+    """
+    config = Config()
+    config.PIPEFORCE_NAMESPACE = "somens"
+    config.PIPEFORCE_SERVICE = "myservice"
+    client = PipeforceClient(config)
+    client.mappings = [("a.*", __name__ + ".TypedService#" + name) for name in ("parsed", "forward", "raw")]
+    client.routing_index = RoutingIndex(client.mappings)
+    client.resolve_handlers()
+    channel = SimpleNamespace(basic_ack=lambda delivery_tag: None)
+    TypedService.received.clear()
+
+    client.dispatch_message(channel, SimpleNamespace(routing_key="a.b", delivery_tag=1), None, b'{"a": 1}')
+
+    received = TypedService.received
+    assert received[0] == {"a": 1}
+    assert received[1].content_type == "application/json" and received[1].value is received[0]
+    assert received[2] == b'{"a": 1}'
+
+
+def test_client_extract_content_by_content_type():
+    """
+    Hub responses are decoded by the codec of their content type.
+    :return:
+    """
+    config = Config()
+    config.PIPEFORCE_NAMESPACE = "somens"
+    config.PIPEFORCE_SERVICE = "myservice"
+    client = PipeforceClient(config)
+
+    def response(content, content_type):
+        return SimpleNamespace(content=content, text=content.decode(), json=lambda: json.loads(content),
+                               headers={"Content-Type": content_type})
+
+    assert client.extract_content(response(b'{"a": 1}', "application/json;charset=UTF-8")) == {"a": 1}
+    assert client.extract_content(response(b'[1]', "text/plain")) == "[1]"
+    assert client.extract_content(response(b'[1]', "")) == [1]
+    assert client.extract_content(response(b'', "application/json")) is None
+
+
+def test_iter_json_items_across_chunks():
+    """
+    Items of a JSON array are parsed incrementally, no matter where the chunks are split.
+    :return:
+    """
+    document = '[{"a": 1}, 2, "x,]ä", [3, 4], 123, true]'.encode("utf-8")
+
+    for size in (1, 2, 7, len(document)):
+        chunks = (document[i:i + size] for i in range(0, len(document), size))
+        assert list(iter_json_items(chunks)) == [{"a": 1}, 2, "x,]ä", [3, 4], 123, True]
+
+    assert list(iter_json_items([b' {"a"', b': 1}'])) == [{"a": 1}]
+
+    # Numbers split across chunks are yielded once complete
+    assert list(iter_json_items([b"[1500.", b"5]"])) == [1500.5]
+    assert list(iter_json_items([b"[1e", b"3]"])) == [1000.0]
+    assert list(iter_json_items([b"[2.5E+", b"2]"])) == [250.0]
+    assert list(iter_json_items([b"[15", b"00]"])) == [1500]
+    assert list(iter_json_items([b"[1, -", b"2", b"0 ", b"]"])) == [1, -20]
+    with pytest.raises(ValueError, match="delimiter"):
+        list(iter_json_items([b"[1500.]"]))
+    with pytest.raises(ValueError, match="Unexpected end"):
+        list(iter_json_items([b"[1, 2"]))
@@ -0,0 +1,399 @@
+"""
+    Performance tests of the messaging and hub client. Run them using run-tests-performance.sh.
+
+    The measurements are printed. In case PIPEFORCE_PERFORMANCE_RESULTS is set, they are written to this JSON file.
+    In case PIPEFORCE_PERFORMANCE_BASELINE is set, they are compared to this file, for example
+    src/test/performance-baseline.json, and a measurement worse than its baseline value by more than
+    PIPEFORCE_PERFORMANCE_TOLERANCE (relative) fails the test. Since absolute values depend on the machine, record
+    the baseline on the machine running the tests by copying the results file over it.
+
+    Throughputs and latencies are the best of several rounds, so a single slow round does not fail the test.
+    The tests use in-process stand-ins and the in-memory broker. Set PIPEFORCE_PERFORMANCE_RABBITMQ_HOST to
+    additionally measure against a local RabbitMQ broker, for example started with:
+
+    > docker run -it --rm --name rabbitmq -p 5672:5672 rabbitmq:3.9-management
+"""
+import json
+import os
+import statistics
+import threading
+from time import perf_counter
+from types import SimpleNamespace
+
+import pika
+import pytest
+
+from src.broker import InMemoryBroker
+from src.loadgen import RPC_KEY, EchoResponder, wait_for_consumer
+from src.pipeforce import BaseService, PipeforceClient, ReplyConsumer
+from src.publisher import BatchPublisher
+from src.test.stubs import ImmediateConnection, RecordingChannel, create_config
+from src.topics import RoutingIndex
+
+RESULTS = os.getenv("PIPEFORCE_PERFORMANCE_RESULTS")
+BASELINE = os.getenv("PIPEFORCE_PERFORMANCE_BASELINE")
+TOLERANCE = float(os.getenv("PIPEFORCE_PERFORMANCE_TOLERANCE", "0.2"))
+RABBITMQ_HOST = os.getenv("PIPEFORCE_PERFORMANCE_RABBITMQ_HOST")
+# Rounds of each throughput measurement, the best one is recorded
+ROUNDS = 3
+
+
+@pytest.fixture(scope="module", name="report")
+def report_fixture():
+    """
+    Collects all measurements of this module and writes them to the results file afterwards, if one is given.
+    :return:
+    """
+    results = {}
+    yield results
+
+    if not RESULTS:
+        return
+
+    with open(RESULTS, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+
+
+def record(results, name, value, unit, higher_is_better=True):
+    """
+    Records the measurement and fails in case it regressed compared to the baseline, if one is given.
+    :param results:
+    :param name:
+    :param value:
+    :param unit:
+    :param higher_is_better: True for throughput, False for latencies.
+    :return:
+    """
+    results[name] = {"value": round(value, 3), "unit": unit, "higher_is_better": higher_is_better}
+    print(f"\n{name}: {value:.3f} {unit}")
+
+    if not BASELINE:
+        return
+
+    with open(BASELINE, encoding="utf-8") as file:
+        baseline = json.load(file).get(name)
+
+    if baseline is None:
+        print(f"{name}: No baseline, copy the results file over {BASELINE} to record one")
+        return
+
+    if higher_is_better:
+        limit = baseline["value"] * (1 - TOLERANCE)
+        assert value >= limit, f"{name} regressed: {value:.3f} {unit} < {limit:.3f} {unit} (baseline)"
+    else:
+        limit = baseline["value"] * (1 + TOLERANCE)
+        assert value <= limit, f"{name} regressed: {value:.3f} {unit} > {limit:.3f} {unit} (baseline)"
+
+
+def throughput(func, iterations):
+    """
+    Calls the function the given number of times per round and returns the calls per second of the best round.
+    :param func:
+    :param iterations:
+    :return:
+    """
+    best = 0
+    for _ in range(ROUNDS):
+        start = perf_counter()
+        for i in range(iterations):
+            func(i)
+        best = max(best, iterations / (perf_counter() - start))
+    return best
+
+
+def latencies(func, iterations) -> tuple:
+    """
+    Calls the function the given number of times per round and returns the p50 and p99 latency in milliseconds
+    of the best round.
+    :param func:
+    :param iterations:
+    :return:
+    """
+    best = None
+    for _ in range(ROUNDS):
+        durations = []
+        for i in range(iterations):
+            start = perf_counter()
+            func(i)
+            durations.append((perf_counter() - start) * 1000)
+        result = (percentile(durations, 50), percentile(durations, 99))
+        best = result if best is None else min(best, result, key=lambda percentiles: percentiles[1])
+    return best
+
+
+def percentile(values, percent):
+    """
+    Returns the given percentile of the values.
+    :param values:
+    :param percent:
+    :return:
+    """
+    return statistics.quantiles(values, n=100)[percent - 1]
+
+
+def create_client():
+    """
+    Creates a client with minimal settings.
+    :return:
+    """
+    config = create_config(PIPEFORCE_SECRET="Apitoken someApitoken", PIPEFORCE_TOKEN_BACKGROUND_REFRESH=False)
+    if RABBITMQ_HOST:
+        config.PIPEFORCE_MESSAGING_HOST = RABBITMQ_HOST
+    return PipeforceClient(config)
+
+
+def create_mappings(count):
+    """
+    Creates the given number of mappings with a mix of exact and wildcard keys.
+    :param count:
+    :return:
+    """
+    mappings = []
+    for i in range(count):
+        if i % 3 == 0:
+            key = f"pipeforce.webhook.service{i}.created"
+        elif i % 3 == 1:
+            key = f"pipeforce.webhook.service{i}.*"
+        else:
+            key = f"pipeforce.event.service{i}.#"
+        mappings.append((key, __name__ + ".NoopService#handle"))
+    return mappings
+
+
+def routing_keys(count):
+    """
+    Returns routing keys matching the mappings created by create_mappings.
+    :param count:
+    :return:
+    """
+    keys = []
+    for i in range(count):
+        if i % 3 == 2:
+            keys.append(f"pipeforce.event.service{i}.order.updated")
+        else:
+            keys.append(f"pipeforce.webhook.service{i}.created")
+    return keys
+
+
+class NoopService(BaseService):
+    """
+    Service doing nothing, to measure the dispatch overhead only.
+    """
+
+    def handle(self, body):
+        """
+        Does nothing.
+        :param body:
+        :return:
+        """
+
+
+def test_performance_amqp_match(report):
+    """
+    Measures the routing key lookup with 600 mappings, uncached and cached.
+    :param report:
+    :return:
+    """
+    mappings = create_mappings(600)
+    keys = routing_keys(600)
+
+    uncached = RoutingIndex(mappings, cache_size=0)
+    record(report, "amqp_match_uncached", throughput(lambda i: uncached.match(keys[i % 600]), 20000), "ops/s")
+
+    cached = RoutingIndex(mappings)
+    record(report, "amqp_match_cached", throughput(lambda i: cached.match(keys[i % 600]), 200000), "ops/s")
+
+
+def test_performance_dispatch(report):
+    """
+    Measures the dispatch overhead of a message to a service method with 600 mappings.
+    :param report:
+    :return:
+    """
+    client = create_client()
+    client.mappings = create_mappings(600)
+    client.routing_index = RoutingIndex(client.mappings)
+    client.resolve_handlers()
+    client.channel = RecordingChannel()
+    methods = [SimpleNamespace(routing_key=key, delivery_tag=1) for key in routing_keys(600)]
+
+    def dispatch(i):
+        client.dispatch_message(client.channel, methods[i % 600], None, b"body")
+
+    record(report, "dispatch", throughput(dispatch, 20000), "msg/s")
+
+
+def test_performance_message_send_buffered(report):
+    """
+    Measures the publish rate of message_send_buffered including the processing of publisher confirms.
+    :param report:
+    :return:
+    """
+    client = create_client()
+    publisher = BatchPublisher(client)
+    publisher.connection = SimpleNamespace(ioloop=ImmediateConnection())
+    publisher.channel = RecordingChannel()
+    client.publisher = publisher
+    count = 20000
+    best = 0
+
+    # Confirm each batch right after it was published, like a broker confirming with multiple=True
+    publish_buffered = publisher.publish_buffered
+
+    def publish_and_confirm():
+        publish_buffered()
+        publisher.on_confirm(SimpleNamespace(method=pika.spec.Basic.Ack(delivery_tag=publisher.delivery_tag,
+                                                                         multiple=True)))
+
+    publisher.publish_buffered = publish_and_confirm
+
+    for _ in range(ROUNDS):
+        start = perf_counter()
+        futures = [client.message_send_buffered("some.key", b"body") for _ in range(count)]
+        publisher.flush()
+        assert all(future.done() for future in futures)
+        best = max(best, count / (perf_counter() - start))
+
+    record(report, "message_send_buffered", best, "msg/s")
+
+
+def test_performance_message_send_and_wait(report):
+    """
+    Measures the round-trip latency of request/reply calls without network.
+    :param report:
+    :return:
+    """
+    consumer = ReplyConsumer(create_client())
+    consumer.queue = "amq.gen-replies"
+    consumer.connection = SimpleNamespace(add_callback_threadsafe=lambda callback: callback())
+    consumer.channel = SimpleNamespace(basic_publish=lambda **kwargs: consumer.on_reply(
+        None, None, SimpleNamespace(correlation_id=kwargs["properties"].correlation_id), kwargs["body"]))
+
+    p50, p99 = latencies(lambda i: consumer.request("some.key", b"body", 5), 5000)
+    record(report, "message_send_and_wait_p50", p50, "ms", higher_is_better=False)
+    record(report, "message_send_and_wait_p99", p99, "ms", higher_is_better=False)
+
+
+def test_performance_token_cache_hit(report, mocker):
+    """
+    Measures the cost of getting a cached access token.
+    :param report:
+    :param mocker:
+    :return:
+    """
+    client = create_client()
+    mocker.patch("src.pipeforce.PipeforceClient.do_post",
+                 lambda self, url, json=None, headers=None, data=None: {"access_token": "token", "expires_in": 300})
+    client.get_pipeforce_access_token()
+
+    record(report, "token_cache_hit", throughput(lambda i: client.get_pipeforce_access_token(), 200000), "ops/s")
+
+
+def test_performance_broker_dispatch(report):
+    """
+    Measures the end-to-end rate of messages published to the in-memory broker until the client has acknowledged them.
+    :param report:
+    :return:
+    """
+    count = 20000
+    acks = []
+    done = threading.Event()
+
+    def on_ack(queue, props, seconds):
+        acks.append(queue)
+        if len(acks) == count:
+            done.set()
+
+    broker = InMemoryBroker(on_ack=on_ack)
+    client = broker.attach(create_client())
+    client.find_event_mappings = lambda: create_mappings(600)
+    thread = threading.Thread(target=client.start_consuming, daemon=True)
+    thread.start()
+    wait_for_consumer(broker, client.config.PIPEFORCE_MESSAGING_QUEUE)
+    channel = broker.connect().channel()
+    keys = routing_keys(600)
+
+    start = perf_counter()
+    for i in range(count):
+        channel.basic_publish(exchange=client.config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC, routing_key=keys[i % 600],
+                              body=b"body")
+    assert done.wait(30)
+    duration = perf_counter() - start
+
+    client.request_drain()
+    thread.join(5)
+    broker.close()
+    record(report, "broker_dispatch", count / duration, "msg/s")
+
+
+def test_performance_broker_message_send_and_wait(report):
+    """
+    Measures the round-trip latency of request/reply calls answered by a responder on the in-memory broker.
+    :param report:
+    :return:
+    """
+    broker = InMemoryBroker()
+    client = broker.attach(create_client())
+    responder = EchoResponder(broker, client.config)
+    responder.start()
+
+    p50, p99 = latencies(lambda i: client.message_send_and_wait(RPC_KEY, b"body", timeout=5), 2000)
+    client.reply_consumer.stop()
+    responder.stop()
+    broker.close()
+    record(report, "broker_message_send_and_wait_p50", p50, "ms", higher_is_better=False)
+    record(report, "broker_message_send_and_wait_p99", p99, "ms", higher_is_better=False)
+
+
+@pytest.mark.skipif(not RABBITMQ_HOST, reason="PIPEFORCE_PERFORMANCE_RABBITMQ_HOST not set")
+def test_performance_rabbitmq_message_send(report):
+    """
+    Measures the publish rate with publisher confirms against a local RabbitMQ broker.
+    :param report:
+    :return:
+    """
+    client = create_client()
+    count = 20000
+
+    start = perf_counter()
+    results = client.message_send_batch((("pipeforce.performance.send", b"body") for _ in range(count)), timeout=30)
+    duration = perf_counter() - start
+    client.publisher.close()
+
+    assert not any(results)
+    record(report, "rabbitmq_message_send", count / duration, "msg/s")
+
+
+@pytest.mark.skipif(not RABBITMQ_HOST, reason="PIPEFORCE_PERFORMANCE_RABBITMQ_HOST not set")
+def test_performance_rabbitmq_message_send_and_wait(report):
+    """
+    Measures the round-trip latency of request/reply calls against a local RabbitMQ broker.
+    :param report:
+    :return:
+    """
+    client = create_client()
+    connection = pika.BlockingConnection(client.connection_parameters())
+    channel = connection.channel()
+    channel.exchange_declare(exchange=client.config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC, exchange_type='topic')
+    queue = channel.queue_declare(queue='', exclusive=True).method.queue
+    channel.queue_bind(exchange=client.config.PIPEFORCE_MESSAGING_DEFAULT_TOPIC, queue=queue,
+                       routing_key="pipeforce.performance.echo")
+
+    def echo(reply_channel, method, props, body):
+        reply_channel.basic_publish(exchange='', routing_key=props.reply_to, body=body,
+                         properties=pika.BasicProperties(correlation_id=props.correlation_id))
+
+    channel.basic_consume(queue=queue, on_message_callback=echo, auto_ack=True)
+    responder = threading.Thread(target=channel.start_consuming, daemon=True)
+    responder.start()
+
+    p50, p99 = latencies(lambda i: client.message_send_and_wait("pipeforce.performance.echo", b"body", timeout=5),
+                         1000)
+
+    connection.add_callback_threadsafe(channel.stop_consuming)
+    responder.join()
+    connection.close()
+    client.reply_consumer.stop()
+
+    record(report, "rabbitmq_message_send_and_wait_p50", p50, "ms", higher_is_better=False)
+    record(report, "rabbitmq_message_send_and_wait_p99", p99, "ms", higher_is_better=False)
@@ -1,7 +1,18 @@
+import asyncio
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
 import pytest
 
 from src.config import Config
-from src.pipeforce import PipeforceClient
+from src.pipeforce import AsyncPipeforceClient, BaseService, PipeforceClient, ReplyConsumer, event, find_event_mappings
+from src.events import read_event_manifest, write_event_manifest
+from src.test.stubs import ImmediateConnection, RecordingChannel
+from src.topics import RoutingIndex
 
 
 def test_client_config_empty():
@@ -76,3 +87,405 @@ def test_client_access_token_from_apitoken(mocker):
 
     token = client.get_pipeforce_access_token()
     assert token == "someAccessToken"
+
+
+def test_routing_index_match():
+    """
+    Test that exact and wildcard patterns are matched in the order of the mappings.
+    :return:
+    """
+    index = RoutingIndex({
+        "pipeforce.webhook.foo.*": "service.hello.HelloService#greeting",
+        "pipeforce.webhook.foo.bar": "service.hello.HelloService#bar",
+        "pipeforce.#": "service.hello.HelloService#everything",
+        "pipeforce.*.foo.#": "service.hello.HelloService#foo",
+    })
+
+    assert [v for _, v in index.match("pipeforce.webhook.foo.bar")] == [
+        "service.hello.HelloService#greeting",
+        "service.hello.HelloService#bar",
+        "service.hello.HelloService#everything",
+        "service.hello.HelloService#foo",
+    ]
+    assert [v for _, v in index.match("pipeforce.webhook.foo")] == [
+        "service.hello.HelloService#everything",
+        "service.hello.HelloService#foo",
+    ]
+    assert [v for _, v in index.match("pipeforce")] == ["service.hello.HelloService#everything"]
+    assert not index.match("other.webhook.foo.bar")
+    assert [v for _, v in index.match("pipeforce.webhook.foo.bar.baz")] == [
+        "service.hello.HelloService#everything",
+        "service.hello.HelloService#foo",
+    ]
+
+
+def test_routing_index_cache():
+    """
+    Test that lookup results are cached per routing key and the cache is bounded.
+    :return:
+    """
+    index = RoutingIndex({"a.*": "x.Y#a"}, cache_size=2)
+
+    assert index.match("a.b") is index.match("a.b")
+    index.match("a.c")
+    index.match("a.d")
+    assert list(index.cache.keys()) == ["a.c", "a.d"]
+
+
+def test_client_amqp_match():
+    """
+    Test the AMQP wildcard matching.
+    :return:
+    """
+    config = Config()
+    config.PIPEFORCE_NAMESPACE = "somens"
+    config.PIPEFORCE_SERVICE = "myservice"
+    client = PipeforceClient(config)
+
+    assert client.amqp_match("a.b.c", "a.b.c")
+    assert client.amqp_match("a.b.c", "a.*.c")
+    assert client.amqp_match("a.b.c", "a.#")
+    assert client.amqp_match("a", "a.#")
+    assert client.amqp_match("a.b.c", "#")
+    assert not client.amqp_match("a.b.c", "a.*")
+    assert not client.amqp_match("axb", "a.b")
+
+
+class SharedService(BaseService):
+    """
+    Service shared by all messages.
+    """
+
+    def handle(self, body):
+        """
+        Returns the instance to make it comparable.
+        :param body:
+        :return:
+        """
+        return self
+
+
+class StatefulService(SharedService):
+    """
+    Service created for each message.
+    """
+
+    instance_per_message = True
+
+
+def test_client_resolve_handler():
+    """
+    Test that handlers are resolved once and service instances are shared unless per message instances are requested.
+    :return:
+    """
+    config = Config()
+    config.PIPEFORCE_NAMESPACE = "somens"
+    config.PIPEFORCE_SERVICE = "myservice"
+    client = PipeforceClient(config)
+
+    shared = client.resolve_handler(__name__ + ".SharedService#handle")
+    assert shared is client.resolve_handler(__name__ + ".SharedService#handle")
+    assert shared("body") is shared("body")
+    assert shared("body").client is client
+
+    stateful = client.resolve_handler(__name__ + ".StatefulService#handle")
+    assert stateful("body") is not stateful("body")
+
+
+class AsyncService(BaseService):
+    """
+    Service with an async method.
+    """
+
+    running = 0
+    max_running = 0
+
+    async def handle(self, body):
+        """
+        Tracks how many calls run at the same time.
+        :param body:
+        :return:
+        """
+        AsyncService.running += 1
+        AsyncService.max_running = max(AsyncService.max_running, AsyncService.running)
+        await asyncio.sleep(0.01)
+        AsyncService.running -= 1
+        if body == b"fail":
+            raise ValueError("failed")
+
+
+def test_async_client_handle_message():
+    """
+    Test that async service methods run concurrently up to the limit and messages are acked after completion.
+    :return:
+    """
+    config = Config()
+    config.PIPEFORCE_NAMESPACE = "somens"
+    config.PIPEFORCE_SERVICE = "myservice"
+    config.PIPEFORCE_MESSAGING_MAX_CONCURRENCY = 2
+    client = AsyncPipeforceClient(config)
+    client.mappings = [("a.*", __name__ + ".AsyncService#handle")]
+    client.routing_index = RoutingIndex(client.mappings)
+    channel = RecordingChannel()
+
+    async def run():
+        client.loop = asyncio.get_running_loop()
+        client.semaphore = asyncio.Semaphore(config.PIPEFORCE_MESSAGING_MAX_CONCURRENCY)
+        await asyncio.gather(*[
+            client.handle_message(channel, SimpleNamespace(routing_key=key, delivery_tag=tag), None, body)
+            for tag, key, body in [(1, "a.b", b"ok"), (2, "a.c", b"ok"), (3, "a.d", b"fail"), (4, "x.y", b"ok")]])
+
+    asyncio.run(run())
+
+    assert AsyncService.max_running == 2
+    assert sorted(channel.acks) == [1, 2, 3, 4]
+    assert [(routing_key, body) for routing_key, body, _ in channel.published] == [
+        (config.PIPEFORCE_MESSAGING_QUEUE + ".retry.5000", b"fail")]
+
+
+class BarrierService(BaseService):
+    """
+    Service which only completes if two messages are processed in parallel.
+    """
+
+    barrier = threading.Barrier(2, timeout=5)
+
+    def handle(self, body):
+        """
+        Waits for the other message.
+        :param body:
+        :return:
+        """
+        BarrierService.barrier.wait()
+        if body == b"fail":
+            raise ValueError("failed")
+
+
+def test_client_dispatch_message_worker_pool():
+    """
+    Test that service methods are executed in parallel inside the worker pool and acks are marshalled back.
+    :return:
+    """
+    config = Config()
+    config.PIPEFORCE_NAMESPACE = "somens"
+    config.PIPEFORCE_SERVICE = "myservice"
+    config.PIPEFORCE_MESSAGING_WORKERS = 2
+    client = PipeforceClient(config)
+    client.mappings = [("a.*", __name__ + ".BarrierService#handle")]
+    client.routing_index = RoutingIndex(client.mappings)
+    client.executor = client.create_executor()
+    client.connection = ImmediateConnection()
+    client.channel = RecordingChannel()
+
+    client.dispatch_message(client.channel, SimpleNamespace(routing_key="a.b", delivery_tag=1), None, b"ok")
+    client.dispatch_message(client.channel, SimpleNamespace(routing_key="a.c", delivery_tag=2), None, b"fail")
+    client.executor.shutdown(wait=True)
+
+    assert sorted(client.channel.acks) == [1, 2]
+    assert [(routing_key, body) for routing_key, body, _ in client.channel.published] == [
+        (config.PIPEFORCE_MESSAGING_QUEUE + ".retry.5000", b"fail")]
+
+
+class EchoChannel(RecordingChannel):
+    """
+    Channel stand-in which answers each published request with its reversed payload after a short delay.
+    Requests to the key "no.answer" are never answered.
+    """
+
+    def __init__(self, on_reply):
+        super().__init__()
+        self.on_reply = on_reply
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        """
+        Records and answers the request.
+        :param exchange:
+        :param routing_key:
+        :param body:
+        :param properties:
+        :return:
+        """
+        super().basic_publish(exchange, routing_key, body, properties)
+        if routing_key == "no.answer":
+            return
+        reply_props = SimpleNamespace(correlation_id=properties.correlation_id)
+        threading.Timer(0.05, self.on_reply, args=(None, None, reply_props, body[::-1])).start()
+
+
+def test_reply_consumer_concurrent_requests():
+    """
+    Test that many requests can wait for their responses at the same time and are matched by correlation id.
+    :return:
+    """
+    config = Config()
+    config.PIPEFORCE_NAMESPACE = "somens"
+    config.PIPEFORCE_SERVICE = "myservice"
+    consumer = ReplyConsumer(PipeforceClient(config))
+    consumer.queue = "amq.gen-replies"
+    consumer.connection = ImmediateConnection()
+    consumer.channel = EchoChannel(consumer.on_reply)
+
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        payloads = [f"request{i}".encode() for i in range(20)]
+        results = list(executor.map(lambda payload: consumer.request("some.key", payload, 5), payloads))
+
+    assert results == [payload[::-1] for payload in payloads]
+    assert not consumer.pending
+
+    with pytest.raises(TimeoutError):
+        consumer.request("no.answer", b"request", 0.1)
+    assert not consumer.pending
+
+
+def test_async_client_message_send_and_wait():
+    """
+    Test that the asyncio client waits for responses without blocking the event loop.
+    :return:
+    """
+    config = Config()
+    config.PIPEFORCE_NAMESPACE = "somens"
+    config.PIPEFORCE_SERVICE = "myservice"
+    client = AsyncPipeforceClient(config)
+
+    async def run():
+        client.loop = asyncio.get_running_loop()
+        client.channel = EchoChannel(
+            lambda *args: client.loop.call_soon_threadsafe(client.on_reply, *args))
+        client.reply_queue = "amq.gen-replies"
+        results = await asyncio.gather(*[client.message_send_and_wait_async("some.key", b"ab" + bytes([i]), 5)
+                                         for i in range(65, 75)])
+        with pytest.raises(TimeoutError):
+            await client.message_send_and_wait_async("no.answer", b"request", 0.1)
+        return results
+
+    results = asyncio.run(run())
+    assert results == [bytes([i]) + b"ba" for i in range(65, 75)]
+    assert not client.pending_replies
+
+
+class FlakyHubHandler(BaseHTTPRequestHandler):
+    """
+    Hub stand-in which fails the first request with 503 and answers all others with JSON.
+    """
+
+    protocol_version = "HTTP/1.1"
+    requests = 0
+    client_ports = set()
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """
+        Answers the request.
+        :return:
+        """
+        self.rfile.read(int(self.headers["Content-Length"]))
+        FlakyHubHandler.requests += 1
+        FlakyHubHandler.client_ports.add(self.client_address[1])
+        status, body = (503, b"") if FlakyHubHandler.requests == 1 else (200, b'{"result": "ok"}')
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """
+        Keeps the test output clean.
+        :return:
+        """
+
+
+def test_client_do_post_pooled_with_retry():
+    """
+    Test that requests to the hub are retried on 503 once enabled and reuse the same keep-alive connection.
+    :return:
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    config = Config()
+    config.PIPEFORCE_NAMESPACE = "somens"
+    config.PIPEFORCE_SERVICE = "myservice"
+    config.PIPEFORCE_HUB_RETRY_BACKOFF = 0
+    config.PIPEFORCE_HUB_RETRY_POST = True
+    client = PipeforceClient(config)
+
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/api/v3/command/some.command"
+        assert client.do_post(url, json={"param": 1}) == {"result": "ok"}
+        assert client.do_post(url, json={"param": 2}) == {"result": "ok"}
+    finally:
+        server.shutdown()
+
+    assert FlakyHubHandler.requests == 3
+    assert len(FlakyHubHandler.client_ports) == 1
+
+
+class DecoratedService(BaseService):
+    """
+    Service mapped by decorators.
+    """
+
+    @event('decorated.single')
+    def single(self, body):
+        """
+        Single key.
+        :param body:
+        :return:
+        """
+
+    @event("decorated.first.*",
+           "decorated.second.#")
+    @event("decorated.third")
+    async def multiple(self, body):
+        """
+        Multiple keys.
+        :param body:
+        :return:
+        """
+
+
+def test_event_decorator_registry():
+    """
+    Test that the @event decorator registers its keys at import time.
+    :return:
+    """
+    mappings = find_event_mappings(package="nonexisting")
+    value = __name__ + ".DecoratedService#"
+
+    assert ("decorated.single", value + "single") in mappings
+    assert [key for key, handler in mappings if handler == value + "multiple"] == [
+        "decorated.third", "decorated.first.*", "decorated.second.#"]
+    assert asyncio.iscoroutinefunction(DecoratedService.multiple)
+
+
+def test_client_load_mappings_from_manifest(tmp_path):
+    """
+    Test that mappings can be loaded from a manifest and handlers are resolved lazily.
+    :param tmp_path:
+    :return:
+    """
+    manifest = str(tmp_path / "event-manifest.json")
+    write_event_manifest(manifest, package="nonexisting")
+
+    config = Config()
+    config.PIPEFORCE_NAMESPACE = "somens"
+    config.PIPEFORCE_SERVICE = "myservice"
+    config.PIPEFORCE_EVENT_MANIFEST = manifest
+    client = PipeforceClient(config)
+    client.load_mappings()
+
+    assert client.mappings == find_event_mappings(package="nonexisting")
+    assert not client.handlers
+    assert [value for _, value in client.routing_index.match("decorated.second.x.y")] == [
+        __name__ + ".DecoratedService#multiple"]
+
+
+def test_manifest_script_from_repository_root(tmp_path):
+    """
+    Test that the documented python -m src.manifest writes the mappings of the service package.
+    :param tmp_path:
+    :return:
+    """
+    manifest = str(tmp_path / "event-manifest.json")
+    subprocess.run([sys.executable, "-m", "src.manifest", manifest], check=True)
+
+    assert ("pipeforce.webhook.foo.*", "service.hello.HelloService#greeting") in read_event_manifest(manifest)
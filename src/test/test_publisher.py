@@ -0,0 +1,113 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pika
+import pytest
+
+from src.pipeforce import PipeforceClient
+from src.publisher import BatchPublisher, PublishError
+from src.test.stubs import ImmediateConnection, RecordingChannel, create_config
+
+
+def create_publisher(batch_size):
+    """
+    Creates a client and a publisher using stand-ins instead of a broker connection.
+    :param batch_size:
+    :return:
+    """
+    client = PipeforceClient(create_config(PIPEFORCE_MESSAGING_BATCH_SIZE=batch_size))
+    publisher = BatchPublisher(client)
+    publisher.connection = SimpleNamespace(ioloop=ImmediateConnection())
+    publisher.channel = RecordingChannel()
+    client.publisher = publisher
+    return client, publisher
+
+
+def confirm(publisher, method_class, delivery_tag, multiple=False):
+    """
+    Simulates a confirmation from the broker.
+    :param publisher:
+    :param method_class:
+    :param delivery_tag:
+    :param multiple:
+    :return:
+    """
+    publisher.on_confirm(SimpleNamespace(method=method_class(delivery_tag=delivery_tag, multiple=multiple)))
+
+
+def test_publisher_batches_and_confirms():
+    """
+    Test that messages are published once the batch is full and futures reflect the confirmations.
+    :return:
+    """
+    client, publisher = create_publisher(batch_size=3)
+
+    futures = [client.message_send_buffered("some.key", f"message{i}") for i in range(5)]
+    assert len(publisher.channel.published) == 3
+    assert len(publisher.buffer) == 2
+
+    publisher.publish_buffered()
+    assert [body for _, body, _ in publisher.channel.published] == [f"message{i}".encode() for i in range(5)]
+
+    confirm(publisher, pika.spec.Basic.Ack, 2, multiple=True)
+    confirm(publisher, pika.spec.Basic.Nack, 3)
+    confirm(publisher, pika.spec.Basic.Ack, 5)
+    publisher.fail_all(PublishError("Connection lost"))
+
+    assert [future.result() for future in futures[:2]] == [1, 2]
+    assert futures[4].result() == 5
+    with pytest.raises(PublishError, match="rejected"):
+        futures[2].result()
+    with pytest.raises(PublishError, match="Connection lost"):
+        futures[3].result()
+    assert not publisher.unconfirmed
+
+
+def test_publisher_fails_rest_of_batch_on_publish_error():
+    """
+    Test that a failing publish fails the futures of the message and the rest of the batch and frees their permits.
+    :return:
+    """
+    client, publisher = create_publisher(batch_size=10)
+    futures = [client.message_send_buffered("some.key", f"message{i}") for i in range(3)]
+    publish = publisher.channel.basic_publish
+
+    def publish_once(**kwargs):
+        publish(**kwargs)
+        publisher.channel.is_open = False
+
+    publisher.channel.basic_publish = publish_once
+    publisher.publish_buffered()
+
+    assert list(publisher.unconfirmed) == [1] and publisher.delivery_tag == 1
+    for future in futures[1:]:
+        with pytest.raises(PublishError, match="not published"):
+            future.result(0)
+    # Only the permit of the unconfirmed message is still taken
+    publisher.pending.release()
+    with pytest.raises(ValueError):
+        publisher.pending.release()
+
+
+def test_client_message_send_batch():
+    """
+    Test that message_send_batch reports the result of each message in order.
+    :return:
+    """
+    client, publisher = create_publisher(batch_size=100)
+
+    def confirm_when_published():
+        while len(publisher.channel.published) < 3:
+            time.sleep(0.01)
+        confirm(publisher, pika.spec.Basic.Ack, 1)
+        confirm(publisher, pika.spec.Basic.Nack, 2)
+        confirm(publisher, pika.spec.Basic.Ack, 3)
+
+    threading.Thread(target=confirm_when_published, daemon=True).start()
+    results = client.message_send_batch([("some.key", "message1"), ("some.key", "message2"),
+                                         ("some.key", "message3")], timeout=5)
+
+    assert results[0] is None
+    assert isinstance(results[1], PublishError)
+    assert results[2] is None
@@ -0,0 +1,106 @@
+from types import SimpleNamespace
+
+import pika
+
+from src.pipeforce import BaseService, PipeforceClient
+from src.retries import ATTEMPTS_HEADER, HANDLERS_HEADER, ROUTING_KEY_HEADER, retry_queue_declarations
+from src.test.stubs import RecordingChannel, create_config
+from src.topics import RoutingIndex
+
+
+class FlakyService(BaseService):
+    """
+    Service with a failing and a succeeding method.
+    """
+
+    calls = []
+
+    def fail(self, body):
+        """
+        Always fails.
+        :param body:
+        :return:
+        """
+        FlakyService.calls.append("fail")
+        raise ValueError("failed")
+
+    def succeed(self, body):
+        """
+        Records the call.
+        :param body:
+        :return:
+        """
+        FlakyService.calls.append("succeed")
+
+
+def create_client() -> PipeforceClient:
+    """
+    Creates a client with a failing and a succeeding service method mapped to the same key.
+    :return:
+    """
+    client = PipeforceClient(create_config(PIPEFORCE_MESSAGING_MAX_ATTEMPTS=3, PIPEFORCE_MESSAGING_RETRY_DELAY=5,
+                                           PIPEFORCE_MESSAGING_RETRY_MAX_DELAY=8))
+    client.mappings = [("a.*", __name__ + ".FlakyService#fail"), ("a.*", __name__ + ".FlakyService#succeed")]
+    client.routing_index = RoutingIndex(client.mappings)
+    FlakyService.calls = []
+    return client
+
+
+def test_retry_queue_declarations():
+    """
+    There is one retry queue per distinct delay, dead-lettering back into the service queue.
+    :return:
+    """
+    config = create_client().config
+    config.PIPEFORCE_MESSAGING_MAX_ATTEMPTS = 5
+
+    declarations = retry_queue_declarations(config)
+
+    assert [declaration["queue"] for declaration in declarations] == [
+        config.PIPEFORCE_MESSAGING_DEFAULT_DLQ, config.PIPEFORCE_MESSAGING_QUEUE + ".retry.5000",
+        config.PIPEFORCE_MESSAGING_QUEUE + ".retry.8000"]
+    assert declarations[2]["arguments"] == {"x-message-ttl": 8000, "x-dead-letter-exchange": "",
+                                            "x-dead-letter-routing-key": config.PIPEFORCE_MESSAGING_QUEUE}
+
+
+def test_failed_handler_is_retried_then_dead_lettered():
+    """
+    A failing service method does not stop the others. The message is retried for the failed one only
+    with growing delay and moved to the dead letter queue after the max attempts.
+    :return:
+    """
+    client = create_client()
+    queue = client.config.PIPEFORCE_MESSAGING_QUEUE
+    channel = RecordingChannel()
+    props = pika.BasicProperties(content_type="text/plain", correlation_id="c1")
+
+    for tag in range(3):
+        client.dispatch_message(channel, SimpleNamespace(routing_key="a.b", delivery_tag=tag), props, b"body")
+        # The retry queue dead-letters the message back into the service queue
+        routing_key, _, props = channel.published[-1]
+        assert props.correlation_id == "c1"
+
+    assert FlakyService.calls == ["fail", "succeed", "fail", "fail"]
+    assert channel.acks == [0, 1, 2]
+    assert [routing_key for routing_key, _, _ in channel.published] == [
+        queue + ".retry.5000", queue + ".retry.8000", client.config.PIPEFORCE_MESSAGING_DEFAULT_DLQ]
+
+    headers = props.headers
+    assert headers[ATTEMPTS_HEADER] == 4
+    assert headers[ROUTING_KEY_HEADER] == "a.b"
+    assert headers[HANDLERS_HEADER] == [__name__ + ".FlakyService#fail"]
+
+
+def test_worker_failure_retries_all_handlers():
+    """
+    In case the worker fails as a whole, all service methods are retried.
+    :return:
+    """
+    client = create_client()
+    channel = RecordingChannel()
+
+    client.settle_message(channel, SimpleNamespace(routing_key="a.b", delivery_tag=1), None, b"body", None)
+
+    _, _, props = channel.published[0]
+    assert HANDLERS_HEADER not in props.headers
+    assert channel.acks == [1]
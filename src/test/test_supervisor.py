@@ -0,0 +1,106 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from src.config import Config
+from src.pipeforce import PipeforceClient
+from src.supervisor import Supervisor
+
+
+class FakeClient:
+    """
+    Client stand-in which crashes once per worker and otherwise records its lifecycle in files.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.drained = threading.Event()
+
+    def request_drain(self):
+        """
+        Stops consuming.
+        :return:
+        """
+        self.drained.set()
+
+    def start_consuming(self):
+        """
+        Crashes on first start, otherwise consumes until drained.
+        :return:
+        """
+        directory = self.config.PIPEFORCE_TEST_DIRECTORY
+        crashed = os.path.join(directory, f"crashed-{self.config.PIPEFORCE_METRICS_PORT}")
+        if not os.path.exists(crashed):
+            with open(crashed, "w", encoding="utf-8"):
+                os._exit(1)  # pylint: disable=protected-access
+
+        with open(os.path.join(directory, f"started-{os.getpid()}"), "w", encoding="utf-8"):
+            pass
+        self.drained.wait()
+        with open(os.path.join(directory, f"drained-{os.getpid()}"), "w", encoding="utf-8"):
+            pass
+
+
+def test_supervisor_restarts_and_drains_workers(tmp_path):
+    """
+    Crashed workers are restarted and all workers are drained on stop.
+    :param tmp_path:
+    :return:
+    """
+    config = Config()
+    config.PIPEFORCE_MESSAGING_PROCESSES = 2
+    config.PIPEFORCE_MESSAGING_RESTART_DELAY = 0.1
+    config.PIPEFORCE_METRICS_PORT = 1
+    config.PIPEFORCE_TEST_DIRECTORY = str(tmp_path)
+    supervisor = Supervisor(config, FakeClient)
+
+    def stop_when_started():
+        deadline = time.monotonic() + 10
+        while len(list(tmp_path.glob("started-*"))) < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        supervisor.request_stop()
+
+    threading.Thread(target=stop_when_started, daemon=True).start()
+    supervisor.run()
+
+    assert sorted(path.name for path in tmp_path.glob("crashed-*")) == ["crashed-1", "crashed-2"]
+    started = {path.name.split("-")[1] for path in tmp_path.glob("started-*")}
+    drained = {path.name.split("-")[1] for path in tmp_path.glob("drained-*")}
+    assert len(started) == 2 and started == drained
+    assert all(process.exitcode == 0 for process in supervisor.processes)
+
+
+def test_client_drain_finishes_in_flight_messages():
+    """
+    Draining stops consuming and acknowledges all messages in-flight before the client stops.
+    :return:
+    """
+    config = Config()
+    config.PIPEFORCE_NAMESPACE = "somens"
+    config.PIPEFORCE_SERVICE = "myservice"
+    client = PipeforceClient(config)
+    callbacks = []
+    acks = []
+    client.channel = SimpleNamespace(stop_consuming=lambda: acks.append("stopped"),
+                                     basic_ack=acks.append)
+    client.connection = SimpleNamespace(
+        call_later=lambda delay, callback: None,
+        add_callback_threadsafe=callbacks.append,
+        process_data_events=lambda time_limit: [callback() for callback in callbacks])
+    client.executor = ThreadPoolExecutor(max_workers=2)
+    for tag in range(4):
+        future = client.executor.submit(lambda: time.sleep(0.05) or [])
+        future.add_done_callback(lambda future, tag=tag: client.on_handlers_done(
+            client.channel, SimpleNamespace(routing_key="a.b", delivery_tag=tag), None, b"", future))
+
+    client.check_drain()
+    assert not acks
+
+    client.request_drain()
+    client.check_drain()
+    client.finish_in_flight()
+
+    assert acks[0] == "stopped"
+    assert sorted(acks[1:]) == [0, 1, 2, 3]
@@ -0,0 +1,123 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.config import Config
+from src.pipeforce import PipeforceClient
+
+
+def create_client(secret):
+    """
+    Creates a client with minimal settings and background refresh disabled.
+    :param secret:
+    :return:
+    """
+    config = Config()
+    config.PIPEFORCE_NAMESPACE = "somens"
+    config.PIPEFORCE_SERVICE = "myservice"
+    config.PIPEFORCE_SECRET = secret
+    config.PIPEFORCE_TOKEN_BACKGROUND_REFRESH = False
+    return PipeforceClient(config)
+
+
+def test_token_single_flight(mocker):
+    """
+    Test that concurrent callers share a single refresh and then hit the cache.
+    :param mocker:
+    :return:
+    """
+    client = create_client("Apitoken someApitoken")
+    calls = []
+
+    def do_post_mocked(self, url, json=None, headers=None, data=None):
+        calls.append(url)
+        time.sleep(0.1)
+        return {"access_token": "someAccessToken", "expires_in": 300}
+
+    mocker.patch("src.pipeforce.PipeforceClient.do_post", do_post_mocked)
+
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        tokens = list(executor.map(lambda _: client.get_pipeforce_access_token(), range(10)))
+
+    assert tokens == ["someAccessToken"] * 10
+    assert len(calls) == 1
+    assert client.token_manager.metrics() == {"hits": 9, "refreshes": 1, "exchanges": 0, "failures": 0}
+
+
+def test_token_refresh_ahead_of_expiry_reuses_refresh_token(mocker):
+    """
+    Test that the token is refreshed before it expires and the refresh token is reused instead of
+    exchanging the password again.
+    :param mocker:
+    :return:
+    """
+    client = create_client("Basic someUsername:somePass")
+    client.config.PIPEFORCE_TOKEN_REFRESH_MARGIN = 30
+    calls = []
+
+    def do_post_mocked(self, url, json=None, headers=None, data=None):
+        calls.append(url.rsplit("/", 1)[1])
+        if url.endswith("iam.token"):
+            return {"refresh_token": "someRefreshToken"}
+        assert json["refreshToken"] == "someRefreshToken"
+        return {"access_token": f"someAccessToken{len(calls)}", "expires_in": 300}
+
+    mocker.patch("src.pipeforce.PipeforceClient.do_post", do_post_mocked)
+
+    assert client.get_pipeforce_access_token() == "someAccessToken2"
+    assert client.token_manager.refresh_at == client.token_manager.expires_at - 30
+
+    # Token is about to expire but still valid -> refresh
+    client.token_manager.refresh_at = time.monotonic() - 1
+    assert client.get_pipeforce_access_token() == "someAccessToken3"
+    assert calls == ["iam.token", "iam.token.refresh", "iam.token.refresh"]
+
+
+def test_token_refresh_failure_uses_valid_token(mocker):
+    """
+    Test that a failed refresh falls back to the current token while it has not expired yet.
+    :param mocker:
+    :return:
+    """
+    client = create_client("Apitoken someApitoken")
+    fail = threading.Event()
+
+    def do_post_mocked(self, url, json=None, headers=None, data=None):
+        if fail.is_set():
+            raise Exception("Hub not available")
+        return {"access_token": "someAccessToken", "expires_in": 300}
+
+    mocker.patch("src.pipeforce.PipeforceClient.do_post", do_post_mocked)
+
+    client.get_pipeforce_access_token()
+    fail.set()
+    client.token_manager.refresh_at = time.monotonic() - 1
+
+    assert client.get_pipeforce_access_token() == "someAccessToken"
+    assert client.token_manager.metrics()["failures"] == 1
+
+
+def test_token_refresh_exchanges_apitoken_again(mocker):
+    """
+    Test that the Apitoken is used again once the refresh token rotated by the hub is rejected.
+    :param mocker:
+    :return:
+    """
+    client = create_client("Apitoken someApitoken")
+    refresh_tokens = []
+
+    def do_post_mocked(self, url, json=None, headers=None, data=None):
+        refresh_tokens.append(json["refreshToken"])
+        if json["refreshToken"] == "someRotatedToken" and len(refresh_tokens) > 1:
+            raise Exception("Refresh token expired")
+        return {"access_token": f"someAccessToken{len(refresh_tokens)}", "expires_in": 300,
+                "refresh_token": "someRotatedToken"}
+
+    mocker.patch("src.pipeforce.PipeforceClient.do_post", do_post_mocked)
+
+    assert client.get_pipeforce_access_token() == "someAccessToken1"
+    client.token_manager.expires_at = client.token_manager.refresh_at = time.monotonic() - 1
+
+    assert client.get_pipeforce_access_token() == "someAccessToken3"
+    assert refresh_tokens == ["someApitoken", "someRotatedToken", "someApitoken"]
+    assert client.token_manager.metrics()["failures"] == 0
@@ -0,0 +1,186 @@
+import threading
+import time
+
+from src.logs import get_logger
+
+logger = get_logger("tokens")
+
+
+class TokenManager:  # pylint: disable=too-many-instance-attributes
+    """
+        Caches the access token to login to PIPEFORCE and refreshes it ahead of its expiry.
+        Concurrent callers share a single refresh (single-flight), the refresh token is reused for
+        subsequent refreshes and a background timer renews the access token before it expires,
+        so requests in-flight at expiry time do not fail.
+    """
+
+    def __init__(self, client):
+        """
+        :param client: The PipeforceClient used to call the hub.
+        """
+        self.client = client
+        self.config = client.config
+        self.lock = threading.Lock()
+        self.timer = None
+        self.stopped = False
+
+        self.access_token = None
+        self.refresh_token = None
+
+        # Monotonic timestamps in seconds: when the token expires and when it should be refreshed
+        self.expires_at = 0.0
+        self.refresh_at = 0.0
+
+        # Metrics
+        self.hits = 0
+        self.refreshes = 0
+        self.exchanges = 0
+        self.failures = 0
+
+    def get_access_token(self) -> str:
+        """
+        Returns the current access token. Refreshes it in case it is about to expire or doesn't exist yet.
+        :return:
+        """
+        if self.access_token and time.monotonic() < self.refresh_at:
+            self.hits += 1
+            return self.access_token
+
+        with self.lock:
+            # Another thread might have refreshed the token while we were waiting for the lock
+            if self.access_token and time.monotonic() < self.refresh_at:
+                self.hits += 1
+                return self.access_token
+
+            try:
+                self.refresh()
+            except Exception:
+                # The current token can still be used until it has finally expired
+                if self.access_token and time.monotonic() < self.expires_at:
+                    self.hits += 1
+                    return self.access_token
+                raise
+
+            return self.access_token
+
+    def refresh(self):
+        """
+        Requests a new access token using the cached refresh token. In case there is no refresh token yet
+        or it was rejected, exchanges a new one using PIPEFORCE_SECRET first. This applies to both secret types,
+        since the hub might rotate the refresh token of an Apitoken secret as well. Must be called with lock held.
+        :return:
+        """
+        try:
+            exchanged = self.refresh_token is None
+            if exchanged:
+                self.refresh_token = self.exchange_refresh_token()
+
+            try:
+                response = self.request_access_token()
+            # pylint: disable=broad-except
+            except Exception:
+                # The refresh token might have expired or been rotated -> exchange a new one and try once again
+                if exchanged:
+                    raise
+                self.refresh_token = self.exchange_refresh_token()
+                response = self.request_access_token()
+
+        except Exception:
+            self.failures += 1
+            raise
+
+        now = time.monotonic()
+        expires_in = response['expires_in']
+        margin = min(self.config.PIPEFORCE_TOKEN_REFRESH_MARGIN, expires_in / 2)
+
+        self.access_token = response['access_token']
+        self.refresh_token = response.get('refresh_token') or self.refresh_token
+        self.expires_at = now + expires_in
+        self.refresh_at = self.expires_at - margin
+        self.refreshes += 1
+
+        if self.config.PIPEFORCE_TOKEN_BACKGROUND_REFRESH:
+            self.schedule(self.refresh_at - now)
+
+    def exchange_refresh_token(self) -> str:
+        """
+        Returns a refresh token for the PIPEFORCE_SECRET. Basic secrets are exchanged using the iam.token command,
+        Apitoken secrets are offline tokens which can be used as refresh token directly.
+        :return:
+        """
+        secret = self.config.PIPEFORCE_SECRET
+
+        # Is it Basic secret?
+        if secret.startswith("Basic "):
+            username, password = secret[len("Basic "):].split(":", 1)
+            json = self.client.do_post(self.config.PIPEFORCE_HUB_URL + "/api/v3/command/iam.token",
+                                       json={"username": username, "password": password})
+            self.exchanges += 1
+            return json['refresh_token']
+
+        # Is it Apitoken secret?
+        if secret.startswith("Apitoken "):
+            return secret[len("Apitoken "):]
+
+        raise ValueError("Config PIPEFORCE_SECRET must start with Basic or Apitoken!")
+
+    def request_access_token(self) -> dict:
+        """
+        Exchanges the refresh token for a new access token.
+        :return:
+        """
+        return self.client.do_post(self.config.PIPEFORCE_HUB_URL + "/api/v3/command/iam.token.refresh",
+                                   json={"refreshToken": self.refresh_token})
+
+    def schedule(self, delay: float):
+        """
+        Schedules a background refresh after the given delay in seconds.
+        :param delay:
+        :return:
+        """
+        if self.stopped:
+            return
+
+        if self.timer:
+            self.timer.cancel()
+
+        self.timer = threading.Timer(max(delay, 0), self.refresh_in_background)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def refresh_in_background(self):
+        """
+        Refreshes the token from the background timer. On failure, tries again a few seconds later as long as
+        the current token is valid. Afterwards the next caller refreshes it synchronously.
+        :return:
+        """
+        with self.lock:
+            try:
+                self.refresh()
+            # pylint: disable=broad-except
+            except Exception as error:
+                logger.error("Background refresh of access token failed: %r", error)
+                retry_delay = self.config.PIPEFORCE_TOKEN_REFRESH_RETRY
+                if time.monotonic() + retry_delay < self.expires_at:
+                    self.schedule(retry_delay)
+
+    def stop(self):
+        """
+        Stops background refreshes.
+        :return:
+        """
+        self.stopped = True
+        if self.timer:
+            self.timer.cancel()
+
+    def metrics(self) -> dict:
+        """
+        Returns the counters of this token manager.
+        :return:
+        """
+        return {
+            "hits": self.hits,
+            "refreshes": self.refreshes,
+            "exchanges": self.exchanges,
+            "failures": self.failures,
+        }
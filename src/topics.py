@@ -0,0 +1,131 @@
+from collections import OrderedDict
+from functools import lru_cache
+
+# Label value of the metrics of messages which did not match any mapping
+UNMATCHED_PATTERN = "unmatched"
+
+
+class _TopicNode:
+    """
+        A single node of the topic trie. Each node represents one word of a routing key pattern.
+    """
+    __slots__ = ("children", "entries")
+
+    def __init__(self):
+        self.children = {}
+        self.entries = []
+
+
+class RoutingIndex:
+    """
+        Precompiled lookup index from routing keys to event mappings.
+        Patterns without wildcards are stored in a hash map, patterns containing * or # are stored
+        word by word in a topic trie. The result of a lookup is cached per routing key, so matching
+        costs are nearly constant regardless of the number of mappings.
+    """
+
+    def __init__(self, mappings, cache_size: int = 10000):
+        """
+        Builds the index.
+        :param mappings: The mappings from routing key pattern to service method as dict or list of tuples.
+        :param cache_size: Max number of routing keys to cache lookup results for. 0 disables the cache.
+        """
+        self.exact = {}
+        self.trie = _TopicNode()
+        self.has_wildcards = False
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+        # Remember the position so results keep the top-down order of the mappings
+        items = mappings.items() if isinstance(mappings, dict) else mappings
+        for position, (pattern, value) in enumerate(items):
+            entry = (position, pattern, value)
+            words = pattern.split(".")
+
+            if "*" not in words and "#" not in words:
+                self.exact.setdefault(pattern, []).append(entry)
+                continue
+
+            self.has_wildcards = True
+            node = self.trie
+            for word in words:
+                node = node.children.setdefault(word, _TopicNode())
+            node.entries.append(entry)
+
+    def match(self, routing_key: str) -> list:
+        """
+        Returns all mappings matching the given routing key as list of (pattern, value) tuples
+        in the order they were defined.
+        :param routing_key:
+        :return:
+        """
+        result = self.cache.get(routing_key)
+        if result is not None:
+            self.cache.move_to_end(routing_key)
+            return result
+
+        found = list(self.exact.get(routing_key, ()))
+        if self.has_wildcards:
+            matched = set()
+            self._collect(self.trie, routing_key.split("."), 0, matched)
+            found.extend(matched)
+
+        found.sort()
+        result = [(pattern, value) for _, pattern, value in found]
+
+        if self.cache_size > 0:
+            self.cache[routing_key] = result
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return result
+
+    def _collect(self, node: _TopicNode, words: list, index: int, matched: set):
+        """
+        Walks the trie and collects all entries matching the given words starting at index.
+        :param node:
+        :param words:
+        :param index:
+        :param matched:
+        :return:
+        """
+        hash_node = node.children.get("#")
+
+        if index == len(words):
+            matched.update(node.entries)
+            # A trailing # also matches zero words
+            if hash_node:
+                self._collect(hash_node, words, index, matched)
+            return
+
+        child = node.children.get(words[index])
+        if child:
+            self._collect(child, words, index + 1, matched)
+
+        star_node = node.children.get("*")
+        if star_node:
+            self._collect(star_node, words, index + 1, matched)
+
+        if hash_node:
+            for rest in range(index, len(words) + 1):
+                self._collect(hash_node, words, rest, matched)
+
+
+@lru_cache(maxsize=1024)
+def pattern_index(pattern: str) -> RoutingIndex:
+    """
+    Returns a cached single-pattern index used by amqp_match.
+    :param pattern:
+    :return:
+    """
+    return RoutingIndex({pattern: pattern}, cache_size=0)
+
+
+def pattern_labels(matches) -> tuple:
+    """
+    Returns the metric labels of a message. These contain the pattern of its first matching mapping instead of
+    its routing key, so the number of label values is bounded by the mappings.
+    :param matches: List of (pattern, value) tuples as returned by RoutingIndex.match.
+    :return:
+    """
+    return (("pattern", matches[0][0] if matches else UNMATCHED_PATTERN),)
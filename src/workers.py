@@ -0,0 +1,35 @@
+# The client of a process pool worker, used to resolve service methods inside the worker process
+_worker_client = None  # pylint: disable=invalid-name
+
+
+def init_process_worker(client_class, config):
+    """
+    Initializes a process pool worker with its own client. Note that this client has no connection to the
+    message broker, so service methods executed in worker processes can not send messages.
+    :param client_class:
+    :param config:
+    :return:
+    """
+    global _worker_client  # pylint: disable=global-statement,invalid-name
+    _worker_client = client_class(config)
+
+
+def run_in_process_worker(routing_key, matches, payload) -> list:
+    """
+    Executes the service functions of the given matches inside a process pool worker.
+    :param routing_key:
+    :param matches:
+    :param payload:
+    :return: The failures as returned by run_handlers.
+    """
+    return _worker_client.run_handlers(routing_key, matches, payload)
+
+
+def run_batch_in_process_worker(value, payloads) -> list:
+    """
+    Executes the batch service method with the given payloads inside a process pool worker.
+    :param value: The batch service method in the form module.Class#method.
+    :param payloads:
+    :return: The failures as returned by run_batch.
+    """
+    return _worker_client.run_batch(value, payloads)